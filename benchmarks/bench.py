@@ -0,0 +1,347 @@
+"""
+Бенчмарки обробників і сховища історії на великих обсягах.
+
+Бот працює з підставним Bot (без мережі) і синтетичними оновленнями в
+тимчасовому каталозі. Для кожного розміру історії (1k/10k/100k записів) і
+кількості груп (10/100/1000) вимірюються пропускна здатність, затримки
+p50/p99 і пікова пам'ять (tracemalloc). Результат - JSON, який можна
+порівнювати між змінами:
+
+    python benchmarks/bench.py --output before.json
+    python benchmarks/bench.py --output after.json --compare before.json
+    python benchmarks/bench.py --quick
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from telegram import Chat, Message, Update, User  # noqa: E402
+
+from bot.fanout import TokenBucket, percentile  # noqa: E402
+
+DEFAULT_RECORDS = (1000, 10000, 100000)
+DEFAULT_GROUPS = (10, 100, 1000)
+QUICK_RECORDS = (1000, 10000)
+QUICK_GROUPS = (10, 100)
+
+ADMIN_ID = 1
+GROUP_ID_BASE = -1000000000000
+
+# Скільки викликів виконувати в кожному сценарії
+SAVE_CALLS = 2000
+READ_CALLS = 200
+SWEEP_ROUNDS = 3
+
+
+class FakeBot:
+    """Підставний Bot: приймає виклики Bot API і нічого не надсилає"""
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = 0
+        self._admin = SimpleNamespace(user=SimpleNamespace(id=ADMIN_ID), status='creator')
+
+    async def _call(self):
+        self.calls += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await self._call()
+
+    async def set_chat_permissions(self, chat_id, permissions, **kwargs):
+        await self._call()
+        return True
+
+    async def get_chat_administrators(self, chat_id, **kwargs):
+        await self._call()
+        return [self._admin]
+
+    async def get_chat_member(self, chat_id, user_id, **kwargs):
+        await self._call()
+        return SimpleNamespace(status='creator' if user_id == ADMIN_ID else 'member')
+
+
+class FakeJobQueue:
+    def run_once(self, *args, **kwargs):
+        pass
+
+    def get_jobs_by_name(self, name):
+        return []
+
+
+def make_context(bot, args=()):
+    return SimpleNamespace(bot=bot, args=list(args), job_queue=FakeJobQueue())
+
+
+# Генератор синтетичних оновлень
+def make_update(bot, update_id, chat_id, user_id=ADMIN_ID, text="Тестове повідомлення", chat_type='supergroup'):
+    chat = Chat(chat_id, chat_type, title=f"Група {chat_id}" if chat_type != 'private' else None)
+    user = User(user_id, f"Користувач {user_id}", False)
+    message = Message(update_id, datetime.now(timezone.utc), chat, from_user=user, text=text)
+    message.set_bot(bot)
+    return Update(update_id, message=message)
+
+
+def synthetic_records(count, groups, start=0):
+    for i in range(start, start + count):
+        yield {
+            'user_name': f"Користувач {i % 500}",
+            'user_id': 1000 + i % 500,
+            'chat_id': GROUP_ID_BASE - i % max(1, groups),
+            'chat_type': 'supergroup',
+            'message_text': f"Синтетичне повідомлення номер {i}",
+            'timestamp': f"{i // 60 % 24:02d}:{i % 60:02d}",
+            'status': ('received', 'replied', 'blocked_time')[i % 3],
+            'replied_by': None,
+            'reply_timestamp': None,
+        }
+
+
+class Measurement:
+    """Затримки окремих викликів, загальний час і пікова пам'ять сценарію"""
+
+    def __init__(self, track_memory):
+        self.track_memory = track_memory
+        self.latencies = []
+        self.started = 0.0
+        self.duration = 0.0
+        self.peak_bytes = None
+
+    def __enter__(self):
+        if self.track_memory:
+            tracemalloc.reset_peak()
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.duration = time.perf_counter() - self.started
+        if self.track_memory:
+            self.peak_bytes = tracemalloc.get_traced_memory()[1]
+
+    async def call(self, coroutine):
+        started = time.perf_counter()
+        result = await coroutine
+        self.latencies.append(time.perf_counter() - started)
+        return result
+
+    def result(self, scenario, **params):
+        calls = len(self.latencies)
+        return {
+            'scenario': scenario,
+            **params,
+            'calls': calls,
+            'seconds': round(self.duration, 4),
+            'throughput_per_s': round(calls / self.duration, 1) if self.duration else None,
+            'p50_ms': round(percentile(self.latencies, 50) * 1000, 3),
+            'p99_ms': round(percentile(self.latencies, 99) * 1000, 3),
+            'peak_kb': round(self.peak_bytes / 1024, 1) if self.peak_bytes is not None else None,
+        }
+
+
+async def fill_store(main, target, groups):
+    """Доводить сховище до target записів пакетами напряму через apply_batch"""
+    current = main.message_store.stats.total()
+    batch = []
+    for record in synthetic_records(target - current, groups, start=current):
+        batch.append(('add', (record,), {}))
+        if len(batch) >= 5000:
+            await asyncio.to_thread(main.message_store.apply_batch, batch)
+            batch = []
+    if batch:
+        await asyncio.to_thread(main.message_store.apply_batch, batch)
+
+
+async def bench_history(main, bot, records, track_memory):
+    results = []
+    await fill_store(main, records, groups=100)
+
+    # save_message: від постановки в чергу до коміту
+    with Measurement(track_memory) as m:
+        futures = []
+        for record in synthetic_records(SAVE_CALLS, 100, start=records):
+            started = time.perf_counter()
+            future = main.save_message(
+                record['user_name'], record['user_id'], record['chat_id'], record['chat_type'],
+                record['message_text'], record['timestamp'], record['status']
+            )
+            future.add_done_callback(lambda _, started=started: m.latencies.append(time.perf_counter() - started))
+            futures.append(future)
+        await asyncio.gather(*futures)
+    results.append(m.result('save_message', records=records))
+
+    with Measurement(track_memory) as m:
+        for _ in range(READ_CALLS):
+            await m.call(main.get_recent_messages(10))
+    results.append(m.result('get_recent_messages', records=records))
+
+    with Measurement(track_memory) as m:
+        for i in range(READ_CALLS):
+            update = make_update(bot, i, GROUP_ID_BASE)
+            await m.call(main.stats_command(update, make_context(bot)))
+    results.append(m.result('stats_command', records=records))
+
+    with Measurement(track_memory) as m:
+        for i in range(READ_CALLS):
+            update = make_update(bot, i, GROUP_ID_BASE)
+            await m.call(main.history_command(update, make_context(bot)))
+    results.append(m.result('history_command', records=records))
+
+    with Measurement(track_memory) as m:
+        for i in range(SAVE_CALLS):
+            update = make_update(bot, i, GROUP_ID_BASE - i % 100, user_id=1000 + i % 500)
+            await m.call(main.message_handler(update, make_context(bot)))
+        await main.message_writer.submit('maintenance')
+    results.append(m.result('message_handler', records=records))
+    return results
+
+
+async def reset_groups(main):
+    """Прибирає всі групи (зокрема зареєстровані сценарієм message_handler) і їхній стан"""
+    for chat_id in list(main.group_registry):
+        main.group_registry.remove(chat_id)
+        main.applied_permissions.forget(chat_id)
+        await main.remember_status(chat_id, None)
+
+
+async def bench_sweep(main, bot, groups, track_memory):
+    await reset_groups(main)
+    for i in range(groups):
+        main.group_registry.add(GROUP_ID_BASE - i, f"Група {i}")
+    context = make_context(bot)
+    bot.calls = 0
+
+    results = []
+    for round_number in range(SWEEP_ROUNDS):
+        # Перший прохід застосовує дозволи всім групам, наступні - тільки перевіряють
+        with Measurement(track_memory) as m:
+            await m.call(main.check_and_update_group_permissions(context))
+        result = m.result('check_and_update_group_permissions', groups=groups, round=round_number + 1)
+        result['api_calls'] = bot.calls
+        bot.calls = 0
+        results.append(result)
+    return results
+
+
+async def run(args):
+    import logging
+
+    import main
+
+    # Бенчмарк вимірює код, а не лог і не ліміт Telegram
+    logging.getLogger().setLevel(logging.WARNING)
+    main.api_rate_limiter = TokenBucket(args.api_rate) if args.api_rate else None
+    main.outbox.limiter = main.api_rate_limiter
+    main.outbox.private_rate = main.outbox.group_rate = 0
+
+    bot = FakeBot(latency=args.api_latency / 1000)
+    if not args.no_memory:
+        tracemalloc.start()
+
+    results = []
+    await main.message_writer.start()
+    await main.outbox.start()
+    try:
+        for records in args.records:
+            results.extend(await bench_history(main, bot, records, not args.no_memory))
+            print(f"історія {records}: готово", file=sys.stderr)
+        for groups in args.groups:
+            results.extend(await bench_sweep(main, bot, groups, not args.no_memory))
+            print(f"групи {groups}: готово", file=sys.stderr)
+    finally:
+        await main.outbox.stop()
+        await main.message_writer.stop()
+        main.message_store.close()
+        if not args.no_memory:
+            tracemalloc.stop()
+    return results
+
+
+def compare(results, baseline_path):
+    """Друкує відношення p50/p99/пропускної здатності до попереднього запуску"""
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = json.load(f)['results']
+
+    def key(result):
+        return (result['scenario'], result.get('records'), result.get('groups'), result.get('round'))
+
+    previous = {key(result): result for result in baseline}
+    for result in results:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        ratios = []
+        for field in ('p50_ms', 'p99_ms', 'throughput_per_s'):
+            if old.get(field) and result.get(field) is not None:
+                ratios.append(f"{field} x{result[field] / old[field]:.2f}")
+        label = ' '.join(f"{name}={value}" for name, value in zip(('records', 'groups', 'round'), key(result)[1:]) if value)
+        print(f"{result['scenario']} {label}: {', '.join(ratios)}")
+
+
+def parse_sizes(text):
+    return tuple(int(value) for value in text.split(',') if value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки обробників і сховища історії")
+    parser.add_argument('--backend', choices=['sqlite', 'json'], default='sqlite')
+    parser.add_argument('--records', type=parse_sizes, default=DEFAULT_RECORDS, help="розміри історії через кому")
+    parser.add_argument('--groups', type=parse_sizes, default=DEFAULT_GROUPS, help="кількості груп через кому")
+    parser.add_argument('--quick', action='store_true', help="менші розміри для швидкої перевірки")
+    parser.add_argument('--api-latency', type=float, default=0.0, help="затримка підставного Bot API (мс)")
+    parser.add_argument('--api-rate', type=float, default=0.0, help="ліміт викликів Bot API на секунду (0 - без ліміту)")
+    parser.add_argument('--no-memory', action='store_true', help="не вимірювати пам'ять (tracemalloc сповільнює код)")
+    parser.add_argument('--output', help="файл для JSON-результатів (за замовчуванням - stdout)")
+    parser.add_argument('--compare', help="попередній JSON-результат для порівняння")
+    args = parser.parse_args()
+    if args.quick:
+        args.records, args.groups = QUICK_RECORDS, QUICK_GROUPS
+
+    with tempfile.TemporaryDirectory(prefix='bot-bench-') as workdir:
+        # main читає налаштування з оточення під час імпорту, а файли створює в поточному каталозі
+        os.chdir(workdir)
+        os.environ.update({
+            'MESSAGE_STORE': args.backend,
+            'WORKER_MODE': 'single',
+            'METRICS_PORT': '0',
+            'LOG_FORMAT': 'text',
+        })
+        os.environ.pop('MESSAGES_FILE', None)
+        results = asyncio.run(run(args))
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'backend': args.backend,
+            'api_latency_ms': args.api_latency,
+            'memory_tracked': not args.no_memory,
+        },
+        'results': results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
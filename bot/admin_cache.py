@@ -0,0 +1,117 @@
+"""
+Кеш статусів учасників груп для перевірки прав адміністратора.
+
+Замість get_chat_member на кожну адмінську команду статус береться з кешу
+з обмеженим часом життя. При промаху бот один раз завантажує список
+адміністраторів групи (get_chat_administrators) і заповнює кеш для всіх
+них; хто не в списку - не адміністратор. Оновлення chat_member скидають
+або оновлюють записи одразу.
+
+Зберігаються тільки статуси адміністраторів і власників: звичайних
+учасників кеш не пам'ятає (їхній статус випливає зі списку
+адміністраторів), тому розмір кешу не залежить від кількості учасників
+груп.
+"""
+
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# Час життя запису кешу (секунди)
+DEFAULT_TTL = 300
+
+# Статус, яким позначаються учасники поза списком адміністраторів
+NON_ADMIN_STATUS = 'member'
+
+ADMIN_STATUSES = ('creator', 'administrator')
+
+
+class MemberStatusCache:
+    """TTL-кеш статусів адміністраторів (chat_id, user_id) -> status з лічильниками влучань"""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # (chat_id, user_id) -> (status, expires_at), тільки для ADMIN_STATUSES
+        self._statuses = {}
+        # chat_id -> (множина ID адміністраторів, expires_at)
+        self._admins = {}
+        # chat_id -> задача завантаження списку адміністраторів, що виконується зараз
+        self._inflight = {}
+
+    async def get_status(self, bot, chat_id, user_id):
+        """Повертає статус учасника ('creator', 'administrator', 'member', ...)"""
+        now = time.monotonic()
+        cached = self._statuses.get((chat_id, user_id))
+        if cached is not None and cached[1] > now:
+            self.hits += 1
+            return cached[0]
+        admins = self._admins.get(chat_id)
+        if admins is not None and admins[1] > now and user_id not in admins[0]:
+            # Список адміністраторів свіжий, а користувача в ньому немає
+            self.hits += 1
+            return NON_ADMIN_STATUS
+
+        self.misses += 1
+        if admins is None or admins[1] <= now:
+            try:
+                await self._load_administrators(bot, chat_id)
+            except Exception as e:
+                # Не вдалося отримати список - питаємо про конкретного користувача
+                logger.warning(f"Не вдалося отримати адміністраторів чату {chat_id}: {e}")
+                member = await bot.get_chat_member(chat_id, user_id)
+                self.update(chat_id, user_id, member.status)
+                return member.status
+
+        cached = self._statuses.get((chat_id, user_id))
+        if cached is not None:
+            return cached[0]
+        return NON_ADMIN_STATUS
+
+    async def _load_administrators(self, bot, chat_id):
+        # Одночасні промахи в одному чаті чекають на одне й те саме завантаження
+        task = self._inflight.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch_administrators(bot, chat_id))
+            self._inflight[chat_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(chat_id, None))
+        await asyncio.shield(task)
+
+    async def _fetch_administrators(self, bot, chat_id):
+        administrators = await bot.get_chat_administrators(chat_id)
+
+        # Старі записи чату (зокрема про колишніх адміністраторів) більше не актуальні
+        self.invalidate(chat_id)
+        expires_at = time.monotonic() + self.ttl
+        admin_ids = set()
+        for member in administrators:
+            admin_ids.add(member.user.id)
+            self._statuses[(chat_id, member.user.id)] = (member.status, expires_at)
+        self._admins[chat_id] = (admin_ids, expires_at)
+
+    def update(self, chat_id, user_id, status):
+        """Записує відомий статус (наприклад, з оновлення chat_member)"""
+        admins = self._admins.get(chat_id)
+        if status in ADMIN_STATUSES:
+            self._statuses[(chat_id, user_id)] = (status, time.monotonic() + self.ttl)
+            if admins is not None:
+                admins[0].add(user_id)
+        else:
+            self._statuses.pop((chat_id, user_id), None)
+            if admins is not None:
+                admins[0].discard(user_id)
+
+    def invalidate(self, chat_id, user_id=None):
+        """Скидає кеш для користувача або для всього чату"""
+        if user_id is not None:
+            self._statuses.pop((chat_id, user_id), None)
+            return
+        self._admins.pop(chat_id, None)
+        for key in [key for key in self._statuses if key[0] == chat_id]:
+            del self._statuses[key]
+
+    def counters(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._statuses)}
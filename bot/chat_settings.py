@@ -0,0 +1,91 @@
+"""
+Розклади робочих годин для окремих чатів.
+
+Розклади зберігаються в JSON-файлі, завантажуються один раз при старті і
+тримаються в пам'яті разом зі скомпільованими формами. Пошук розкладу на
+шляху обробки повідомлення - це звичайне читання словника в циклі подій.
+Чати без власного розкладу використовують розклад за замовчуванням.
+"""
+
+import json
+import logging
+from pathlib import Path
+
+from bot.clock import CompiledSchedule, Schedule
+from bot.storage import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class ChatSchedules:
+    """Розклади по чатах: chat_id -> Schedule і його CompiledSchedule"""
+
+    def __init__(self, path, default_schedule):
+        self.path = Path(path)
+        self.default_schedule = default_schedule
+        self.default_clock = CompiledSchedule(default_schedule)
+        self._schedules = {}
+        self._clocks = {}
+        self.load()
+
+    def load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Не вдалося прочитати розклади чатів {self.path}: {e}")
+            return
+        self.restore(data)
+
+    def restore(self, data):
+        """Замінює власні розклади чатів знімком (у форматі snapshot)"""
+        old_schedules, old_clocks = self._schedules, self._clocks
+        self._schedules = {}
+        self._clocks = {}
+        for chat_id, schedule_data in data.items():
+            try:
+                chat_id = int(chat_id)
+                schedule = Schedule.from_dict(schedule_data)
+            except (KeyError, ValueError) as e:
+                logger.error(f"Пошкоджений розклад чату {chat_id} пропущено: {e}")
+                continue
+            # Незмінені розклади не компілюються заново
+            if old_schedules.get(chat_id) == schedule:
+                self._schedules[chat_id] = old_schedules[chat_id]
+                self._clocks[chat_id] = old_clocks[chat_id]
+            else:
+                self._set(chat_id, schedule)
+
+    def _set(self, chat_id, schedule):
+        self._schedules[chat_id] = schedule
+        self._clocks[chat_id] = CompiledSchedule(schedule)
+
+    def has_own(self, chat_id):
+        return chat_id in self._schedules
+
+    def schedule_for(self, chat_id):
+        return self._schedules.get(chat_id, self.default_schedule)
+
+    def clock_for(self, chat_id):
+        return self._clocks.get(chat_id, self.default_clock)
+
+    def set(self, chat_id, schedule):
+        """Встановлює власний розклад чату"""
+        self._set(chat_id, schedule)
+
+    def reset(self, chat_id):
+        """Повертає чат до розкладу за замовчуванням"""
+        self._schedules.pop(chat_id, None)
+        self._clocks.pop(chat_id, None)
+
+    def clocks(self):
+        """Усі різні скомпільовані розклади (за замовчуванням і власні)"""
+        return [self.default_clock, *self._clocks.values()]
+
+    def snapshot(self):
+        return {str(chat_id): schedule.to_dict() for chat_id, schedule in self._schedules.items()}
+
+    def write(self, data):
+        write_json_atomic(self.path, data)
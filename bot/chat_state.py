@@ -0,0 +1,152 @@
+"""
+Останні застосовані дозволи і надіслані статуси для кожної групи.
+
+Зберігається, які дозволи бот востаннє встановив у групі і коли. Перевірка
+викликає setChatPermissions тільки якщо потрібний стан відрізняється від
+застосованого або минув інтервал повторної перевірки.
+
+Так само зберігається останній статус робочого часу, про який група
+отримала повідомлення: після перезапуску перевірка не надсилає "доброго
+ранку" групам, які його вже отримали.
+"""
+
+import json
+import logging
+import random
+import time
+from pathlib import Path
+
+from bot.storage import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class AppliedPermissions:
+    """Застосовані дозволи по чатах: chat_id -> (can_send_messages, applied_at)"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._applied = {}
+        # Чи є зміни, ще не записані на диск
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Не вдалося прочитати стан дозволів {self.path}: {e}")
+            return
+        self.restore(data)
+
+    def restore(self, data):
+        """Замінює стан знімком (у форматі snapshot)"""
+        self._applied = {
+            int(chat_id): (entry['can_send_messages'], entry['applied_at'])
+            for chat_id, entry in data.items()
+        }
+
+    def get(self, chat_id):
+        """Повертає (can_send_messages, applied_at) або None"""
+        return self._applied.get(chat_id)
+
+    def needs_update(self, chat_id, can_send_messages, now, reverify_interval):
+        """Чи треба викликати setChatPermissions для цього чату"""
+        applied = self._applied.get(chat_id)
+        if applied is None:
+            return True
+        applied_state, applied_at = applied
+        return applied_state != can_send_messages or now - applied_at >= reverify_interval
+
+    def record(self, chat_id, can_send_messages, now):
+        self._applied[chat_id] = (can_send_messages, now)
+        self.dirty = True
+
+    def stagger_overdue(self, now, reverify_interval):
+        """Розносить у часі повторну перевірку чатів, для яких вона прострочена
+
+        Після довгої зупинки строк повторної перевірки минає для всіх груп
+        одночасно, і перша перевірка викликала б Bot API для кожної. Незмінні
+        дозволи тільки страхуються повторною перевіркою, тож її можна
+        рівномірно розподілити на наступний інтервал.
+        """
+        staggered = 0
+        for chat_id, (state, applied_at) in self._applied.items():
+            if now - applied_at >= reverify_interval:
+                self._applied[chat_id] = (state, now - reverify_interval + random.uniform(0, reverify_interval))
+                staggered += 1
+        if staggered:
+            self.dirty = True
+        return staggered
+
+    def forget(self, chat_id):
+        """Скидає стан чату, щоб наступна перевірка застосувала дозволи заново"""
+        if self._applied.pop(chat_id, None) is None:
+            return False
+        self.dirty = True
+        return True
+
+    def snapshot(self):
+        """Знімок стану для запису; скидає ознаку незаписаних змін"""
+        self.dirty = False
+        return {
+            str(chat_id): {'can_send_messages': state, 'applied_at': applied_at}
+            for chat_id, (state, applied_at) in self._applied.items()
+        }
+
+    def write(self, data):
+        write_json_atomic(self.path, data)
+
+
+class SentStatuses:
+    """Останній надісланий групі статус робочого часу: chat_id -> 'allowed' або 'blocked'"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._statuses = {}
+        # Чи є зміни, ще не записані на диск
+        self.dirty = False
+
+    def __len__(self):
+        return len(self._statuses)
+
+    def load(self):
+        """Відновлює статуси зі знімка; повертає кількість відновлених чатів"""
+        if not self.path.exists():
+            return 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Не вдалося прочитати знімок статусів {self.path}: {e}")
+            return 0
+        self.restore(data)
+        return len(self._statuses)
+
+    def restore(self, data):
+        """Замінює стан знімком (у форматі snapshot)"""
+        self._statuses = {int(chat_id): status for chat_id, status in data.get('statuses', {}).items()}
+        self.dirty = False
+
+    def swap(self, chat_id, status):
+        """Записує статус чату (None - забуває) і повертає попередній"""
+        previous = self._statuses.pop(chat_id, None)
+        if status is not None:
+            self._statuses[chat_id] = status
+        if previous != status:
+            self.dirty = True
+        return previous
+
+    def snapshot(self):
+        """Знімок стану для запису; скидає ознаку незаписаних змін"""
+        self.dirty = False
+        return {
+            'saved_at': time.time(),
+            'statuses': {str(chat_id): status for chat_id, status in self._statuses.items()},
+        }
+
+    def write(self, data):
+        write_json_atomic(self.path, data)
@@ -0,0 +1,272 @@
+"""
+Годинник робочих годин.
+
+Розклад (правила по днях тижня з точністю до хвилини, вікна через північ,
+святкові дні, часова зона) компілюється у відсортований список моментів
+переходу в UTC. Перевірка "чи можна писати зараз" - це одне порівняння
+поточного часу з закешованою наступною межею; часові зони задіяні тільки
+під час компіляції.
+"""
+
+import time
+from bisect import bisect_right
+from collections import namedtuple
+from datetime import date, datetime, timedelta
+
+import pytz
+
+DEFAULT_TIMEZONE = 'Europe/Kiev'
+
+MINUTES_PER_DAY = 24 * 60
+
+ALL_WEEKDAYS = frozenset(range(7))
+
+WEEKDAY_NAMES = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Нд')
+
+# На скільки днів уперед компілюються переходи
+DEFAULT_HORIZON_DAYS = 14
+
+# Скільки горизонтів переглядати в пошуку наступного переходу (розклад без переходів)
+MAX_LOOKAHEAD_HORIZONS = 30
+
+
+# Функція для розбору часу у форматі "9", "09:30" або "24:00"
+def parse_time_of_day(text):
+    """Повертає кількість хвилин від півночі; кидає ValueError для некоректного часу"""
+    hours, _, minutes = text.strip().partition(':')
+    hours = int(hours)
+    minutes = int(minutes) if minutes else 0
+    if not (0 <= minutes < 60) or not (0 <= hours <= 24) or (hours == 24 and minutes):
+        raise ValueError(f"Некоректний час: {text}")
+    return hours * 60 + minutes
+
+
+def format_time_of_day(minutes):
+    return f"{minutes // 60:02d}:{minutes % 60:02d}"
+
+
+# Функція для розбору днів тижня: "1-5", "1,3,5", "6-7" (1 - понеділок)
+def parse_weekdays(text):
+    """Повертає множину днів тижня (0 - понеділок); кидає ValueError для некоректного запису"""
+    weekdays = set()
+    for part in text.split(','):
+        first, _, last = part.strip().partition('-')
+        first = int(first)
+        last = int(last) if last else first
+        if not (1 <= first <= 7 and 1 <= last <= 7):
+            raise ValueError(f"Дні тижня мають бути від 1 до 7: {text}")
+        if first <= last:
+            weekdays.update(range(first - 1, last))
+        else:
+            # Діапазон через неділю, наприклад "6-1"
+            weekdays.update(range(first - 1, 7))
+            weekdays.update(range(0, last))
+    return frozenset(weekdays)
+
+
+def format_weekdays(weekdays):
+    if weekdays == ALL_WEEKDAYS:
+        return "щодня"
+    days = sorted(weekdays)
+    # Суцільний діапазон записуємо як "Пн-Пт"
+    if len(days) > 2 and days == list(range(days[0], days[-1] + 1)):
+        return f"{WEEKDAY_NAMES[days[0]]}-{WEEKDAY_NAMES[days[-1]]}"
+    return ", ".join(WEEKDAY_NAMES[day] for day in days)
+
+
+class ScheduleRule(namedtuple('ScheduleRule', 'weekdays start end')):
+    """Вікно роботи: дні тижня, початок і кінець у хвилинах від півночі
+
+    Якщо end <= start, вікно закінчується наступного дня (start == end - цілодобово).
+    """
+
+    @property
+    def duration(self):
+        length = (self.end - self.start) % MINUTES_PER_DAY
+        return length or MINUTES_PER_DAY
+
+    def describe(self):
+        hours = f"{format_time_of_day(self.start)} - {format_time_of_day(self.end)}"
+        if self.weekdays == ALL_WEEKDAYS:
+            return hours
+        return f"{format_weekdays(self.weekdays)} {hours}"
+
+
+class Schedule:
+    """Розклад робочих годин однієї групи (або глобальний)"""
+
+    def __init__(self, rules, timezone=DEFAULT_TIMEZONE, holidays=()):
+        self.rules = tuple(rules)
+        self.timezone = timezone
+        # Святкові дні: вікна, що починаються в ці дати, не діють
+        self.holidays = frozenset(holidays)
+        self.tz = pytz.timezone(timezone)
+
+    @classmethod
+    def from_hours(cls, start_hour, end_hour, timezone=DEFAULT_TIMEZONE, holidays=()):
+        return cls([ScheduleRule(ALL_WEEKDAYS, start_hour * 60, end_hour * 60)], timezone, holidays)
+
+    def __eq__(self, other):
+        return isinstance(other, Schedule) and self.to_dict() == other.to_dict()
+
+    def describe(self):
+        """Опис для повідомлень, наприклад "08:00 - 23:00" або "Пн-Пт 09:00 - 18:00" """
+        if not self.rules:
+            return "немає робочих годин"
+        return "; ".join(rule.describe() for rule in self.rules)
+
+    def to_dict(self):
+        return {
+            'timezone': self.timezone,
+            'rules': [
+                {
+                    'weekdays': sorted(rule.weekdays),
+                    'start': format_time_of_day(rule.start),
+                    'end': format_time_of_day(rule.end),
+                }
+                for rule in self.rules
+            ],
+            'holidays': sorted(day.isoformat() for day in self.holidays),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        rules = [
+            ScheduleRule(
+                frozenset(rule['weekdays']),
+                parse_time_of_day(rule['start']),
+                parse_time_of_day(rule['end']),
+            )
+            for rule in data['rules']
+        ]
+        holidays = [date.fromisoformat(day) for day in data.get('holidays', [])]
+        return cls(rules, data.get('timezone', DEFAULT_TIMEZONE), holidays)
+
+
+class CompiledSchedule:
+    """Розклад, скомпільований у моменти переходу (секунди epoch)"""
+
+    def __init__(self, schedule, horizon_days=DEFAULT_HORIZON_DAYS, now=None):
+        self.schedule = schedule
+        self.horizon_days = horizon_days
+        self._compile(time.time() if now is None else now)
+
+    def _localize(self, day, minutes):
+        naive = datetime.combine(day, datetime.min.time()) + timedelta(minutes=minutes)
+        # normalize зсуває час, що не існує через перехід на літній час
+        return self.schedule.tz.normalize(self.schedule.tz.localize(naive)).timestamp()
+
+    def _compile(self, now):
+        schedule = self.schedule
+        today = datetime.fromtimestamp(now, schedule.tz).date()
+        first_day = today - timedelta(days=1)
+
+        intervals = []
+        for offset in range(self.horizon_days + 2):
+            day = first_day + timedelta(days=offset)
+            if day in schedule.holidays:
+                continue
+            for rule in schedule.rules:
+                if day.weekday() not in rule.weekdays:
+                    continue
+                start = self._localize(day, rule.start)
+                end = self._localize(day, rule.start + rule.duration)
+                intervals.append((start, end))
+
+        # Об'єднуємо вікна, що перекриваються або стикуються
+        intervals.sort()
+        merged = []
+        for start, end in intervals:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+
+        self._times = []
+        self._states = []
+        for start, end in merged:
+            self._times.extend((start, end))
+            self._states.extend((True, False))
+
+        # День перед сьогоднішнім компілюється тільки заради вікон через північ
+        self._compiled_from = self._localize(today, 0)
+        self._compiled_until = self._localize(first_day + timedelta(days=self.horizon_days + 1), 0)
+        self._locate(now)
+
+    def _locate(self, now):
+        index = bisect_right(self._times, now)
+        self._allowed = self._states[index - 1] if index > 0 else False
+        self._current_since = self._times[index - 1] if index > 0 else self._compiled_from
+        if index < len(self._times):
+            self._next_boundary = min(self._times[index], self._compiled_until)
+        else:
+            self._next_boundary = self._compiled_until
+
+    def is_allowed(self, now=None):
+        """Чи робочий час зараз (або в момент now, секунди epoch)"""
+        if now is None:
+            now = time.time()
+        if self._current_since <= now < self._next_boundary:
+            return self._allowed
+        if not (self._compiled_from <= now < self._compiled_until):
+            self._compile(now)
+        else:
+            self._locate(now)
+        return self._allowed
+
+    def next_transition(self, after=None):
+        """Повертає (момент, стан після нього) найближчого переходу після after
+
+        Для розкладу без переходів (порожній або цілодобовий) повертає (None, None).
+        """
+        if after is None:
+            after = time.time()
+        for _ in range(MAX_LOOKAHEAD_HORIZONS):
+            if not (self._compiled_from <= after < self._compiled_until):
+                self._compile(after)
+            index = bisect_right(self._times, after)
+            # Переходи за межею горизонту неточні: там бракує вікон наступних днів
+            if index < len(self._times) and self._times[index] < self._compiled_until:
+                return self._times[index], self._states[index]
+            after = self._compiled_until - 0.001
+            self._compile(after)
+        return None, None
+
+
+class LocalClock:
+    """Поточний час у часовій зоні з кешем на хвилину"""
+
+    def __init__(self, timezone=DEFAULT_TIMEZONE):
+        self.tz = pytz.timezone(timezone)
+        self._minute_start = 0.0
+        self._minute_end = 0.0
+        self._label = ''
+        self._iso_prefix = ''
+        self._iso_offset = ''
+
+    def _refresh_minute(self, now):
+        if not (self._minute_start <= now < self._minute_end):
+            moment = datetime.fromtimestamp(now, self.tz)
+            self._minute_start = now - moment.second - moment.microsecond / 1_000_000
+            self._minute_end = self._minute_start + 60
+            self._label = moment.strftime("%H:%M")
+            # Зміщення зони змінюється тільки на межі години, тож у межах хвилини воно однакове
+            iso = moment.isoformat(timespec='seconds')
+            self._iso_prefix, self._iso_offset = iso[:17], iso[19:]
+
+    def time_string(self, now=None):
+        """Поточний час у форматі HH:MM"""
+        if now is None:
+            now = time.time()
+        self._refresh_minute(now)
+        return self._label
+
+    def isoformat(self, now=None):
+        """Момент now (секунди epoch) у форматі ISO 8601 з точністю до секунди і зміщенням зони"""
+        if now is None:
+            now = time.time()
+        self._refresh_minute(now)
+        return f"{self._iso_prefix}{int(now - self._minute_start):02d}{self._iso_offset}"
+
+    def now(self):
+        return datetime.now(self.tz)
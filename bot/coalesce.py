@@ -0,0 +1,112 @@
+"""
+Об'єднання серій повідомлень одного користувача в особистому чаті.
+
+Користувач, що надсилає текст кількома повідомленнями підряд, отримує одну
+автовідповідь на серію: на перше повідомлення бот відповідає одразу, на
+наступні - ні. Записи серії зберігаються в історію однією зміною, коли
+серія закінчується: після window секунд без нових повідомлень, але не
+пізніше max_delay секунд від її початку. Якщо змінюється відповідь (серія
+почалась у робочий час, а продовжується після нього), починається нова
+серія з новою відповіддю.
+
+Серії тримаються в LRU з обмеженим розміром. Найдавніша серія, що
+витісняється, записується одразу, тож пам'ять не росте з кількістю
+користувачів, а повідомлення не губляться.
+"""
+
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+from bot.metrics import REPLIES_COALESCED
+
+logger = logging.getLogger(__name__)
+
+# Скільки секунд тиші закінчують серію
+DEFAULT_WINDOW = 5.0
+# Найдовша серія (секунди): далі записи зберігаються, а наступне повідомлення отримує нову відповідь
+DEFAULT_MAX_DELAY = 15.0
+# Скільки серій тримати одночасно
+DEFAULT_MAX_USERS = 10000
+
+
+class Burst:
+    """Серія повідомлень одного користувача"""
+
+    __slots__ = ('reply_key', 'records', 'started', 'last_seen', 'handle')
+
+    def __init__(self, reply_key, now):
+        self.reply_key = reply_key
+        self.records = []
+        self.started = now
+        self.last_seen = now
+        self.handle = None
+
+    def deadline(self, window, max_delay):
+        return min(self.last_seen + window, self.started + max_delay)
+
+
+class BurstCoalescer:
+    """Збирає повідомлення користувачів у серії і передає кожну серію в flush(records)"""
+
+    def __init__(self, flush, window=DEFAULT_WINDOW, max_delay=DEFAULT_MAX_DELAY, max_users=DEFAULT_MAX_USERS):
+        self.flush = flush
+        self.window = window
+        self.max_delay = max_delay
+        self.max_users = max_users
+        # user_id -> Burst, від найдавніше активного до найсвіжішого
+        self._bursts = OrderedDict()
+
+    def __len__(self):
+        return len(self._bursts)
+
+    def add(self, user_id, record, reply_key):
+        """Додає запис у серію користувача; повертає True, якщо на повідомлення треба відповісти
+
+        reply_key - яка відповідь належить повідомленню (наприклад, статус):
+        серія продовжується тільки повідомленнями з тією самою відповіддю.
+        """
+        now = time.monotonic()
+        burst = self._bursts.get(user_id)
+        if burst is not None and burst.reply_key != reply_key:
+            self._flush(user_id)
+            burst = None
+        if burst is None:
+            if len(self._bursts) >= self.max_users:
+                self._flush(next(iter(self._bursts)))
+            burst = self._bursts[user_id] = Burst(reply_key, now)
+            burst.handle = asyncio.get_running_loop().call_later(self.window, self._expire, user_id)
+            reply = True
+        else:
+            self._bursts.move_to_end(user_id)
+            REPLIES_COALESCED.inc()
+            reply = False
+        burst.records.append(record)
+        burst.last_seen = now
+        return reply
+
+    def _expire(self, user_id):
+        burst = self._bursts.get(user_id)
+        if burst is None:
+            return
+        # Таймер не переставляється на кожне повідомлення: при спрацюванні перевіряємо, чи серія справді скінчилась
+        delay = burst.deadline(self.window, self.max_delay) - time.monotonic()
+        if delay > 0:
+            burst.handle = asyncio.get_running_loop().call_later(delay, self._expire, user_id)
+            return
+        self._flush(user_id)
+
+    def _flush(self, user_id):
+        burst = self._bursts.pop(user_id)
+        if burst.handle is not None:
+            burst.handle.cancel()
+        try:
+            self.flush(burst.records)
+        except Exception as e:
+            logger.error(f"Помилка збереження серії повідомлень користувача {user_id}: {e}")
+
+    def flush_all(self):
+        """Передає в flush усі незакінчені серії (перед зупинкою)"""
+        for user_id in list(self._bursts):
+            self._flush(user_id)
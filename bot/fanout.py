@@ -0,0 +1,158 @@
+"""
+Паралельне розсилання викликів Bot API по групах.
+
+Оновлення дозволів сотень груп по одній займає хвилини. Тут виклики йдуть
+паралельно з обмеженням кількості одночасних задач і загальної швидкості,
+з повторами після RetryAfter та тимчасових мережевих помилок.
+"""
+
+import asyncio
+import logging
+import random
+import time
+
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+# Кількість повторів виклику після тимчасової помилки
+DEFAULT_MAX_RETRIES = 3
+
+# Базова затримка для експоненційного повтору (секунди)
+DEFAULT_BASE_DELAY = 0.5
+
+
+class TokenBucket:
+    """Обмежувач швидкості: не більше rate викликів на секунду"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Чекає, поки з'явиться дозвіл на виклик"""
+        async with self._lock:
+            while True:
+                delay = self.delay()
+                if delay <= 0:
+                    self.take()
+                    return
+                await asyncio.sleep(delay)
+
+    def delay(self):
+        """Скільки секунд чекати до наступного дозволу (0 - дозвіл є); нічого не забирає"""
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        if self._tokens >= 1:
+            return 0.0
+        return (1 - self._tokens) / self.rate
+
+    def take(self):
+        """Забирає дозвіл, наявність якого щойно перевірено delay()"""
+        self._tokens -= 1
+
+    @property
+    def full(self):
+        """Чи відновився обмежувач повністю (його стан можна забути)"""
+        return self.delay() <= 0 and self._tokens >= self.capacity
+
+    def pause(self, seconds):
+        """Зупиняє всі виклики на seconds (після RetryAfter від Telegram)"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+# Функція для виклику Bot API з повторами
+async def call_with_retry(make_call, limiter=None, max_retries=DEFAULT_MAX_RETRIES,
+                          base_delay=DEFAULT_BASE_DELAY):
+    """Виконує make_call() з урахуванням ліміту швидкості та повторює тимчасові помилки
+
+    RetryAfter зупиняє обмежувач на вказаний Telegram час; мережеві помилки
+    повторюються з експоненційною затримкою і випадковим розкидом. Інші
+    винятки (Forbidden, BadRequest тощо) передаються далі одразу.
+    """
+    attempt = 0
+    while True:
+        if limiter is not None:
+            await limiter.acquire()
+        try:
+            return await make_call()
+        except RetryAfter as e:
+            if attempt >= max_retries:
+                raise
+            logger.warning(f"Telegram просить зачекати {e.retry_after} с перед наступним викликом")
+            if limiter is not None:
+                limiter.pause(e.retry_after)
+            else:
+                await asyncio.sleep(e.retry_after)
+        except (TimedOut, NetworkError) as e:
+            if attempt >= max_retries:
+                raise
+            delay = base_delay * (2 ** attempt) * random.uniform(0.5, 1.5)
+            logger.warning(f"Тимчасова помилка Bot API ({e}), повтор через {delay:.2f} с")
+            await asyncio.sleep(delay)
+        attempt += 1
+
+
+# Функція для обчислення перцентиля
+def percentile(values, pct):
+    """Перцентиль методом найближчого рангу; 0.0 для порожнього списку"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(pct / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+
+class SweepReport:
+    """Метрики одного проходу по групах"""
+
+    def __init__(self):
+        self.duration = 0.0
+        self.latencies = []
+        self.failures = []
+
+    @property
+    def total(self):
+        return len(self.latencies)
+
+    def summary(self):
+        return (
+            f"груп: {self.total}, помилок: {len(self.failures)}, "
+            f"тривалість: {self.duration:.2f} с, "
+            f"p50: {percentile(self.latencies, 50) * 1000:.0f} мс, "
+            f"p99: {percentile(self.latencies, 99) * 1000:.0f} мс"
+        )
+
+
+# Функція для паралельного виконання задачі для кожного чату
+async def fan_out(chat_ids, worker, concurrency):
+    """Викликає worker(chat_id) для всіх чатів, не більше concurrency одночасно
+
+    worker повертає False або кидає виняток у разі невдачі. Повертає SweepReport.
+    """
+    report = SweepReport()
+    semaphore = asyncio.Semaphore(concurrency)
+    started = time.monotonic()
+
+    async def run_one(chat_id):
+        async with semaphore:
+            call_started = time.monotonic()
+            try:
+                ok = await worker(chat_id)
+            except Exception as e:
+                logger.error(f"Помилка обробки чату {chat_id}: {e}")
+                ok = False
+            report.latencies.append(time.monotonic() - call_started)
+            if ok is False:
+                report.failures.append(chat_id)
+
+    await asyncio.gather(*(run_one(chat_id) for chat_id in chat_ids))
+    report.duration = time.monotonic() - started
+    return report
@@ -0,0 +1,112 @@
+"""
+Реєстр груп, якими керує бот.
+
+Список груп зберігається в окремому JSON-файлі і тримається в пам'яті, тому
+планувальнику не треба перечитувати історію повідомлень, а групи, де давно
+ніхто не писав, не випадають з-під контролю.
+"""
+
+import json
+import logging
+from pathlib import Path
+
+from bot.storage import write_json_atomic
+
+logger = logging.getLogger(__name__)
+
+
+class GroupRegistry:
+    """Відомі групи та групи, де бот втратив права адміністратора"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        # chat_id -> назва групи
+        self._groups = {}
+        # Групи, прибрані через втрату прав; повідомлення з них не повертають їх у реєстр
+        self._pruned = set()
+        self.load()
+
+    def __contains__(self, chat_id):
+        return chat_id in self._groups
+
+    def __iter__(self):
+        return iter(list(self._groups))
+
+    def __len__(self):
+        return len(self._groups)
+
+    def chat_ids(self):
+        return set(self._groups)
+
+    def load(self):
+        if not self.path.exists():
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.error(f"Не вдалося прочитати реєстр груп {self.path}: {e}")
+            return
+        self._groups = {int(chat_id): title for chat_id, title in data.get('groups', {}).items()}
+        self._pruned = set(data.get('pruned', []))
+
+    def chat_snapshot(self):
+        """Знімок по чатах для спільного стану: chat_id -> {'title', 'pruned'}"""
+        data = {str(chat_id): {'title': title, 'pruned': False} for chat_id, title in self._groups.items()}
+        for chat_id in self._pruned:
+            data[str(chat_id)] = {'title': None, 'pruned': True}
+        return data
+
+    def restore_chats(self, data):
+        """Замінює стан знімком по чатах (див. chat_snapshot)"""
+        self._groups = {int(chat_id): entry['title'] for chat_id, entry in data.items() if not entry['pruned']}
+        self._pruned = {int(chat_id) for chat_id, entry in data.items() if entry['pruned']}
+
+    def exists(self):
+        return self.path.exists()
+
+    def snapshot(self):
+        """Знімок стану для запису (береться в циклі подій, пишеться в потоці)"""
+        return {
+            'groups': {str(chat_id): title for chat_id, title in self._groups.items()},
+            'pruned': sorted(self._pruned),
+        }
+
+    def write(self, data):
+        """Атомарно записує знімок реєстру на диск"""
+        write_json_atomic(self.path, data)
+
+    def save(self):
+        self.write(self.snapshot())
+
+    def seen(self, chat_id, title=None):
+        """Реєструє групу, з якої прийшло повідомлення; повертає True, якщо реєстр змінився"""
+        if chat_id in self._pruned:
+            return False
+        if chat_id in self._groups and (title is None or self._groups[chat_id] == title):
+            return False
+        self._groups[chat_id] = title
+        return True
+
+    def add(self, chat_id, title=None):
+        """Додає групу (бота додали або призначили адміністратором)"""
+        changed = chat_id not in self._groups or chat_id in self._pruned
+        self._pruned.discard(chat_id)
+        if title is not None and self._groups.get(chat_id) != title:
+            changed = True
+        self._groups[chat_id] = title if title is not None else self._groups.get(chat_id)
+        return changed
+
+    def remove(self, chat_id):
+        """Прибирає групу (бота видалили з групи)"""
+        changed = chat_id in self._groups or chat_id in self._pruned
+        self._groups.pop(chat_id, None)
+        self._pruned.discard(chat_id)
+        return changed
+
+    def prune(self, chat_id):
+        """Прибирає групу, де бот більше не адміністратор"""
+        changed = chat_id in self._groups or chat_id not in self._pruned
+        self._groups.pop(chat_id, None)
+        self._pruned.add(chat_id)
+        return changed
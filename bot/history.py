@@ -0,0 +1,271 @@
+"""
+Посторінковий перегляд історії повідомлень для адміністраторів.
+
+Сторінка - це кілька записів, вибраних сховищем за фільтрами (чат, статус,
+користувач) відносно курсора. Курсор - непрозорий рядок у callback_data
+кнопок "старіші"/"новіші": напрямок, ID крайнього запису сторінки і
+фільтри. Текст сторінки форматується в MarkdownV2 з екрануванням усіх
+даних користувачів і ніколи не розрізає запис: якщо записи не вміщаються
+в одне повідомлення, зайві переходять на наступну сторінку.
+"""
+
+import base64
+from collections import namedtuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import MessageLimit
+from telegram.helpers import escape_markdown
+
+from bot.migrations import MESSAGE_STATUSES, normalize_status
+
+CALLBACK_PREFIX = 'hist:'
+
+# Скільки записів на сторінці
+PAGE_SIZE = 10
+
+# Скільки символів тексту повідомлення показувати в записі
+TEXT_PREVIEW_LENGTH = 100
+
+# Напрямки курсора
+OLDER = 'o'
+NEWER = 'n'
+
+STATUS_EMOJI = {
+    'replied': '✅',
+    'manually_replied': '💬',
+    'rejected_time': '⏰',
+    'blocked_time': '🚫',
+    'received': '📨',
+}
+
+
+class FilterError(ValueError):
+    """Неправильний фільтр у команді /history"""
+
+
+class HistoryFilters(namedtuple('HistoryFilters', 'chat_id status user_id', defaults=(None, None, None))):
+    """Фільтри сторінки історії; None - без фільтра"""
+
+    def as_query(self):
+        return {'chat_id': self.chat_id, 'status': self.status, 'user_id': self.user_id}
+
+    def describe(self):
+        parts = []
+        if self.chat_id is not None:
+            parts.append(f"чат {self.chat_id}")
+        if self.status is not None:
+            parts.append(f"статус {self.status}")
+        if self.user_id is not None:
+            parts.append(f"користувач {self.user_id}")
+        return ', '.join(parts)
+
+
+class HistoryCursor(namedtuple('HistoryCursor', 'direction message_id filters')):
+    """Позиція в історії: записи в напрямку direction від message_id"""
+
+
+# Функція для розбору фільтрів команди /history
+def parse_filters(args, current_chat_id):
+    """Розбирає аргументи: here, chat=<id|here>, status=<статус>, user=<id>"""
+    filters = HistoryFilters()
+    for arg in args:
+        key, _, value = arg.partition('=')
+        key = key.lower()
+        if key == 'here' and not value:
+            filters = filters._replace(chat_id=current_chat_id)
+        elif key == 'chat' and value:
+            if value.lower() == 'here':
+                filters = filters._replace(chat_id=current_chat_id)
+            else:
+                filters = filters._replace(chat_id=_parse_int(value, "ID чату"))
+        elif key == 'status' and value:
+            status = normalize_status(value)
+            if status not in MESSAGE_STATUSES:
+                raise FilterError(f"Невідомий статус: {value}. Доступні: {', '.join(MESSAGE_STATUSES)}")
+            filters = filters._replace(status=status)
+        elif key == 'user' and value:
+            filters = filters._replace(user_id=_parse_int(value, "ID користувача"))
+        else:
+            raise FilterError(f"Невідомий фільтр: {arg}")
+    return filters
+
+
+# Скільки ID і діапазонів можна вказати в одній команді /replied
+MAX_ID_RANGES = 50
+
+
+# Функція для розбору аргументів /replied
+def parse_selection(args, current_chat_id):
+    """Розбирає ID, списки і діапазони (12 15,16 20-40) разом з фільтрами /history
+
+    Повертає (діапазони [(від, до), ...], HistoryFilters).
+    """
+    ranges = []
+    filter_args = []
+    for arg in args:
+        if '=' in arg or arg.lower() == 'here':
+            filter_args.append(arg)
+            continue
+        for part in arg.split(','):
+            if part:
+                ranges.append(_parse_id_range(part))
+    if len(ranges) > MAX_ID_RANGES:
+        raise FilterError(f"Забагато ID і діапазонів (максимум {MAX_ID_RANGES})")
+    return merge_ranges(ranges), parse_filters(filter_args, current_chat_id)
+
+
+def _parse_id_range(text):
+    low, dash, high = text.partition('-')
+    low = _parse_int(low, "ID повідомлення")
+    high = _parse_int(high, "ID повідомлення") if dash else low
+    if low <= 0 or high < low:
+        raise FilterError(f"Неправильний діапазон ID: {text}")
+    return low, high
+
+
+def merge_ranges(ranges):
+    """Об'єднує діапазони, що перетинаються або йдуть підряд"""
+    merged = []
+    for low, high in sorted(ranges):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def format_ranges(ids, limit=20):
+    """'12-20, 25, 30-40' для відсортованих ID; після limit діапазонів - скорочення"""
+    ranges = merge_ranges((message_id, message_id) for message_id in ids)
+    parts = [f"{low}-{high}" if high > low else str(low) for low, high in ranges[:limit]]
+    if len(ranges) > limit:
+        parts.append("…")
+    return ', '.join(parts)
+
+
+def _parse_int(value, what):
+    try:
+        return int(value)
+    except ValueError:
+        raise FilterError(f"{what} має бути числом: {value}")
+
+
+# Курсор у callback_data (до 64 байт)
+
+def encode_cursor(cursor):
+    filters = cursor.filters
+    status = MESSAGE_STATUSES.index(filters.status) if filters.status is not None else ''
+    packed = '|'.join(
+        str(value) for value in (
+            f"{cursor.direction}{cursor.message_id}",
+            '' if filters.chat_id is None else filters.chat_id,
+            status,
+            '' if filters.user_id is None else filters.user_id,
+        )
+    )
+    return CALLBACK_PREFIX + base64.urlsafe_b64encode(packed.encode('ascii')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(data):
+    """Відновлює курсор з callback_data; ValueError, якщо дані пошкоджені"""
+    if not data or not data.startswith(CALLBACK_PREFIX):
+        raise ValueError("Це не курсор історії")
+    token = data[len(CALLBACK_PREFIX):]
+    try:
+        packed = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('ascii')
+        position, chat_id, status, user_id = packed.split('|')
+        direction, message_id = position[0], int(position[1:])
+        filters = HistoryFilters(
+            chat_id=int(chat_id) if chat_id else None,
+            status=MESSAGE_STATUSES[int(status)] if status else None,
+            user_id=int(user_id) if user_id else None,
+        )
+    except (ValueError, IndexError, UnicodeDecodeError) as e:
+        raise ValueError(f"Пошкоджений курсор історії: {e}")
+    if direction not in (OLDER, NEWER):
+        raise ValueError(f"Невідомий напрямок курсора: {direction}")
+    return HistoryCursor(direction, message_id, filters)
+
+
+# Функція для вибірки сторінки зі сховища
+def fetch_page(store, filters, cursor=None, page_size=PAGE_SIZE):
+    """Повертає (записи в порядку вибірки, чи є ще записи в напрямку вибірки)
+
+    Вибирається на один запис більше, ніж треба, щоб знати, чи показувати кнопку далі.
+    """
+    if cursor is not None and cursor.direction == NEWER:
+        records = store.query(page_size + 1, after_id=cursor.message_id, **filters.as_query())
+    else:
+        before_id = cursor.message_id if cursor is not None else None
+        records = store.query(page_size + 1, before_id=before_id, **filters.as_query())
+    return records[:page_size], len(records) > page_size
+
+
+def _escape(text):
+    return escape_markdown(str(text), version=2)
+
+
+def format_record(msg):
+    """Блок MarkdownV2 для одного запису"""
+    status = msg.get('status')
+    text = msg.get('message_text') or ''
+    preview = text[:TEXT_PREVIEW_LENGTH] + ('…' if len(text) > TEXT_PREVIEW_LENGTH else '')
+    # created_at є в усіх записах після міграції; час доби - для записів, де дату не відновлено
+    when = msg['created_at'][:16].replace('T', ' ') if msg.get('created_at') else msg.get('timestamp')
+    reply_info = ''
+    if status == 'manually_replied' and msg.get('replied_by'):
+        reply_info = f" \\(відповів адмін, {_escape(msg['reply_timestamp'])}\\)"
+    return (
+        f"{STATUS_EMOJI.get(status, '❓')} *{_escape(msg.get('user_name') or '—')}* "
+        f"\\({_escape(when)}\\) \\[ID: {msg['id']}\\]\n"
+        f"   💬 {_escape(preview)}\n"
+        f"   📍 {_escape(msg.get('chat_type'))} {_escape(msg.get('chat_id'))} \\| "
+        f"Статус: {_escape(status)}{reply_info}\n"
+    )
+
+
+# Функція для формування сторінки історії
+def render_page(records, has_more, filters, cursor=None):
+    """Повертає (текст MarkdownV2, клавіатура або None) для записів з fetch_page
+
+    Записи, що не вмістились в одне повідомлення, відкидаються з дальнього
+    від курсора краю - вони потраплять на наступну сторінку.
+    """
+    newer_direction = cursor is not None and cursor.direction == NEWER
+    title = "📋 *Історія повідомлень*"
+    if filters.describe():
+        title += f"\n🔎 {_escape(filters.describe())}"
+    header = title + "\n\n"
+
+    blocks = []
+    length = len(header)
+    for msg in records:
+        block = format_record(msg)
+        if blocks and length + len(block) + 1 > MessageLimit.MAX_TEXT_LENGTH:
+            has_more = True
+            break
+        blocks.append((msg['id'], block))
+        length += len(block) + 1
+    if not blocks:
+        return header + "📝 Повідомлень не знайдено\\.", None
+    # Вибірка йде від курсора, а показуємо в хронологічному порядку
+    blocks.sort()
+    text = header + '\n'.join(block for _, block in blocks)
+
+    if cursor is None:
+        has_older, has_newer = has_more, False
+    elif newer_direction:
+        has_older, has_newer = True, has_more
+    else:
+        has_older, has_newer = has_more, True
+
+    buttons = []
+    if has_older:
+        buttons.append(InlineKeyboardButton(
+            "⬅️ Старіші", callback_data=encode_cursor(HistoryCursor(OLDER, blocks[0][0], filters))
+        ))
+    if has_newer:
+        buttons.append(InlineKeyboardButton(
+            "Новіші ➡️", callback_data=encode_cursor(HistoryCursor(NEWER, blocks[-1][0], filters))
+        ))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
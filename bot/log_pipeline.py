@@ -0,0 +1,162 @@
+"""
+Неблокувальне логування.
+
+Обробники лише кладуть записи в чергу (QueueHandler), а форматування і
+запис у stderr виконує фоновий потік (QueueListener), тож повільний вивід
+не затримує цикл подій. Записи форматуються в JSON зі структурованими
+полями (chat_id, user_id, status, latency_ms); повідомлення формуються
+ліниво - вже в потоці слухача. Текст повідомлень користувачів за
+замовчуванням не потрапляє в лог, а записи з дуже активних груп
+проріджуються.
+"""
+
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+
+# Структуровані поля, що передаються через extra=
+STRUCTURED_FIELDS = ('chat_id', 'user_id', 'chat_type', 'status', 'latency_ms', 'message_id', 'text')
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Скільки записів може чекати в черзі; надлишок відкидається, а не блокує
+DEFAULT_QUEUE_SIZE = 10000
+
+# Проріджування: скільки записів на чат пропускати повністю за вікно і яку частку після цього
+DEFAULT_SAMPLE_BURST = 20
+DEFAULT_SAMPLE_EVERY = 10
+SAMPLE_WINDOW = 60.0
+
+# Максимальна кількість чатів у лічильниках проріджування
+MAX_SAMPLED_CHATS = 10000
+
+
+class JsonFormatter(logging.Formatter):
+    """Один JSON-об'єкт на рядок"""
+
+    def format(self, record):
+        data = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for field in STRUCTURED_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                data[field] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Звичайний текстовий формат зі структурованими полями в кінці рядка"""
+
+    def __init__(self):
+        super().__init__(TEXT_FORMAT)
+
+    def format(self, record):
+        line = super().format(record)
+        fields = [
+            f"{field}={getattr(record, field)}"
+            for field in STRUCTURED_FIELDS if getattr(record, field, None) is not None
+        ]
+        return f"{line} [{' '.join(fields)}]" if fields else line
+
+
+class RedactTextFilter(logging.Filter):
+    """Замінює текст повідомлення користувача його довжиною"""
+
+    def filter(self, record):
+        text = getattr(record, 'text', None)
+        if text is not None:
+            record.text = f"<{len(text)} символів>"
+        return True
+
+
+class ChatSamplingFilter(logging.Filter):
+    """Проріджує записи рівня нижче WARNING з однієї групи
+
+    За вікно SAMPLE_WINDOW з кожного чату проходять перші burst записів, а
+    далі - кожен every-й. Попередження і помилки проходять завжди.
+    """
+
+    def __init__(self, burst=DEFAULT_SAMPLE_BURST, every=DEFAULT_SAMPLE_EVERY):
+        super().__init__()
+        self.burst = burst
+        self.every = every
+        self.dropped = 0
+        # chat_id -> [початок вікна, кількість записів у вікні]
+        self._windows = {}
+
+    def filter(self, record):
+        chat_id = getattr(record, 'chat_id', None)
+        if chat_id is None or record.levelno >= logging.WARNING:
+            return True
+
+        now = time.monotonic()
+        window = self._windows.get(chat_id)
+        if window is None or now - window[0] >= SAMPLE_WINDOW:
+            if window is None and len(self._windows) >= MAX_SAMPLED_CHATS:
+                self._windows.clear()
+            window = self._windows[chat_id] = [now, 0]
+        window[1] += 1
+
+        count = window[1]
+        if count <= self.burst or (count - self.burst) % self.every == 0:
+            return True
+        self.dropped += 1
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, що не форматує запис у потоці виклику і не чекає на чергу"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Форматування (getMessage, traceback) виконає слухач
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# Функція для налаштування логування
+def setup_logging(level=logging.INFO, json_format=True, redact_text=True,
+                  sample_burst=DEFAULT_SAMPLE_BURST, sample_every=DEFAULT_SAMPLE_EVERY,
+                  queue_size=DEFAULT_QUEUE_SIZE):
+    """Замінює обробники кореневого логера чергою з фоновим слухачем
+
+    Повертає запущений QueueListener; його треба зупинити при завершенні,
+    щоб дописати записи, що лишились у черзі.
+    """
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter() if json_format else TextFormatter())
+
+    log_queue = queue.Queue(queue_size)
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    if redact_text:
+        queue_handler.addFilter(RedactTextFilter())
+    if sample_burst:
+        queue_handler.addFilter(ChatSamplingFilter(sample_burst, sample_every))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    listener.start()
+    return listener
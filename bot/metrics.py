@@ -0,0 +1,351 @@
+"""
+Метрики роботи бота.
+
+Гістограми тривалості обробників, викликів Bot API, операцій сховища і
+проходів по групах, лічильники помилок і поточні розміри черг. Метрики
+віддаються у форматі Prometheus локальним HTTP-сервером і коротким
+зведенням через адмінську команду /metrics.
+
+Запис метрики - кілька операцій зі словником у циклі подій, без блокувань
+і без залежностей від сторонніх бібліотек.
+"""
+
+import asyncio
+import functools
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from http import HTTPStatus
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Межі кошиків гістограм (секунди)
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = [*key, *extra]
+    if not pairs:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Histogram:
+    """Гістограма з фіксованими кошиками для кожного набору міток"""
+
+    def __init__(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = tuple(buckets)
+        # мітки -> [лічильники кошиків..., кількість, сума]
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        series = self._series.get(key)
+        if series is None:
+            series = self._series[key] = [0] * (len(self.buckets) + 2)
+        index = bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += 1
+        series[-1] += value
+
+    def series(self):
+        """Повертає {мітки: (кількість, сума, p50, p99)} для зведення"""
+        return {
+            key: (series[-2], series[-1], self._quantile(series, 0.5), self._quantile(series, 0.99))
+            for key, series in self._series.items()
+        }
+
+    def _quantile(self, series, q):
+        """Верхня межа кошика, в який потрапляє квантиль (наближено)"""
+        count = series[-2]
+        if not count:
+            return 0.0
+        rank = q * count
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets, series):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for key, series in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, series):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, [('le', '+Inf')])} {series[-2]}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series[-2]}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series[-1]}")
+        return lines
+
+
+class Counter:
+    """Лічильник, що тільки зростає"""
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def values(self):
+        return dict(self._values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self._values.items()):
+            lines.append(f"{self.name}{_format_labels(key)} {value}")
+        return lines
+
+
+class Gauge:
+    """Поточне значення, яке обчислюється функцією під час читання"""
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def value(self):
+        try:
+            return self.read()
+        except Exception:
+            return float('nan')
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge", f"{self.name} {self.value()}"]
+
+
+class MetricsRegistry:
+    """Усі метрики процесу"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def _register(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def histogram(self, name, help_text, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help_text, buckets))
+
+    def counter(self, name, help_text):
+        return self._register(Counter(name, help_text))
+
+    def gauge(self, name, help_text, read):
+        # Функцію читання можна замінити (наприклад, після перезапуску компонента)
+        gauge = self._register(Gauge(name, help_text, read))
+        gauge.read = read
+        return gauge
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def metrics(self):
+        return list(self._metrics.values())
+
+    def render(self):
+        """Текст у форматі Prometheus"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+# Реєстр за замовчуванням, яким користуються всі модулі бота
+REGISTRY = MetricsRegistry()
+
+HANDLER_SECONDS = REGISTRY.histogram('bot_handler_seconds', "Тривалість обробки оновлення")
+HANDLER_ERRORS = REGISTRY.counter('bot_handler_errors_total', "Винятки в обробниках")
+API_SECONDS = REGISTRY.histogram('bot_api_request_seconds', "Тривалість викликів Bot API")
+API_ERRORS = REGISTRY.counter('bot_api_errors_total', "Невдалі виклики Bot API (мережа або HTTP-помилка)")
+STORE_SECONDS = REGISTRY.histogram('bot_store_seconds', "Тривалість операцій сховища історії")
+STORE_ERRORS = REGISTRY.counter('bot_store_errors_total', "Помилки операцій сховища історії")
+SWEEP_SECONDS = REGISTRY.histogram(
+    'bot_sweep_seconds', "Тривалість проходу оновлення дозволів груп",
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+)
+SWEEP_FAILURES = REGISTRY.counter('bot_sweep_failures_total', "Групи, які не вдалося оновити під час проходу")
+OPERATION_SECONDS = REGISTRY.histogram('bot_operation_seconds', "Тривалість внутрішніх операцій бота")
+OPERATION_ERRORS = REGISTRY.counter('bot_operation_errors_total', "Невдалі внутрішні операції бота")
+OUTBOX_WAIT_SECONDS = REGISTRY.histogram(
+    'bot_outbox_wait_seconds', "Час від постановки повідомлення в чергу відправлення до надсилання",
+    buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0)
+)
+OUTBOX_RETRIES = REGISTRY.counter('bot_outbox_retries_total', "Повідомлення, повернуті в чергу після RetryAfter або помилки мережі")
+OUTBOX_FAILURES = REGISTRY.counter('bot_outbox_failures_total', "Повідомлення, які не вдалося надіслати")
+REPLIES_COALESCED = REGISTRY.counter(
+    'bot_replies_coalesced_total', "Повідомлення в особистих чатах без окремої автовідповіді (продовження серії)"
+)
+
+
+@contextmanager
+def timer(histogram, **labels):
+    """Записує тривалість блоку with у гістограму"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+
+# Декоратор для вимірювання async-функцій
+def timed(histogram, errors=None, **labels):
+    """Тривалість виклику - в histogram; виняток або результат False - в errors"""
+
+    def decorator(callback):
+        @functools.wraps(callback)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(**labels)
+                raise
+            finally:
+                histogram.observe(time.perf_counter() - started, **labels)
+            if result is False and errors is not None:
+                errors.inc(**labels)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def timed_handler(name, callback):
+    """Обгортає обробник оновлень: bot_handler_seconds і bot_handler_errors_total"""
+    return timed(HANDLER_SECONDS, HANDLER_ERRORS, handler=name)(callback)
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTP-клієнт Bot API, що вимірює тривалість кожного методу"""
+
+    async def do_request(self, url, method, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+        except Exception:
+            API_ERRORS.inc(method=api_method, reason='network')
+            raise
+        finally:
+            API_SECONDS.observe(time.perf_counter() - started, method=api_method)
+        if code >= 400:
+            API_ERRORS.inc(method=api_method, reason=str(code))
+        return code, payload
+
+
+class MetricsServer:
+    """Локальний HTTP-сервер, що віддає GET /metrics"""
+
+    def __init__(self, registry=REGISTRY, listen='127.0.0.1', port=9464):
+        self.registry = registry
+        self.listen = listen
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Метрики доступні на http://{self.listen}:{self.port}/metrics")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            # Заголовки не потрібні, але їх треба дочитати
+            while (await asyncio.wait_for(reader.readline(), 10)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            if len(parts) < 2 or parts[0] != 'GET':
+                status, body = HTTPStatus.METHOD_NOT_ALLOWED, b''
+            elif parts[1].split('?', 1)[0] != '/metrics':
+                status, body = HTTPStatus.NOT_FOUND, b''
+            else:
+                status, body = HTTPStatus.OK, self.registry.render().encode('utf-8')
+            writer.write(
+                f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+                f"Content-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: close\r\n\r\n".encode('latin-1') + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+
+# Функція для короткого текстового зведення метрик
+def summary(registry=REGISTRY, limit=10):
+    """Рядки зведення для /metrics: найповільніші обробники і методи API, помилки, черги"""
+    lines = []
+    for title, name, label in (
+        ("Обробники", 'bot_handler_seconds', 'handler'),
+        ("Bot API", 'bot_api_request_seconds', 'method'),
+        ("Операції", 'bot_operation_seconds', 'operation'),
+        ("Сховище", 'bot_store_seconds', 'operation'),
+        ("Очікування в черзі відправлення", 'bot_outbox_wait_seconds', 'lane'),
+        ("Проходи по групах", 'bot_sweep_seconds', None),
+    ):
+        histogram = registry.get(name)
+        if histogram is None:
+            continue
+        series = sorted(histogram.series().items(), key=lambda item: item[1][3], reverse=True)[:limit]
+        if not series:
+            continue
+        lines.append(f"{title}:")
+        for key, (count, total, p50, p99) in series:
+            labels = dict(key)
+            what = labels.get(label, '-') if label else 'усього'
+            lines.append(f"  {what}: {count} викл., p50 ≤ {p50 * 1000:.0f} мс, p99 ≤ {p99 * 1000:.0f} мс")
+
+    errors = []
+    for name in ('bot_handler_errors_total', 'bot_api_errors_total', 'bot_operation_errors_total',
+                 'bot_store_errors_total', 'bot_sweep_failures_total', 'bot_outbox_failures_total'):
+        counter = registry.get(name)
+        if counter is None:
+            continue
+        total = sum(counter.values().values())
+        if total:
+            errors.append(f"  {name}: {total}")
+    if errors:
+        lines.append("Помилки:")
+        lines.extend(errors)
+
+    gauges = [metric for metric in registry.metrics() if isinstance(metric, Gauge)]
+    if gauges:
+        lines.append("Черги:")
+        lines.extend(f"  {gauge.name}: {gauge.value()}" for gauge in gauges)
+    return lines
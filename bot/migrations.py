@@ -0,0 +1,133 @@
+"""
+Версії схеми історії повідомлень і міграції між ними.
+
+Сховище запам'ятовує версію схеми (SQLite - PRAGMA user_version, журнал
+JSON Lines - рядок-заголовок на початку файлу) і при старті один раз
+доводить старі записи до поточної версії. Після цього читання нічого не
+виправляє і не переписує.
+
+Версії:
+
+1. у кожного запису є унікальний ID, що зростає разом з позицією запису,
+   і поля replied_by, reply_timestamp;
+2. created_at - повний момент отримання з часовою зоною; для старих
+   записів він відновлюється з часу доби timestamp (HH:MM);
+3. статуси належать до MESSAGE_STATUSES.
+"""
+
+import logging
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+SCHEMA_VERSION = 3
+
+MESSAGE_STATUSES = ('received', 'replied', 'rejected_time', 'blocked_time', 'manually_replied')
+
+# Варіанти написання статусів, що трапляються в старих записах
+STATUS_ALIASES = {
+    'rejected': 'rejected_time',
+    'blocked': 'blocked_time',
+    'manual_replied': 'manually_replied',
+    'manually-replied': 'manually_replied',
+}
+
+
+def normalize_status(status):
+    """Приводить статус до одного з MESSAGE_STATUSES; невідомий залишається як є"""
+    if status is None:
+        return 'received'
+    normalized = str(status).strip().lower()
+    normalized = STATUS_ALIASES.get(normalized, normalized)
+    return normalized if normalized in MESSAGE_STATUSES else status
+
+
+def assign_ids(records, last_id=0):
+    """Дає записам (у хронологічному порядку) унікальні зростаючі ID
+
+    Запис зберігає свій ID, якщо той більший за ID попереднього; інакше
+    (ID немає або він повторюється - старий бот видавав len(messages) + 1)
+    отримує наступний. Повертає кількість змінених записів.
+    """
+    changed = 0
+    previous = last_id
+    for record in records:
+        message_id = record.get('id')
+        if not isinstance(message_id, int) or message_id <= previous:
+            record['id'] = previous + 1
+            changed += 1
+        previous = record['id']
+        record.setdefault('replied_by', None)
+        record.setdefault('reply_timestamp', None)
+    return changed
+
+
+def parse_time_of_day(text):
+    """Час доби з рядка 'HH:MM' або None"""
+    try:
+        return datetime.strptime(str(text).strip()[:5], '%H:%M').time()
+    except ValueError:
+        return None
+
+
+class RecordMigrator:
+    """Доводить записи до SCHEMA_VERSION; записи подаються від найновішого до найстарішого
+
+    Для записів без дати день відновлюється відносно новішого сусіда: якщо
+    час доби запису пізніший за час сусіда, запис зроблено напередодні.
+    Найновіший запис без дати відраховується від anchor (зазвичай - часу
+    останньої зміни файлу сховища).
+    """
+
+    def __init__(self, from_version, tz=None, anchor=None):
+        self.from_version = from_version
+        self.tz = tz or timezone.utc
+        self._newer = anchor or datetime.now(self.tz)
+        self.changed = 0
+        self.unknown_statuses = set()
+
+    def migrate(self, record):
+        """Повертає нову версію запису або None, якщо запис уже відповідає схемі"""
+        migrated = dict(record)
+        if self.from_version < 1:
+            migrated.setdefault('replied_by', None)
+            migrated.setdefault('reply_timestamp', None)
+        if self.from_version < 2:
+            self._fill_created_at(migrated)
+        if self.from_version < 3:
+            migrated['status'] = normalize_status(migrated.get('status'))
+            if migrated['status'] not in MESSAGE_STATUSES:
+                self.unknown_statuses.add(migrated['status'])
+        if migrated == record:
+            return None
+        self.changed += 1
+        return migrated
+
+    def _fill_created_at(self, record):
+        if record.get('created_at'):
+            try:
+                self._newer = datetime.fromisoformat(record['created_at'])
+            except ValueError:
+                pass
+            return
+        time_of_day = parse_time_of_day(record.get('timestamp'))
+        if time_of_day is None:
+            return
+        newer = self._newer.astimezone(self.tz)
+        day = newer.date()
+        if time_of_day > newer.time():
+            day -= timedelta(days=1)
+        moment = self._localize(datetime.combine(day, time_of_day))
+        record['created_at'] = moment.isoformat(timespec='seconds')
+        self._newer = moment
+
+    def _localize(self, naive):
+        # Часові зони pytz потребують localize, стандартні - replace
+        if hasattr(self.tz, 'localize'):
+            return self.tz.localize(naive)
+        return naive.replace(tzinfo=self.tz)
+
+    def report(self, where):
+        logger.info(f"Міграцію {where} до версії {SCHEMA_VERSION} завершено: змінено {self.changed} записів")
+        if self.unknown_statuses:
+            logger.warning(f"Невідомі статуси в {where}: {', '.join(map(str, sorted(self.unknown_statuses, key=str)))}")
@@ -0,0 +1,260 @@
+"""
+Черга вихідних повідомлень з пріоритетами.
+
+Всі повідомлення бота проходять через одну asyncio-задачу-диспетчер.
+Повідомлення стоять у смугах за пріоритетом: відповіді користувачам, потім
+розсилки групам про зміну статусу, потім звіти адміністраторам (історія,
+статистика, пошук). Диспетчер завжди бере найпріоритетніше повідомлення,
+чат якого може прийняти його зараз:
+
+- ліміт кожного чату (Telegram: близько одного повідомлення на секунду в
+  особистому чаті і 20 на хвилину в групі) - окремий обмежувач на чат;
+- загальний ліміт викликів Bot API - спільний з іншими викликами бота;
+- у кожен чат одночасно надсилається не більше одного повідомлення, тож
+  порядок повідомлень у чаті зберігається.
+
+RetryAfter і тимчасові мережеві помилки не гублять повідомлення: чат
+призупиняється на вказаний час, а повідомлення повертається на початок
+своєї смуги. RetryAfter, як і в call_with_retry, призупиняє ще й загальний
+обмежувач: Telegram просить зачекати весь бот, а не тільки цей чат.
+"""
+
+import asyncio
+import logging
+import random
+import time
+from collections import OrderedDict, deque
+
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+from bot.fanout import DEFAULT_BASE_DELAY, DEFAULT_MAX_RETRIES, TokenBucket
+from bot.metrics import OUTBOX_FAILURES, OUTBOX_RETRIES, OUTBOX_WAIT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Смуги в порядку пріоритету
+LANE_REPLY = 0
+LANE_BROADCAST = 1
+LANE_REPORT = 2
+LANE_NAMES = ('reply', 'broadcast', 'report')
+
+# Ліміти Telegram для одного чату
+DEFAULT_PRIVATE_RATE = 1.0
+DEFAULT_GROUP_RATE = 20 / 60
+# Скільки повідомлень чат може прийняти підряд після паузи
+DEFAULT_CHAT_BURST = 3
+
+# Скільки повідомлень надсилається одночасно (у різні чати)
+DEFAULT_CONCURRENCY = 16
+
+# Скільки обмежувачів чатів тримати в пам'яті
+MAX_CHAT_BUCKETS = 10000
+
+# Скільки секунд дописувати чергу при зупинці
+DEFAULT_DRAIN_TIMEOUT = 10.0
+
+
+class OutboundMessage:
+    """Повідомлення в черзі: виклик Bot API для чату і future з його результатом"""
+
+    __slots__ = ('lane', 'chat_id', 'make_call', 'future', 'enqueued', 'attempts')
+
+    def __init__(self, lane, chat_id, make_call, future):
+        self.lane = lane
+        self.chat_id = chat_id
+        self.make_call = make_call
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+class Outbox:
+    """Asyncio-актор, що надсилає повідомлення за пріоритетами і лімітами чатів"""
+
+    def __init__(self, limiter=None, private_rate=DEFAULT_PRIVATE_RATE, group_rate=DEFAULT_GROUP_RATE,
+                 chat_burst=DEFAULT_CHAT_BURST, concurrency=DEFAULT_CONCURRENCY,
+                 max_retries=DEFAULT_MAX_RETRIES):
+        # Загальний обмежувач Bot API; None - без загального ліміту
+        self.limiter = limiter
+        # Ліміти чатів (повідомлень на секунду); 0 - без ліміту
+        self.private_rate = private_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._lanes = tuple(deque() for _ in LANE_NAMES)
+        self._buckets = OrderedDict()
+        # chat_id -> момент, до якого чат призупинено після RetryAfter або помилки мережі
+        self._paused = {}
+        self._in_flight = set()
+        self._sending = set()
+        self._wakeup = None
+        self._slots = None
+        self._task = None
+        self._stopping = False
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def queue_size(self, lane=None):
+        if lane is not None:
+            return len(self._lanes[lane])
+        return sum(len(queue) for queue in self._lanes)
+
+    async def start(self):
+        """Запускає диспетчер у поточному циклі подій"""
+        if self.running:
+            return
+        self._wakeup = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._stopping = False
+        self._task = asyncio.create_task(self._run(), name='outbox')
+
+    async def stop(self, timeout=DEFAULT_DRAIN_TIMEOUT):
+        """Дописує чергу (не довше timeout секунд) і зупиняє диспетчер"""
+        if not self.running:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            dropped = self.queue_size()
+            for queue in self._lanes:
+                for message in queue:
+                    if not message.future.done():
+                        message.future.set_exception(RuntimeError("Черга відправлення зупинена"))
+                queue.clear()
+            logger.warning(f"Черга відправлення зупинена, не надіслано повідомлень: {dropped}")
+        self._task = None
+
+    def submit(self, lane, chat_id, make_call):
+        """Ставить make_call() у смугу lane; повертає future з результатом виклику"""
+        if not self.running or self._stopping:
+            raise RuntimeError("Черга відправлення не запущена")
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[lane].append(OutboundMessage(lane, chat_id, make_call, future))
+        self._wakeup.set()
+        return future
+
+    def _bucket(self, chat_id):
+        """Обмежувач чату або None, якщо для чатів такого типу ліміту немає"""
+        rate = self.group_rate if chat_id < 0 else self.private_rate
+        if not rate:
+            return None
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if len(self._buckets) >= MAX_CHAT_BUCKETS:
+                self._evict_buckets()
+            bucket = self._buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        else:
+            self._buckets.move_to_end(chat_id)
+        return bucket
+
+    def _evict_buckets(self):
+        # Забуваємо найдавніші обмежувачі, які вже відновились: вони нічим не відрізняються від нових
+        for chat_id in list(self._buckets):
+            if len(self._buckets) < MAX_CHAT_BUCKETS:
+                return
+            if self._buckets[chat_id].full and chat_id not in self._in_flight:
+                del self._buckets[chat_id]
+        # Усі чати щойно отримували повідомлення - жертвуємо найдавнішим
+        while len(self._buckets) >= MAX_CHAT_BUCKETS:
+            self._buckets.popitem(last=False)
+
+    def _chat_delay(self, chat_id, now):
+        """Скільки секунд чекати, поки чат зможе прийняти повідомлення"""
+        paused_until = self._paused.get(chat_id)
+        if paused_until is not None:
+            if paused_until > now:
+                return paused_until - now
+            del self._paused[chat_id]
+        bucket = self._bucket(chat_id)
+        return bucket.delay() if bucket is not None else 0.0
+
+    def _next_ready(self):
+        """Найпріоритетніше повідомлення, яке можна надіслати зараз, або (None, скільки чекати)"""
+        now = time.monotonic()
+        wait = None
+        for queue in self._lanes:
+            blocked = set(self._in_flight)
+            for index, message in enumerate(queue):
+                if message.chat_id in blocked:
+                    continue
+                # Повідомлення одного чату йдуть по черзі, навіть якщо перше ще не можна надіслати
+                blocked.add(message.chat_id)
+                delay = self._chat_delay(message.chat_id, now)
+                if delay <= 0:
+                    bucket = self._bucket(message.chat_id)
+                    if bucket is not None:
+                        bucket.take()
+                    del queue[index]
+                    return message, None
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _run(self):
+        while True:
+            message, wait = self._next_ready()
+            if message is None:
+                if self._stopping and not self.queue_size() and not self._in_flight:
+                    return
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._in_flight.add(message.chat_id)
+            await self._slots.acquire()
+            if self.limiter is not None:
+                await self.limiter.acquire()
+            task = asyncio.create_task(self._send(message))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, message):
+        lane = LANE_NAMES[message.lane]
+        try:
+            if message.attempts == 0:
+                OUTBOX_WAIT_SECONDS.observe(time.monotonic() - message.enqueued, lane=lane)
+            result = await message.make_call()
+        except RetryAfter as e:
+            self._retry(message, e, e.retry_after, 'retry_after')
+        except (TimedOut, NetworkError) as e:
+            delay = DEFAULT_BASE_DELAY * (2 ** message.attempts) * random.uniform(0.5, 1.5)
+            self._retry(message, e, delay, 'network')
+        except Exception as e:
+            OUTBOX_FAILURES.inc(lane=lane)
+            if not message.future.done():
+                message.future.set_exception(e)
+        else:
+            if not message.future.done():
+                message.future.set_result(result)
+        finally:
+            self._in_flight.discard(message.chat_id)
+            self._slots.release()
+            self._wakeup.set()
+
+    def _retry(self, message, error, delay, reason):
+        lane = LANE_NAMES[message.lane]
+        if message.attempts >= self.max_retries:
+            OUTBOX_FAILURES.inc(lane=lane)
+            if not message.future.done():
+                message.future.set_exception(error)
+            return
+        message.attempts += 1
+        OUTBOX_RETRIES.inc(lane=lane, reason=reason)
+        logger.warning(
+            f"Повідомлення в чат {message.chat_id} повернуто в чергу ({error}), повтор через {delay:.2f} с",
+            extra={'chat_id': message.chat_id}
+        )
+        self._paused[message.chat_id] = time.monotonic() + delay
+        if reason == 'retry_after' and self.limiter is not None:
+            # Той самий 429, що й у call_with_retry: зупиняємо всі виклики Bot API
+            self.limiter.pause(delay)
+        # Назад на початок смуги: повідомлення цього чату мають зберегти порядок
+        self._lanes[message.lane].appendleft(message)
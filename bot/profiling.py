@@ -0,0 +1,328 @@
+"""
+Профілювання і діагностика пам'яті на працюючому боті.
+
+Сесія триває задану кількість секунд і повертає текстовий звіт:
+
+- sample - вибірки стеку потоку циклу подій окремим потоком. Навантаження
+  обмежене: якщо потік вибірок займає більше overhead_cap часу, інтервал
+  між вибірками збільшується. Звіт містить найчастіші функції і стеки у
+  форматі для flamegraph;
+- cprofile - детерміноване профілювання (cProfile) потоку циклу подій;
+- memory - знімки tracemalloc на початку і в кінці сесії та різниця між
+  ними по рядках коду.
+
+Під час будь-якої сесії стежить за затримкою циклу подій: якщо вона
+перевищує max_lag, сесія зупиняється достроково, щоб профілювання не
+заважало обробці оновлень. Одночасно може йти тільки одна сесія.
+"""
+
+import asyncio
+import cProfile
+import functools
+import io
+import linecache
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+KINDS = ('sample', 'cprofile', 'memory')
+
+DEFAULT_SECONDS = 30
+DEFAULT_MAX_SECONDS = 300
+
+# Частка часу, яку може займати потік вибірок
+DEFAULT_OVERHEAD_CAP = 0.02
+# Середня затримка циклу подій, після якої сесія зупиняється (секунди)
+DEFAULT_MAX_LAG = 0.25
+
+SAMPLE_INTERVAL = 0.005
+MAX_SAMPLE_INTERVAL = 0.5
+MAX_STACK_DEPTH = 64
+
+# Перевірка затримки циклу подій: період і скільки вимірів усереднювати
+LAG_PROBE_INTERVAL = 0.1
+LAG_WINDOW = 20
+
+# Скільки рядків у кожному розділі звіту
+REPORT_LINES = 40
+TRACEMALLOC_FRAMES = 10
+
+# Функції очікування в циклі подій - вибірки в них рахуються як простій
+IDLE_FUNCTIONS = frozenset(('select', 'poll', 'epoll', 'kqueue'))
+
+
+class ProfilingBusy(RuntimeError):
+    """Вже триває інша сесія профілювання"""
+
+
+class ProfileReport:
+    """Результат сесії: короткий підсумок і текст звіту"""
+
+    def __init__(self, kind, summary, text):
+        self.kind = kind
+        self.summary = summary
+        self.text = text
+
+    def filename(self):
+        return f"{self.kind}-{time.strftime('%Y%m%d-%H%M%S')}.txt"
+
+
+class StackSampler(threading.Thread):
+    """Потік, що періодично записує стек іншого потоку"""
+
+    def __init__(self, target_thread_id, overhead_cap, interval=SAMPLE_INTERVAL):
+        super().__init__(name='stack-sampler', daemon=True)
+        self.target_thread_id = target_thread_id
+        self.overhead_cap = overhead_cap
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self.idle = 0
+        self.cpu_time = 0.0
+        self.started_at = 0.0
+        self.finished_at = 0.0
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+    def run(self):
+        self.started_at = time.monotonic()
+        while not self._stop_event.wait(self.interval):
+            started = time.thread_time()
+            self._sample()
+            self.cpu_time += time.thread_time() - started
+            # Тримаємо власне навантаження в межах overhead_cap
+            elapsed = time.monotonic() - self.started_at
+            if self.cpu_time > self.overhead_cap * elapsed and self.interval < MAX_SAMPLE_INTERVAL:
+                self.interval = min(self.interval * 2, MAX_SAMPLE_INTERVAL)
+        self.finished_at = time.monotonic()
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.target_thread_id)
+        if frame is None:
+            return
+        self.samples += 1
+        if frame.f_code.co_name in IDLE_FUNCTIONS:
+            self.idle += 1
+            return
+        stack = []
+        while frame is not None and len(stack) < MAX_STACK_DEPTH:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({_short_path(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        stack.reverse()
+        self.stacks[tuple(stack)] += 1
+
+
+@functools.lru_cache(maxsize=4096)
+def _short_path(path):
+    """Шлях відносно site-packages, стандартної бібліотеки або поточного каталогу - коротший у звіті"""
+    for prefix in _path_prefixes():
+        if path.startswith(prefix):
+            return path[len(prefix):]
+    return path
+
+
+def _path_prefixes():
+    site_packages = [path for path in sys.path if path.endswith('site-packages')]
+    # Довші префікси першими: site-packages лежить усередині стандартної бібліотеки
+    return [path + os.sep for path in (*site_packages, os.path.dirname(os.__file__), os.getcwd())]
+
+
+class LagProbe:
+    """Вимірює, наскільки пізно прокидається задача в циклі подій"""
+
+    def __init__(self, max_lag):
+        self.max_lag = max_lag
+        self.lags = []
+        self.worst = 0.0
+        self.exceeded = False
+
+    def average(self):
+        recent = self.lags[-LAG_WINDOW:]
+        return sum(recent) / len(recent) if recent else 0.0
+
+    async def watch(self, stop_event):
+        while not stop_event.is_set():
+            started = time.monotonic()
+            await asyncio.sleep(LAG_PROBE_INTERVAL)
+            lag = max(0.0, time.monotonic() - started - LAG_PROBE_INTERVAL)
+            self.lags.append(lag)
+            self.worst = max(self.worst, lag)
+            if len(self.lags) >= LAG_WINDOW // 2 and self.average() > self.max_lag:
+                self.exceeded = True
+                stop_event.set()
+
+
+class Profiler:
+    """Запускає сесії профілювання по одній"""
+
+    def __init__(self, max_seconds=DEFAULT_MAX_SECONDS, overhead_cap=DEFAULT_OVERHEAD_CAP,
+                 max_lag=DEFAULT_MAX_LAG, focus=()):
+        self.max_seconds = max_seconds
+        self.overhead_cap = overhead_cap
+        self.max_lag = max_lag
+        # Імена функцій (обробників), для яких у звіті є окремий розділ
+        self.focus = tuple(focus)
+        self.active = None
+        self._stop_event = None
+
+    def stop(self):
+        """Завершує поточну сесію достроково; False, якщо сесії немає"""
+        if self.active is None:
+            return False
+        self._stop_event.set()
+        return True
+
+    async def run(self, kind, seconds=DEFAULT_SECONDS):
+        """Проводить сесію kind тривалістю до seconds секунд і повертає ProfileReport"""
+        if kind not in KINDS:
+            raise ValueError(f"Невідомий вид профілювання: {kind}. Доступні: {', '.join(KINDS)}")
+        if self.active is not None:
+            raise ProfilingBusy(f"Вже триває сесія {self.active}")
+        seconds = max(1, min(int(seconds), self.max_seconds))
+        self.active = kind
+        self._stop_event = asyncio.Event()
+        probe = LagProbe(self.max_lag)
+        probe_task = asyncio.create_task(probe.watch(self._stop_event))
+        started = time.monotonic()
+        try:
+            collect = {'sample': self._sample, 'cprofile': self._cprofile, 'memory': self._memory}[kind]
+            text = await collect(seconds)
+        finally:
+            self._stop_event.set()
+            await probe_task
+            self.active = None
+        duration = time.monotonic() - started
+        summary = f"{kind}: {duration:.1f} с, найбільша затримка циклу подій {probe.worst * 1000:.0f} мс"
+        if probe.exceeded:
+            summary += f" - зупинено достроково: затримка перевищила {self.max_lag * 1000:.0f} мс"
+        return ProfileReport(kind, summary, f"{summary}\n\n{text}")
+
+    async def _wait(self, seconds):
+        try:
+            await asyncio.wait_for(self._stop_event.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _sample(self, seconds):
+        sampler = StackSampler(threading.get_ident(), self.overhead_cap)
+        sampler.start()
+        try:
+            await self._wait(seconds)
+        finally:
+            await asyncio.to_thread(sampler.stop)
+        return self._format_samples(sampler)
+
+    def _format_samples(self, sampler):
+        elapsed = max(sampler.finished_at - sampler.started_at, 1e-9)
+        busy = sampler.samples - sampler.idle
+        lines = [
+            f"Вибірок: {sampler.samples}, з них простій циклу подій: {sampler.idle}",
+            f"Кінцевий інтервал вибірок: {sampler.interval * 1000:.1f} мс, "
+            f"час потоку вибірок: {sampler.cpu_time / elapsed:.1%} (межа {self.overhead_cap:.1%})",
+            "",
+        ]
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in sampler.stacks.items():
+            own[stack[-1]] += count
+            for frame in set(stack):
+                inclusive[frame] += count
+
+        def section(title, counter):
+            lines.append(title)
+            for frame, count in counter.most_common(REPORT_LINES):
+                lines.append(f"{count / busy:7.1%} {count:7d}  {frame}" if busy else frame)
+            lines.append("")
+
+        if self.focus:
+            focused = Counter({
+                frame: count for frame, count in inclusive.items() if frame.split(' ', 1)[0] in self.focus
+            })
+            section("Обробники (частка вибірок, в яких функція є в стеку):", focused)
+        section("Власний час (функція на вершині стеку):", own)
+        section("Загальний час (функція будь-де в стеку):", inclusive)
+        lines.append("Стеки (формат flamegraph.pl / speedscope):")
+        for stack, count in sampler.stacks.most_common():
+            lines.append(f"{';'.join(stack)} {count}")
+        return '\n'.join(lines) + '\n'
+
+    async def _cprofile(self, seconds):
+        # cProfile стежить за потоком, у якому його ввімкнено, - це потік циклу подій
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError as e:
+            # Інший профайлер (наприклад, налагоджувач) уже встановлений
+            raise ProfilingBusy(f"Не вдалося ввімкнути cProfile: {e}")
+        try:
+            await self._wait(seconds)
+        finally:
+            profile.disable()
+        return await asyncio.to_thread(self._format_cprofile, profile)
+
+    def _format_cprofile(self, profile):
+        stream = io.StringIO()
+        stats = pstats.Stats(profile, stream=stream)
+        stats.strip_dirs()
+        if self.focus:
+            stream.write("Обробники:\n")
+            stats.sort_stats('cumulative').print_stats('|'.join(self.focus))
+        stream.write("За загальним часом:\n")
+        stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+        stream.write("За власним часом:\n")
+        stats.sort_stats('tottime').print_stats(REPORT_LINES)
+        return stream.getvalue()
+
+    async def _memory(self, seconds):
+        started_here = not tracemalloc.is_tracing()
+        if started_here:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        try:
+            before = await asyncio.to_thread(tracemalloc.take_snapshot)
+            await self._wait(seconds)
+            after = await asyncio.to_thread(tracemalloc.take_snapshot)
+            current, peak = tracemalloc.get_traced_memory()
+        finally:
+            if started_here:
+                tracemalloc.stop()
+        return await asyncio.to_thread(self._format_memory, before, after, current, peak, started_here)
+
+    def _format_memory(self, before, after, current, peak, started_here):
+        ignored = (
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+            tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+        )
+        before = before.filter_traces(ignored)
+        after = after.filter_traces(ignored)
+        lines = [
+            f"Відстежується зараз: {current / 1024:.1f} КБ, пік: {peak / 1024:.1f} КБ",
+        ]
+        if started_here:
+            lines.append("tracemalloc увімкнено на час сесії: видно тільки виділення, зроблені під час неї")
+        lines.append("")
+        lines.append("Найбільший приріст за сесію:")
+        for diff in after.compare_to(before, 'lineno')[:REPORT_LINES]:
+            lines.append(f"{diff.size_diff / 1024:+10.1f} КБ {diff.count_diff:+8d} блоків  {_format_frame(diff.traceback)}")
+        lines.append("")
+        lines.append("Найбільші виділення в кінці сесії:")
+        for stat in after.statistics('lineno')[:REPORT_LINES]:
+            lines.append(f"{stat.size / 1024:10.1f} КБ {stat.count:8d} блоків  {_format_frame(stat.traceback)}")
+        return '\n'.join(lines) + '\n'
+
+
+def _format_frame(traceback):
+    frame = traceback[0]
+    source = linecache.getline(frame.filename, frame.lineno).strip()
+    return f"{_short_path(frame.filename)}:{frame.lineno}  {source}"
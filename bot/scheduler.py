@@ -0,0 +1,44 @@
+"""
+Планувальник переходів між робочим і неробочим часом.
+
+Замість перевірки щохвилини планувальник обчислює найближчу межу робочих
+годин і ставить одноразову задачу точно на цей момент. Після спрацювання
+(або після зміни годин) план будується заново.
+"""
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class TransitionScheduler:
+    """Ставить одноразову задачу на найближчу межу робочих годин"""
+
+    JOB_NAME = 'working-hours-transition'
+
+    def __init__(self, sweep_callback, next_boundary):
+        # sweep_callback(context) - оновлення дозволів груп
+        # next_boundary(after) - момент наступного переходу після after
+        # (або після поточного часу, якщо after=None), datetime з часовою зоною або None
+        self.sweep_callback = sweep_callback
+        self.next_boundary = next_boundary
+
+    def plan(self, job_queue, after=None):
+        """Скасовує поточний план і ставить задачу на наступну межу"""
+        for job in job_queue.get_jobs_by_name(self.JOB_NAME):
+            job.schedule_removal()
+
+        when = self.next_boundary(after)
+        if when is None:
+            logger.info("Розклад не має переходів - точна перевірка не запланована")
+            return None
+        job_queue.run_once(self._on_transition, when=when, name=self.JOB_NAME, data=when)
+        logger.info(f"Наступний перехід робочих годин заплановано на {when.isoformat()}")
+        return when
+
+    async def _on_transition(self, context):
+        try:
+            await self.sweep_callback(context)
+        finally:
+            # Плануємо від щойно обробленої межі, щоб не поставити її ж повторно
+            self.plan(context.job_queue, after=context.job.data)
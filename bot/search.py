@@ -0,0 +1,391 @@
+"""
+Повнотекстовий пошук по історії повідомлень.
+
+Інвертований індекс над message_text: для кожного терміна - ID повідомлень
+і кількість входжень. Терміни отримуються з тексту без урахування регістру
+і апострофів, без службових слів і з відкиданням українських закінчень,
+тож "оплату", "оплати" і "Оплата" знаходяться одним запитом. Результати
+впорядковуються за BM25, новіші - вище серед рівних. Індекс пам'ятає чат
+кожного повідомлення, тож пошук можна обмежити одним чатом.
+
+Індекс оновлюється після збереження кожного повідомлення і зберігається
+журналом JSON Lines: новий документ - новий рядок у кінці файлу, тож
+запис на диск не залежить від розміру індексу. Після перезапуску індекс
+читається з журналу і доганяє сховище повідомленнями, новішими за
+останній проіндексований ID.
+"""
+
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import re
+import unicodedata
+from array import array
+from collections import Counter, OrderedDict, namedtuple
+from pathlib import Path
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.constants import MessageLimit
+from telegram.helpers import escape_markdown
+
+from bot.history import PAGE_SIZE, format_record
+from bot.storage import fsync_directory
+
+logger = logging.getLogger(__name__)
+
+# Версія журналу і нормалізації термінів; при зміні журнал перебудовується зі сховища.
+# 2 - у документах є ID чату
+INDEX_VERSION = 2
+
+CALLBACK_PREFIX = 'srch:'
+
+# Скільки найкращих результатів запам'ятовувати для одного запиту
+MAX_RESULTS = 500
+
+# Скільки останніх запитів пам'ятати для кнопок гортання
+MAX_REMEMBERED_QUERIES = 256
+
+# Параметри BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+TOKEN_PATTERN = re.compile(r"[\w'’ʼ`]+")
+APOSTROPHES = str.maketrans('', '', "'’ʼ`")
+
+# Службові слова, що є майже в кожному повідомленні
+STOP_WORDS = frozenset((
+    'а', 'але', 'би', 'б', 'в', 'во', 'де', 'до', 'же', 'ж', 'з', 'за', 'зі', 'і', 'й', 'із', 'к',
+    'коли', 'ну', 'на', 'над', 'не', 'ні', 'о', 'об', 'от', 'під', 'по', 'при', 'про', 'с', 'та',
+    'то', 'у', 'уже', 'вже', 'це', 'чи', 'що', 'щоб', 'як', 'я', 'ти', 'ми', 'ви', 'він', 'вона',
+    'воно', 'вони', 'мене', 'мені', 'тебе', 'тобі', 'нас', 'вас', 'їх', 'його', 'її', 'від', 'для',
+))
+
+# Закінчення відмінків і зворотних дієслів, що відкидаються (від довших до коротших).
+# Закінчення, які збігаються з частиною основи в інших формах слова (-ати, -ла, -ання),
+# не відкидаються: "оплати" і "оплата" мають давати одну основу
+UKRAINIAN_ENDINGS = tuple(sorted((
+    'ться', 'лися', 'тися', 'ого', 'ому', 'ими', 'ами', 'ями', 'ові', 'еві', 'єві', 'іше', 'ись',
+    'ися', 'ють', 'уть', 'ся', 'сь', 'ий', 'ій', 'ої', 'ою', 'ею', 'єю', 'им', 'ім', 'их', 'іх',
+    'ах', 'ях', 'ом', 'ем', 'єм', 'ам', 'ям', 'ів', 'їв', 'а', 'я', 'о', 'е', 'є', 'и', 'і', 'ї',
+    'у', 'ю', 'ь', 'й',
+), key=len, reverse=True))
+MIN_STEM = 3
+
+# Голосні, що випадають у непрямих відмінках: рахунок - рахунку, продавець - продавця
+FLEETING_VOWELS = (('ок', 'к'), ('ец', 'ц'))
+
+CYRILLIC = re.compile('[а-яіїєґ]')
+
+
+# Функція для основи українського слова
+def stem(word):
+    """Відкидає найдовше відоме закінчення, якщо лишається основа з MIN_STEM літер
+
+    Застосовується до всіх форм однаково, тож форми одного слова дають одну основу.
+    """
+    if not CYRILLIC.search(word):
+        return word
+    for ending in UKRAINIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= MIN_STEM:
+            word = word[:-len(ending)]
+            break
+    for full, short in FLEETING_VOWELS:
+        if word.endswith(full) and len(word) - len(full) + len(short) >= MIN_STEM:
+            return word[:-len(full)] + short
+    return word
+
+
+# Функція для розбиття тексту на терміни
+def tokenize(text):
+    """Терміни тексту в порядку появи (з повторами)"""
+    if not text:
+        return []
+    normalized = unicodedata.normalize('NFC', str(text)).casefold()
+    terms = []
+    for token in TOKEN_PATTERN.findall(normalized):
+        word = token.translate(APOSTROPHES).strip('_')
+        if len(word) < 2 or word in STOP_WORDS:
+            continue
+        terms.append(stem(word))
+    return terms
+
+
+class SearchIndex:
+    """Інвертований індекс: термін -> (ID повідомлень, кількість входжень)
+
+    Змінюється тільки в циклі подій; на диск потрапляють лише нові записи
+    (take_pending + write_pending у потоці).
+    """
+
+    def __init__(self, path=None):
+        self.path = Path(path) if path else None
+        # термін -> (array ID, array кількостей входжень)
+        self._postings = {}
+        # ID -> кількість термінів документа; видалені зі сховища документи звідси прибираються
+        self._lengths = {}
+        # ID -> ID чату документа
+        self._chats = {}
+        self._total_length = 0
+        self.last_id = 0
+        # Ще не записані рядки журналу і чи треба переписати журнал з нуля
+        self._pending = []
+        self._reset = True
+
+    def __len__(self):
+        return len(self._lengths)
+
+    @property
+    def dirty(self):
+        return bool(self._pending) or self._reset
+
+    def load(self):
+        """Читає журнал; повертає False, якщо індекс треба будувати зі сховища заново"""
+        if self.path is None or not self.path.exists():
+            return False
+        documents = {}
+        damaged = 0
+        version = None
+        last_id = 0
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Обірваний останній рядок після аварійної зупинки
+                        damaged += 1
+                        continue
+                    if entry.get('op') == 'schema':
+                        version = entry.get('version')
+                    elif entry.get('op') == 'drop':
+                        damaged += documents.pop(entry['id'], None) is not None
+                    else:
+                        documents[entry['id']] = (entry['terms'], entry.get('chat'))
+                        last_id = max(last_id, entry['id'])
+                    last_id = max(last_id, entry.get('last_id', 0))
+        except OSError as e:
+            logger.error(f"Не вдалося прочитати пошуковий індекс {self.path}: {e}")
+            return False
+        if version != INDEX_VERSION:
+            logger.info(f"Пошуковий індекс {self.path} має іншу версію ({version}), його буде перебудовано")
+            return False
+
+        for message_id in sorted(documents):
+            self._insert(message_id, *documents[message_id])
+        self.last_id = last_id
+        self._reset = False
+        if damaged:
+            # Переписуємо журнал без видалених документів і пошкоджених рядків
+            self._write_journal(sorted(documents.items()))
+        logger.info(f"Пошуковий індекс завантажено: {len(self._lengths)} повідомлень, {len(self._postings)} термінів")
+        return True
+
+    def _insert(self, message_id, terms, chat_id):
+        for term, count in terms.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = (array('q'), array('H'))
+            postings[0].append(message_id)
+            postings[1].append(min(count, 0xFFFF))
+        length = sum(terms.values())
+        self._lengths[message_id] = length
+        self._chats[message_id] = chat_id
+        self._total_length += length
+
+    def add(self, message_id, text, chat_id=None):
+        """Індексує повідомлення чату chat_id; повторне додавання того самого ID ігнорується"""
+        self.last_id = max(self.last_id, message_id)
+        if message_id in self._lengths:
+            return False
+        terms = dict(Counter(tokenize(text)))
+        if not terms:
+            return False
+        self._insert(message_id, terms, chat_id)
+        self._pending.append({'id': message_id, 'chat': chat_id, 'terms': terms})
+        return True
+
+    def discard(self, message_id):
+        """Прибирає документ, якого вже немає у сховищі (наприклад, після очищення архіву)"""
+        length = self._lengths.pop(message_id, None)
+        if length is None:
+            return False
+        self._chats.pop(message_id, None)
+        # Записи в списках термінів лишаються до перезапуску, але вже не потрапляють у результати
+        self._total_length -= length
+        self._pending.append({'op': 'drop', 'id': message_id})
+        return True
+
+    def clear(self):
+        """Забуває всі документи; ID не скидається, як і в сховищі"""
+        self._postings.clear()
+        self._lengths.clear()
+        self._chats.clear()
+        self._total_length = 0
+        self._pending = []
+        self._reset = True
+
+    def search(self, query, chat_id=None, limit=MAX_RESULTS):
+        """(ID повідомлень, що містять усі терміни запиту, від найкращого збігу; скільки всього збігів)
+
+        chat_id - шукати тільки в повідомленнях цього чату (None - в усіх).
+        Повертається не більше limit ID, а кількість збігів - повна.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self._lengths:
+            return [], 0
+        postings = [self._postings.get(term) for term in terms]
+        if any(entry is None for entry in postings):
+            return [], 0
+        # Починаємо з найрідшого терміна: кандидатів менше, а решта списків лише перевіряє їх
+        postings.sort(key=lambda entry: len(entry[0]))
+
+        documents = len(self._lengths)
+        average_length = self._total_length / documents or 1
+        lengths = self._lengths
+        chats = self._chats
+        # Знаменник BM25: count + base + per_length * довжина документа
+        base = BM25_K1 * (1 - BM25_B)
+        per_length = BM25_K1 * BM25_B / average_length
+        scores = None
+        for ids, counts in postings:
+            idf = math.log(1 + (documents - len(ids) + 0.5) / (len(ids) + 0.5))
+            weight = idf * (BM25_K1 + 1)
+            if scores is None:
+                scores = {
+                    message_id: weight * count / (count + base + per_length * lengths[message_id])
+                    for message_id, count in zip(ids, counts)
+                    if message_id in lengths and (chat_id is None or chats[message_id] == chat_id)
+                }
+            else:
+                scores = {
+                    message_id: scores[message_id] + weight * count / (count + base + per_length * lengths[message_id])
+                    for message_id, count in zip(ids, counts) if message_id in scores
+                }
+            if not scores:
+                return [], 0
+        best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], item[0]))
+        return [message_id for message_id, _ in best], len(scores)
+
+    def take_pending(self):
+        """Забирає незаписані зміни для write_pending: (рядки, чи переписати журнал)"""
+        pending, reset = self._pending, self._reset
+        self._pending = []
+        self._reset = False
+        return pending, reset
+
+    def requeue(self, pending, reset):
+        """Повертає зміни, які не вдалося записати, на початок черги"""
+        self._pending = pending + self._pending
+        self._reset = self._reset or reset
+
+    def write_pending(self, pending, reset):
+        """Дописує зміни в журнал (у потоці); reset - почати журнал заново"""
+        if self.path is None:
+            return
+        if reset or not self.path.exists():
+            self._write_journal([], last_id=self.last_id)
+        if not pending:
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.writelines(json.dumps(entry, ensure_ascii=False) + '\n' for entry in pending)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_journal(self, documents, last_id=None):
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            header = {'op': 'schema', 'version': INDEX_VERSION, 'last_id': last_id or self.last_id}
+            f.write(json.dumps(header) + '\n')
+            for message_id, (terms, chat_id) in documents:
+                f.write(json.dumps({'id': message_id, 'chat': chat_id, 'terms': terms}, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        fsync_directory(self.path.parent)
+
+
+class RememberedQuery(namedtuple('RememberedQuery', 'query chat_id user_id')):
+    """Запит для гортання: текст, чат пошуку (None - всі чати) і хто шукав"""
+
+
+class RecentQueries:
+    """Останні запити для кнопок гортання: короткий ключ у callback_data -> RememberedQuery"""
+
+    def __init__(self, limit=MAX_REMEMBERED_QUERIES):
+        self.limit = limit
+        self._queries = OrderedDict()
+        self._counter = itertools.count(1)
+
+    def remember(self, query, chat_id, user_id):
+        key = format(next(self._counter), 'x')
+        self._queries[key] = RememberedQuery(query, chat_id, user_id)
+        while len(self._queries) > self.limit:
+            self._queries.popitem(last=False)
+        return key
+
+    def get(self, key):
+        query = self._queries.get(key)
+        if query is not None:
+            self._queries.move_to_end(key)
+        return query
+
+
+def encode_page(key, offset):
+    return f"{CALLBACK_PREFIX}{key}:{offset}"
+
+
+def decode_page(data):
+    """(ключ запиту, позиція першого результату сторінки) з callback_data; ValueError, якщо дані пошкоджені"""
+    if not data or not data.startswith(CALLBACK_PREFIX):
+        raise ValueError("Це не сторінка пошуку")
+    key, _, offset = data[len(CALLBACK_PREFIX):].partition(':')
+    offset = int(offset)
+    if not key or offset < 0:
+        raise ValueError(f"Пошкоджена сторінка пошуку: {data}")
+    return key, offset
+
+
+# Місце в заголовку для рядка з номерами результатів, що стає відомим після розкладки сторінки
+POSITION_RESERVE = 40
+
+
+# Функція для формування сторінки результатів пошуку
+def render_results(query, records, total, available, key, offset, page_size=PAGE_SIZE):
+    """Повертає (текст MarkdownV2, клавіатура або None) для сторінки, що починається з результату offset
+
+    records - до page_size записів від offset у порядку рангу. Записи, що не
+    вмістились в одне повідомлення, переходять на наступну сторінку.
+    total - скільки всього збігів, available - скільки найкращих з них можна
+    гортати (не більше MAX_RESULTS).
+    """
+    title = (
+        f"🔍 *Пошук:* {escape_markdown(query, version=2)}\n"
+        f"Знайдено: {total}"
+    )
+    if available < total:
+        title += f", показано найкращі {available}"
+
+    blocks = []
+    length = len(title) + POSITION_RESERVE
+    for msg in records:
+        block = format_record(msg)
+        if blocks and length + len(block) + 1 > MessageLimit.MAX_TEXT_LENGTH:
+            break
+        blocks.append(block)
+        length += len(block) + 1
+    shown = len(blocks)
+    if shown and (offset > 0 or offset + shown < available):
+        title += f"\nРезультати {offset + 1}–{offset + shown}"
+    text = title + "\n\n" + ('\n'.join(blocks) if blocks else "📝 Нічого не знайдено\\.")
+
+    buttons = []
+    if offset > 0:
+        buttons.append(InlineKeyboardButton(
+            "⬅️ Попередні", callback_data=encode_page(key, max(0, offset - page_size))
+        ))
+    if shown and offset + shown < available:
+        buttons.append(InlineKeyboardButton("Наступні ➡️", callback_data=encode_page(key, offset + shown)))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
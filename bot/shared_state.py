@@ -0,0 +1,246 @@
+"""
+Спільний стан кількох робочих процесів бота.
+
+Кілька процесів (наприклад, за балансувальником webhook) працюють з одним
+SQLite-файлом. У ньому зберігаються:
+
+- оренда лідера: тільки процес, що тримає непрострочену оренду, виконує
+  перевірку дозволів груп, точні переходи та обслуговування сховища; якщо
+  лідер зупинився, інший процес перехоплює оренду після її закінчення;
+- стан по чатах (реєстр груп, застосовані дозволи, розклади, останній
+  надісланий статус): кожен чат - окремий рядок, тож зміни різних чатів з
+  різних процесів не затирають одна одну, а номер версії простору імен
+  підказує іншим процесам, що стан треба перечитати.
+"""
+
+import asyncio
+import json
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+logger = logging.getLogger(__name__)
+
+# Скільки чекати, поки інший процес звільнить блокування (секунди)
+DEFAULT_BUSY_TIMEOUT = 5.0
+
+# Тривалість оренди лідера за замовчуванням (секунди)
+DEFAULT_LEASE_TTL = 30
+
+
+class SharedState:
+    """Оренди і стан по чатах у спільному SQLite-файлі"""
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )""",
+        """CREATE TABLE IF NOT EXISTS chat_state (
+            namespace TEXT NOT NULL,
+            chat_id TEXT NOT NULL,
+            value TEXT NOT NULL,
+            PRIMARY KEY (namespace, chat_id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS state_versions (
+            namespace TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )""",
+    )
+
+    def __init__(self, path, busy_timeout=DEFAULT_BUSY_TIMEOUT):
+        self.path = Path(path)
+        self._lock = threading.RLock()
+        # Транзакції відкриваються явно (BEGIN IMMEDIATE для запису)
+        self._conn = sqlite3.connect(
+            str(self.path), timeout=busy_timeout, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._write() as conn:
+            for statement in self.SCHEMA:
+                conn.execute(statement)
+        # Останній прочитаний або записаний цим процесом стан і версії просторів імен
+        self._known = {}
+        self._versions = {}
+
+    @contextmanager
+    def _write(self):
+        """Транзакція, що одразу бере блокування запису"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    @contextmanager
+    def _read(self):
+        """Транзакція читання з узгодженим знімком бази"""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield self._conn
+            finally:
+                self._conn.execute("COMMIT")
+
+    # Оренда лідера
+
+    def acquire_lease(self, name, holder, ttl, now=None):
+        """Бере або продовжує оренду; повертає True, якщо holder тепер її власник"""
+        if now is None:
+            now = time.time()
+        with self._write() as conn:
+            row = conn.execute("SELECT holder, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+            if row is not None and row[0] != holder and row[1] > now:
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (name, holder, expires_at) VALUES (?, ?, ?)",
+                (name, holder, now + ttl)
+            )
+            return True
+
+    def release_lease(self, name, holder):
+        """Звільняє оренду, якщо нею володіє holder"""
+        with self._write() as conn:
+            conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    def lease_holder(self, name, now=None):
+        """Повертає власника непростроченої оренди або None"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT holder FROM leases WHERE name = ? AND expires_at > ?", (name, now)
+            ).fetchone()
+        return row[0] if row is not None else None
+
+    # Стан по чатах
+
+    def save(self, namespace, snapshot):
+        """Записує знімок простору імен: тільки чати, що змінились з останнього читання
+
+        snapshot - словник chat_id -> значення, що серіалізується в JSON.
+        Повертає True, якщо щось записано.
+        """
+        snapshot = {str(chat_id): value for chat_id, value in snapshot.items()}
+        with self._lock:
+            known = self._known.get(namespace, {})
+            changed = [
+                (namespace, chat_id, json.dumps(value, ensure_ascii=False))
+                for chat_id, value in snapshot.items() if known.get(chat_id) != value
+            ]
+            removed = [(namespace, chat_id) for chat_id in known if chat_id not in snapshot]
+            if not changed and not removed:
+                return False
+            with self._write() as conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO chat_state (namespace, chat_id, value) VALUES (?, ?, ?)",
+                    changed
+                )
+                conn.executemany("DELETE FROM chat_state WHERE namespace = ? AND chat_id = ?", removed)
+                conn.execute(
+                    "INSERT INTO state_versions (namespace, version) VALUES (?, 1) "
+                    "ON CONFLICT (namespace) DO UPDATE SET version = version + 1",
+                    (namespace,)
+                )
+            # Версію не запам'ятовуємо: наступна синхронізація перечитає простір імен
+            # разом зі змінами інших процесів, якщо вони були
+            self._known[namespace] = snapshot
+            return True
+
+    def load(self, namespace):
+        """Читає весь простір імен (chat_id -> значення) і запам'ятовує його версію"""
+        with self._read() as conn:
+            row = conn.execute(
+                "SELECT version FROM state_versions WHERE namespace = ?", (namespace,)
+            ).fetchone()
+            rows = conn.execute(
+                "SELECT chat_id, value FROM chat_state WHERE namespace = ?", (namespace,)
+            ).fetchall()
+        data = {chat_id: json.loads(value) for chat_id, value in rows}
+        with self._lock:
+            self._known[namespace] = data
+            self._versions[namespace] = row[0] if row is not None else 0
+        return data
+
+    def changed_namespaces(self, namespaces):
+        """Простори імен, змінені з часу останнього читання цим процесом"""
+        with self._lock:
+            versions = dict(self._conn.execute("SELECT namespace, version FROM state_versions").fetchall())
+            return [
+                namespace for namespace in namespaces
+                if versions.get(namespace, 0) != self._versions.get(namespace, 0)
+            ]
+
+    def swap(self, namespace, chat_id, value):
+        """Атомарно замінює значення одного чату (None - видаляє); повертає попереднє"""
+        chat_id = str(chat_id)
+        with self._write() as conn:
+            row = conn.execute(
+                "SELECT value FROM chat_state WHERE namespace = ? AND chat_id = ?", (namespace, chat_id)
+            ).fetchone()
+            if value is None:
+                conn.execute("DELETE FROM chat_state WHERE namespace = ? AND chat_id = ?", (namespace, chat_id))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO chat_state (namespace, chat_id, value) VALUES (?, ?, ?)",
+                    (namespace, chat_id, json.dumps(value, ensure_ascii=False))
+                )
+        return json.loads(row[0]) if row is not None else None
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class LeaderElection:
+    """Вибір лідера через оренду в спільному стані"""
+
+    LEASE_NAME = 'scheduler-leader'
+
+    def __init__(self, state, holder, ttl=DEFAULT_LEASE_TTL):
+        self.state = state
+        self.holder = holder
+        self.ttl = ttl
+        self._leader = False
+        # До якого моменту (time.monotonic) оренда гарантовано наша
+        self._valid_until = 0.0
+
+    @property
+    def is_leader(self):
+        # Якщо продовження затрималось довше за оренду, вважаємо її втраченою
+        return self._leader and time.monotonic() < self._valid_until
+
+    async def renew(self):
+        """Бере або продовжує оренду; повертає True, якщо роль процесу змінилась"""
+        was_leader = self._leader
+        started = time.monotonic()
+        try:
+            acquired = await asyncio.to_thread(self.state.acquire_lease, self.LEASE_NAME, self.holder, self.ttl)
+        except Exception as e:
+            logger.error(f"Не вдалося продовжити оренду лідера: {e}")
+            acquired = False
+        self._leader = acquired
+        self._valid_until = started + self.ttl if acquired else 0.0
+
+        if acquired != was_leader:
+            logger.info(f"Процес {self.holder} {'став лідером' if acquired else 'більше не лідер'}")
+            return True
+        return False
+
+    async def release(self):
+        """Звільняє оренду, щоб інший процес перехопив її без очікування"""
+        if not self._leader:
+            return
+        self._leader = False
+        self._valid_until = 0.0
+        try:
+            await asyncio.to_thread(self.state.release_lease, self.LEASE_NAME, self.holder)
+        except Exception as e:
+            logger.error(f"Не вдалося звільнити оренду лідера: {e}")
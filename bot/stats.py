@@ -0,0 +1,113 @@
+"""
+Накопичувальна статистика повідомлень.
+
+Лічильники оновлюються під час запису в сховище (в тому ж коміті), тому
+/stats не перечитує історію і лишається точною навіть після компакції або
+видалення старих записів.
+"""
+
+# Виміри статистики; ключі всіх вимірів - рядки
+DIMENSIONS = ('total', 'status', 'chat', 'user', 'day', 'hour')
+
+TOTAL_KEY = ''
+
+
+class MessageStats:
+    """Лічильники по статусах, чатах, користувачах, днях і годинах"""
+
+    def __init__(self, tz=None):
+        # Часова зона, в якій рахуються календарні дні та години
+        self.tz = tz
+        self.counts = {dimension: {} for dimension in DIMENSIONS}
+        # Незаписані зміни: (вимір, ключ) -> приріст
+        self._deltas = {}
+        self._cleared = False
+
+    def _incr(self, dimension, key, delta=1):
+        key = str(key)
+        values = self.counts[dimension]
+        values[key] = values.get(key, 0) + delta
+        self._deltas[(dimension, key)] = self._deltas.get((dimension, key), 0) + delta
+
+    def message_added(self, record, when):
+        """Враховує нове повідомлення; when - момент отримання або None, якщо він невідомий"""
+        self._incr('total', TOTAL_KEY)
+        self._incr('status', record.get('status'))
+        self._incr('chat', record.get('chat_id'))
+        self._incr('user', record.get('user_id'))
+        if when is not None:
+            self._incr('day', when.strftime('%Y-%m-%d'))
+            self._incr('hour', when.strftime('%Y-%m-%d %H'))
+
+    def message_removed(self, record, when):
+        """Знімає з лічильників видалене повідомлення; when - як при message_added"""
+        self._incr('total', TOTAL_KEY, -1)
+        self._incr('status', record.get('status'), -1)
+        self._incr('chat', record.get('chat_id'), -1)
+        self._incr('user', record.get('user_id'), -1)
+        if when is not None:
+            self._incr('day', when.strftime('%Y-%m-%d'), -1)
+            self._incr('hour', when.strftime('%Y-%m-%d %H'), -1)
+
+    def status_changed(self, old_status, new_status):
+        if old_status == new_status:
+            return
+        self._incr('status', old_status, -1)
+        self._incr('status', new_status)
+
+    def reset(self):
+        self.counts = {dimension: {} for dimension in DIMENSIONS}
+        self._deltas.clear()
+        self._cleared = True
+
+    # Читання
+
+    def total(self):
+        return self.counts['total'].get(TOTAL_KEY, 0)
+
+    def by_status(self, status):
+        return self.counts['status'].get(status, 0)
+
+    def unique_users(self):
+        return sum(1 for count in self.counts['user'].values() if count > 0)
+
+    def on_day(self, moment):
+        return self.counts['day'].get(moment.strftime('%Y-%m-%d'), 0)
+
+    def in_hour(self, moment):
+        return self.counts['hour'].get(moment.strftime('%Y-%m-%d %H'), 0)
+
+    # Збереження
+
+    def take_changes(self):
+        """Повертає (чи була очистка, [(вимір, ключ, приріст), ...]) і скидає список змін
+
+        Прирости (а не підсумкові значення) дозволяють кільком процесам
+        оновлювати ті самі лічильники в спільному сховищі.
+        """
+        changes = [(dimension, key, delta) for (dimension, key), delta in self._deltas.items() if delta]
+        cleared = self._cleared
+        self._deltas.clear()
+        self._cleared = False
+        return cleared, changes
+
+    def has_changes(self):
+        return self._cleared or bool(self._deltas)
+
+    def snapshot(self):
+        return {dimension: dict(values) for dimension, values in self.counts.items()}
+
+    def load(self, data):
+        for dimension in DIMENSIONS:
+            self.counts[dimension] = {str(key): value for key, value in data.get(dimension, {}).items()}
+        self._deltas.clear()
+        self._cleared = False
+
+    def load_rows(self, rows):
+        """Завантажує лічильники з рядків (вимір, ключ, значення) замість поточних"""
+        self.counts = {dimension: {} for dimension in DIMENSIONS}
+        for dimension, key, value in rows:
+            if dimension in self.counts:
+                self.counts[dimension][key] = value
+        self._deltas.clear()
+        self._cleared = False
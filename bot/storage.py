@@ -0,0 +1,1592 @@
+"""
+Сховище історії повідомлень.
+
+Обробники працюють з історією тільки через інтерфейс MessageStore. Є два бекенди:
+
+- SqliteMessageStore - база SQLite у режимі WAL з індексами, без обмеження
+  кількості записів;
+- JsonlMessageStore - append-only журнал у форматі JSON Lines для невеликих
+  установок: кожне нове повідомлення - це один рядок у кінці файлу, а зміни
+  (наприклад, /replied) дописуються окремими рядками-патчами. Читання йде
+  з кінця файлу, тому останні записи дістаються без розбору всієї історії.
+
+Обидва бекенди тримають у "гарячому" шарі тільки останні повідомлення, а
+старіші під час обслуговування переносять в архів (MessageArchive):
+стиснуті gzip-сегменти по одному на календарний день. Архів відкривається
+тільки тоді, коли запиту не вистачає гарячого шару, і лише в тих
+сегментах, що потрібні запиту. ID повідомлень тільки зростають - і після
+компакції, і після очищення історії.
+
+Сховище зберігає версію своєї схеми і при відкритті один раз мігрує старі
+записи (див. bot.migrations); читання нічого не виправляє.
+
+Перенесення старого messages_history.json:
+
+    python -m bot.storage import messages_history.json --backend sqlite --path messages.db
+"""
+
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from bot.migrations import SCHEMA_VERSION, RecordMigrator, assign_ids
+from bot.stats import MessageStats
+
+logger = logging.getLogger(__name__)
+
+# Розмір блоку для читання файлу з кінця
+TAIL_BLOCK_SIZE = 64 * 1024
+
+# Скільки повідомлень залишається в гарячому шарі після компакції
+DEFAULT_MAX_RECORDS = 1000
+
+# Архів: каталог поруч з файлом сховища, один сегмент на день
+ARCHIVE_SUFFIX = '.archive'
+SEGMENT_SUFFIX = '.jsonl.gz'
+ARCHIVE_INDEX_FILE = 'index.json'
+# Сегмент для записів без created_at (перенесених зі старого формату)
+UNDATED_SEGMENT = 'undated'
+# Скільки записів переносити в архів за один крок
+ARCHIVE_CHUNK_SIZE = 5000
+
+# Скільки чекати, поки інший процес звільнить блокування SQLite (мілісекунди)
+SQLITE_BUSY_TIMEOUT_MS = 5000
+
+
+def iter_lines_reversed(path, block_size=TAIL_BLOCK_SIZE):
+    """Повертає рядки файлу у зворотному порядку, читаючи блоками з кінця"""
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b''
+        while position > 0:
+            read_size = min(block_size, position)
+            position -= read_size
+            f.seek(position)
+            chunk = f.read(read_size) + remainder
+            lines = chunk.split(b'\n')
+            # Перший рядок блоку може бути неповним - дочитаємо його з наступним блоком
+            remainder = lines.pop(0)
+            for line in reversed(lines):
+                if line.strip():
+                    yield line.decode('utf-8')
+        if remainder.strip():
+            yield remainder.decode('utf-8')
+
+
+# Поля запису повідомлення у порядку колонок таблиці
+MESSAGE_FIELDS = (
+    'id', 'user_name', 'user_id', 'chat_id', 'chat_type', 'message_text',
+    'timestamp', 'status', 'replied_by', 'reply_timestamp', 'created_at'
+)
+
+GROUP_CHAT_TYPES = ('group', 'supergroup')
+
+# Операції, які змінюють сховище і виконуються тільки через StoreWriter
+MUTATIONS = ('add', 'add_many', 'import_messages', 'update', 'mark_replied', 'mark_replied_many', 'clear', 'clear_chat', 'maintenance')
+
+
+def file_time(path, tz=None):
+    """Час останньої зміни файлу (datetime з часовою зоною) або None"""
+    try:
+        return datetime.fromtimestamp(Path(path).stat().st_mtime, tz)
+    except OSError:
+        return None
+
+
+class MessageSelection(namedtuple('MessageSelection', 'ranges filters exclude_status', defaults=((), None, None))):
+    """Вибір повідомлень для масової зміни
+
+    ranges - діапазони ID [(від, до), ...] включно (порожній - будь-які ID),
+    filters - точні значення полів, exclude_status - статус, записи з яким
+    пропускаються.
+    """
+
+    def matches(self, record):
+        if self.ranges and not any(low <= record['id'] <= high for low, high in self.ranges):
+            return False
+        if self.exclude_status is not None and record.get('status') == self.exclude_status:
+            return False
+        return all(record.get(field) == value for field, value in (self.filters or {}).items())
+
+    def id_bounds(self):
+        """Найменший і найбільший ID діапазонів або None, якщо ID не обмежено"""
+        if not self.ranges:
+            return None
+        return min(low for low, _ in self.ranges), max(high for _, high in self.ranges)
+
+    def where(self):
+        """Умова SQL і параметри для цього вибору"""
+        unknown = set(self.filters or {}) - set(MESSAGE_FIELDS)
+        if unknown:
+            raise ValueError(f"Невідомі поля повідомлення: {', '.join(sorted(unknown))}")
+        conditions, params = [], []
+        if self.ranges:
+            conditions.append('(' + ' OR '.join('id BETWEEN ? AND ?' for _ in self.ranges) + ')')
+            params.extend(bound for id_range in self.ranges for bound in id_range)
+        if self.exclude_status is not None:
+            conditions.append("status IS NOT ?")
+            params.append(self.exclude_status)
+        for field, value in (self.filters or {}).items():
+            conditions.append(f"{field} = ?")
+            params.append(value)
+        return ' AND '.join(conditions) or '1', params
+
+
+def load_legacy_messages(path, tz=None):
+    """Читає старий messages_history.json і доводить записи до поточної схеми"""
+    with open(path, 'r', encoding='utf-8') as f:
+        messages = json.load(f)
+
+    assign_ids(messages)
+    # Останній запис файлу зроблено не пізніше за останню зміну файлу
+    migrator = RecordMigrator(0, tz, anchor=file_time(path, tz))
+    for i in reversed(range(len(messages))):
+        messages[i] = migrator.migrate(messages[i]) or messages[i]
+    return messages
+
+
+def record_day(record):
+    """Календарний день повідомлення (YYYY-MM-DD) за created_at"""
+    created_at = record.get('created_at')
+    return created_at[:10] if created_at else UNDATED_SEGMENT
+
+
+def record_time(record):
+    """Момент отримання повідомлення (datetime з часовою зоною) або None"""
+    created_at = record.get('created_at')
+    if not created_at:
+        return None
+    try:
+        return datetime.fromisoformat(created_at)
+    except ValueError:
+        return None
+
+
+class MessageStore(ABC):
+    """Інтерфейс сховища історії повідомлень
+
+    Бекенд реалізує гарячий шар (методи _hot_*), а читання і зміни, яким
+    гарячого шару не вистачило, базовий клас передає в архів, якщо він є.
+    """
+
+    # Накопичувальна статистика (MessageStats), оновлюється разом зі змінами
+    stats = None
+
+    # Архів старих повідомлень (MessageArchive) або None - тоді старі записи не зберігаються
+    archive = None
+
+    @abstractmethod
+    def add(self, record):
+        """Зберігає нове повідомлення і повертає присвоєний йому ID"""
+        raise NotImplementedError
+
+    def add_many(self, records):
+        """Зберігає кілька нових повідомлень однією зміною; повертає список їхніх ID
+
+        Зміни виконуються в пакеті StoreWriter, тож усі записи потрапляють в один коміт.
+        """
+        return [self.add(record) for record in records]
+
+    @abstractmethod
+    def import_messages(self, messages):
+        """Переносить готові записи зі збереженням їхніх ID; повертає перенесені записи"""
+        raise NotImplementedError
+
+    def get(self, message_id):
+        """Повертає повідомлення за ID або None"""
+        record = self._hot_get(message_id)
+        if record is None and self.archive is not None:
+            record = self.archive.get(message_id)
+        return record
+
+    def update(self, message_id, **fields):
+        """Змінює поля повідомлення; повертає False, якщо його не знайдено"""
+        if self._hot_update(message_id, **fields):
+            return True
+        return self.archive is not None and self.archive.update(message_id, **fields)
+
+    def recent(self, limit=10):
+        """Повертає останні limit повідомлень у хронологічному порядку"""
+        messages = list(itertools.islice(self.iter_messages(), limit))
+        messages.reverse()
+        return messages
+
+    def iter_messages(self):
+        """Повертає всі повідомлення від найновішого до найстарішого
+
+        Архів розпаковується посегментно і тільки якщо читання дійшло до кінця гарячого шару.
+        """
+        oldest_hot_id = None
+        for record in self._hot_iter():
+            oldest_hot_id = record['id']
+            yield record
+        if self.archive is not None:
+            yield from self.archive.iter_messages(before_id=oldest_hot_id)
+
+    def query(self, limit, before_id=None, after_id=None, **filters):
+        """Одна сторінка повідомлень за фільтрами (chat_id, status, user_id)
+
+        Без after_id - до limit повідомлень, старших за before_id (або
+        найновіших), від найновішого; з after_id - до limit повідомлень,
+        новіших за after_id, від найстарішого. Архів читається, тільки якщо
+        гарячого шару сторінці не вистачило.
+        """
+        filters = {field: value for field, value in filters.items() if value is not None}
+        unknown = set(filters) - set(MESSAGE_FIELDS)
+        if unknown:
+            raise ValueError(f"Невідомі поля повідомлення: {', '.join(sorted(unknown))}")
+
+        def matches(record):
+            return all(record.get(field) == value for field, value in filters.items())
+
+        if after_id is None:
+            messages = self._hot_query(limit, before_id, None, filters)
+            if len(messages) < limit and self.archive is not None:
+                seen = {record['id'] for record in messages}
+                older = (
+                    record for record in self.archive.iter_messages(before_id)
+                    if matches(record) and record['id'] not in seen
+                )
+                messages.extend(itertools.islice(older, limit - len(messages)))
+            return messages
+
+        messages = []
+        if self.archive is not None:
+            newer = (record for record in self.archive.iter_messages_after(after_id) if matches(record))
+            messages = list(itertools.islice(newer, limit))
+        if len(messages) < limit:
+            seen = {record['id'] for record in messages}
+            hot = self._hot_query(limit, None, after_id, filters)
+            messages.extend(record for record in hot if record['id'] not in seen)
+        return messages[:limit]
+
+    def messages_between(self, start, end):
+        """Повідомлення, отримані в [start, end), у хронологічному порядку
+
+        Записи без created_at (перенесені зі старого формату) не враховуються.
+        З архіву читаються тільки сегменти днів, що перетинаються з проміжком.
+        """
+        messages = []
+        if self.archive is not None:
+            messages.extend(self.archive.messages_between(start, end))
+        hot = [record for record in self._hot_iter() if start <= (record_time(record) or end) < end]
+        hot.reverse()
+        seen = {record['id'] for record in messages}
+        messages.extend(record for record in hot if record['id'] not in seen)
+        return messages
+
+    def clear(self):
+        """Видаляє всю історію, разом з архівом (лічильник ID не скидається)"""
+        self._hot_clear()
+        if self.archive is not None:
+            self.archive.clear()
+
+    def clear_chat(self, chat_id):
+        """Видаляє історію однієї групи, разом з її записами в архіві; повертає видалені записи"""
+        removed = self._hot_clear_chat(chat_id)
+        if self.archive is not None:
+            hot_ids = {record['id'] for record in removed}
+            removed.extend(record for record in self.archive.clear_chat(chat_id) if record['id'] not in hot_ids)
+        return removed
+
+    def is_empty(self):
+        if not self._hot_is_empty():
+            return False
+        return self.archive is None or self.archive.is_empty()
+
+    def group_chat_ids(self):
+        """Повертає ID усіх груп, з яких є повідомлення"""
+        chat_ids = self._hot_group_chat_ids()
+        if self.archive is not None:
+            chat_ids |= self.archive.group_chat_ids()
+        return chat_ids
+
+    def mark_replied(self, message_id, replied_by, reply_timestamp):
+        """Відзначає повідомлення як відповіджене і повертає оновлений запис"""
+        if not self.update(message_id, status='manually_replied',
+                           replied_by=replied_by, reply_timestamp=reply_timestamp):
+            return None
+        return self.get(message_id)
+
+    def mark_replied_many(self, selection, replied_by, reply_timestamp):
+        """Відзначає відповідженими всі повідомлення вибору (MessageSelection) однією зміною
+
+        Вже відповіджені вручну пропускаються. Повертає [(ID, попередній статус), ...]
+        за зростанням ID.
+        """
+        selection = selection._replace(exclude_status='manually_replied')
+        fields = {'status': 'manually_replied', 'replied_by': replied_by, 'reply_timestamp': reply_timestamp}
+        changed = self._hot_update_where(selection, fields)
+        if self.archive is not None:
+            hot_ids = {message_id for message_id, _ in changed}
+            changed.extend(
+                item for item in self.archive.update_where(selection, fields) if item[0] not in hot_ids
+            )
+        changed.sort()
+        return changed
+
+    def maintenance(self):
+        """Фонове обслуговування сховища (перенесення в архів, компакція тощо)"""
+        if self.archive is not None:
+            self.archive.prune()
+
+    # Гарячий шар, який реалізує бекенд
+
+    @abstractmethod
+    def _hot_get(self, message_id):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _hot_update(self, message_id, **fields):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _hot_iter(self):
+        """Повідомлення гарячого шару від найновішого до найстарішого"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _hot_clear(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _hot_clear_chat(self, chat_id):
+        """Видаляє записи чату з гарячого шару; повертає видалені записи"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def _hot_update_where(self, selection, fields):
+        """Змінює поля всіх записів гарячого шару з вибору; повертає [(ID, попередній статус), ...]"""
+        raise NotImplementedError
+
+    def _hot_query(self, limit, before_id, after_id, filters):
+        """Сторінка гарячого шару: як query, але без архіву (filters - тільки задані поля)"""
+        def matches(record):
+            return all(record.get(field) == value for field, value in filters.items())
+
+        if after_id is None:
+            older = (
+                record for record in self._hot_iter()
+                if (before_id is None or record['id'] < before_id) and matches(record)
+            )
+            return list(itertools.islice(older, limit))
+        newer = []
+        for record in self._hot_iter():
+            if record['id'] <= after_id:
+                break
+            if matches(record):
+                newer.append(record)
+        newer.reverse()
+        return newer[:limit]
+
+    def _hot_is_empty(self):
+        return next(iter(self._hot_iter()), None) is None
+
+    def _hot_group_chat_ids(self):
+        return {
+            msg['chat_id'] for msg in self._hot_iter()
+            if msg.get('chat_type') in GROUP_CHAT_TYPES
+        }
+
+    def apply_batch(self, mutations):
+        """Застосовує пакет змін [(назва, args, kwargs), ...] одним комітом
+
+        Повертає список результатів у тому ж порядку; помилка окремої зміни
+        повертається як виняток на її місці і не зупиняє решту пакета.
+        """
+        results = []
+        for name, args, kwargs in mutations:
+            results.append(self._apply_mutation(name, args, kwargs))
+        return results
+
+    def _apply_mutation(self, name, args, kwargs):
+        if name not in MUTATIONS:
+            return ValueError(f"Невідома операція сховища: {name}")
+        try:
+            previous = None
+            if self.stats is not None and name in ('update', 'mark_replied'):
+                previous = self.get(args[0])
+            with self._mutation():
+                result = getattr(self, name)(*args, **kwargs)
+        except Exception as e:
+            return e
+        if self.stats is not None:
+            self._track_stats(name, args, result, previous)
+        return result
+
+    @contextmanager
+    def _mutation(self):
+        """Межі однієї зміни пакета: бекенд скасовує все, що встигла зробити невдала зміна"""
+        yield
+
+    def _track_stats(self, name, args, result, previous):
+        if name == 'add':
+            self.stats.message_added(args[0], record_time(args[0]) or datetime.now(self.stats.tz))
+        elif name == 'add_many':
+            for record in args[0]:
+                self.stats.message_added(record, record_time(record) or datetime.now(self.stats.tz))
+        elif name == 'import_messages':
+            # Для записів старого формату відомий тільки час доби, тому без днів і годин
+            for msg in result:
+                self.stats.message_added(msg, record_time(msg))
+        elif name == 'clear':
+            self.stats.reset()
+        elif name == 'clear_chat':
+            for record in result:
+                when = record_time(record)
+                if when is not None and self.stats.tz is not None:
+                    when = when.astimezone(self.stats.tz)
+                self.stats.message_removed(record, when)
+        elif name == 'mark_replied_many':
+            for _, old_status in result:
+                self.stats.status_changed(old_status, 'manually_replied')
+        elif name in ('update', 'mark_replied') and result and previous is not None:
+            current = result if isinstance(result, dict) else self.get(args[0])
+            self.stats.status_changed(previous.get('status'), current.get('status'))
+
+    def _init_stats(self, tz, rebuild=False):
+        """Завантажує статистику; якщо її ще немає (або rebuild) - рахує з наявної історії"""
+        self.stats = MessageStats(tz)
+        self._load_stats()
+        if (rebuild or self.stats.total() == 0) and not self.is_empty():
+            self.rebuild_stats()
+
+    # Міграція схеми
+
+    def migrate(self, tz=None):
+        """Доводить записи (разом з архівом) до SCHEMA_VERSION; повертає кількість змінених
+
+        Виконується один раз при старті: читання історії вже нічого не виправляє.
+        """
+        version = self._schema_version()
+        if version >= SCHEMA_VERSION:
+            return 0
+        logger.info(f"Міграція сховища {self.path} з версії {version} до {SCHEMA_VERSION}")
+        # Час зміни файлу - до того, як міграція його перепише
+        migrator = RecordMigrator(version, tz, anchor=file_time(self.path, tz))
+        self._migrate_layout(version)
+
+        hot_changes = []
+        oldest_hot_id = None
+        for record in self._hot_iter():
+            oldest_hot_id = record['id']
+            migrated = migrator.migrate(record)
+            if migrated is not None:
+                hot_changes.append(migrated)
+        if hot_changes:
+            self._hot_replace(hot_changes)
+        if self.archive is not None:
+            archive_changes = []
+            for record in self.archive.iter_messages(before_id=oldest_hot_id):
+                migrated = migrator.migrate(record)
+                if migrated is not None:
+                    archive_changes.append((record, migrated))
+            if archive_changes:
+                self.archive.replace(archive_changes)
+
+        self._set_schema_version(SCHEMA_VERSION)
+        migrator.report(str(self.path))
+        return migrator.changed
+
+    @abstractmethod
+    def _schema_version(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _set_schema_version(self, version):
+        raise NotImplementedError
+
+    def _migrate_layout(self, version):
+        """Зміни формату самого сховища (колонки, ID), що передують міграції записів"""
+
+    @abstractmethod
+    def _hot_replace(self, records):
+        """Замінює записи гарячого шару з тими самими ID"""
+        raise NotImplementedError
+
+    def rebuild_stats(self):
+        """Перераховує лічильники з історії разом з архівом (записи без created_at - без днів і годин)"""
+        self.stats.reset()
+        for msg in self.iter_messages():
+            when = record_time(msg)
+            if when is not None and self.stats.tz is not None:
+                when = when.astimezone(self.stats.tz)
+            self.stats.message_added(msg, when)
+        self._save_stats()
+
+    def refresh_stats(self):
+        """Перечитує лічильники, змінені іншими процесами (для спільного сховища)"""
+
+    @abstractmethod
+    def _load_stats(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    def _save_stats(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def fsync_directory(path):
+    """Фіксує на диску перейменування файлу в каталозі"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def write_json_atomic(path, data):
+    """Записує JSON через тимчасовий файл і перейменування з fsync"""
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    fsync_directory(path.parent)
+
+
+class MessageArchive:
+    """Архів старих повідомлень: стиснуті сегменти по одному на день
+
+    Сегмент - gzip-файл з рядками JSON. Дописування додає в кінець файлу
+    новий gzip-член, тому сегмент ніколи не переписується; зміна
+    заархівованого запису дописує його нову версію, і при читанні пізніший
+    рядок з тим самим ID перекриває попередній. Індекс (index.json) описує
+    кожен сегмент - діапазон ID, кількість записів і групи, - тож вибір
+    сегментів для запиту не потребує їх розпаковувати.
+    """
+
+    def __init__(self, directory, retention_days=0, tz=None):
+        self.directory = Path(directory)
+        self.index_path = self.directory / ARCHIVE_INDEX_FILE
+        # Скільки днів зберігати сегменти (0 - без обмеження)
+        self.retention_days = retention_days
+        # Часова зона для відліку днів зберігання
+        self.tz = tz
+        self._lock = threading.RLock()
+        # день -> {'min_id', 'max_id', 'count', 'groups'}
+        self._segments = {}
+        self._index_mtime = None
+        self._refresh()
+
+    def _segment_path(self, day):
+        return self.directory / f"{day}{SEGMENT_SUFFIX}"
+
+    def _refresh(self):
+        """Перечитує індекс, якщо його змінив інший процес"""
+        try:
+            mtime = self.index_path.stat().st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        if mtime is not None and mtime == self._index_mtime:
+            return
+        if mtime is None:
+            # Індекс втрачено, а сегменти лишились - відновлюємо його з сегментів
+            if self.directory.exists() and any(self.directory.glob(f"*{SEGMENT_SUFFIX}")):
+                self.rebuild_index()
+            else:
+                self._segments = {}
+            return
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                self._segments = json.load(f)['segments']
+        except (OSError, ValueError, KeyError) as e:
+            logger.error(f"Не вдалося прочитати індекс архіву {self.index_path}: {e}")
+            self.rebuild_index()
+            return
+        self._index_mtime = mtime
+
+    def _save_index(self):
+        write_json_atomic(self.index_path, {'segments': self._segments})
+        self._index_mtime = self.index_path.stat().st_mtime_ns
+
+    def rebuild_index(self):
+        """Перебудовує індекс, розпаковуючи всі сегменти"""
+        with self._lock:
+            self._segments = {}
+            for path in sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}")):
+                day = path.name[:-len(SEGMENT_SUFFIX)]
+                records = self._read_segment(day)
+                if records:
+                    self._segments[day] = self._describe(records)
+            self._save_index()
+        logger.info(f"Індекс архіву {self.directory} перебудовано: {len(self._segments)} сегментів")
+
+    @staticmethod
+    def _describe(records, meta=None):
+        """Додає записи до опису сегмента"""
+        meta = dict(meta) if meta else {'min_id': None, 'max_id': None, 'count': 0, 'groups': []}
+        ids = [record['id'] for record in records]
+        meta['min_id'] = min(ids) if meta['min_id'] is None else min(meta['min_id'], *ids)
+        meta['max_id'] = max(ids) if meta['max_id'] is None else max(meta['max_id'], *ids)
+        meta['count'] += len(records)
+        groups = set(meta['groups'])
+        groups.update(record['chat_id'] for record in records if record.get('chat_type') in GROUP_CHAT_TYPES)
+        meta['groups'] = sorted(groups)
+        return meta
+
+    def _read_segment(self, day):
+        """Розпаковує сегмент; повертає записи в порядку зростання ID"""
+        records = {}
+        try:
+            with gzip.open(self._segment_path(day), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        logger.warning(f"Пошкоджений рядок в архіві {day} пропущено: {line[:80]}")
+                        continue
+                    records[record['id']] = record
+        except FileNotFoundError:
+            return []
+        except (OSError, EOFError) as e:
+            # Недописаний останній gzip-член після збою: все, що прочитано до нього, лишається
+            logger.error(f"Сегмент архіву {day} прочитано не повністю: {e}")
+        return [records[message_id] for message_id in sorted(records)]
+
+    def _write_member(self, day, records):
+        """Дописує записи в сегмент одним gzip-членом і фіксує на диску"""
+        payload = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        # Один виклик write: член не перемішається з дописуванням з іншого процесу
+        data = gzip.compress(payload.encode('utf-8'))
+        with open(self._segment_path(day), 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _write_segment(self, day, records):
+        """Переписує сегмент цілком (через тимчасовий файл); порожній - видаляє"""
+        path = self._segment_path(day)
+        if not records:
+            self._segments.pop(day, None)
+            path.unlink(missing_ok=True)
+            return
+        tmp_path = path.with_name(path.name + '.tmp')
+        payload = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        with open(tmp_path, 'wb') as f:
+            f.write(gzip.compress(payload.encode('utf-8')))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        self._segments[day] = self._describe(records)
+
+    def replace(self, changes):
+        """Замінює записи новими версіями [(старий, новий), ...] (для міграції схеми)
+
+        Запис, у якого змінився день, переноситься в сегмент нового дня.
+        """
+        with self._lock:
+            self._refresh()
+            by_segment = {}
+            for original, migrated in changes:
+                by_segment.setdefault(record_day(original), {})[original['id']] = migrated
+            for day, replaced in by_segment.items():
+                kept, moved = [], {}
+                for record in self._read_segment(day):
+                    record = replaced.get(record['id'], record)
+                    if record_day(record) == day:
+                        kept.append(record)
+                    else:
+                        moved.setdefault(record_day(record), []).append(record)
+                # Спершу дописуємо перенесені записи, потім переписуємо старий сегмент
+                for new_day, records in moved.items():
+                    self._write_member(new_day, records)
+                    self._segments[new_day] = self._describe(records, self._segments.get(new_day))
+                self._write_segment(day, kept)
+            self._save_index()
+
+    def _ordered_segments(self):
+        """Сегменти від найновіших ID до найстаріших"""
+        return sorted(self._segments.items(), key=lambda item: item[1]['max_id'], reverse=True)
+
+    def append(self, records):
+        """Переносить записи в сегменти їхніх днів; повертає кількість перенесених
+
+        Записи, чиї ID уже покриває сегмент того ж дня, пропускаються: так
+        повторне перенесення після збою (архів дописано, а гарячий шар ще
+        не очищено) не дублює історію.
+        """
+        with self._lock:
+            self._refresh()
+            by_day = {}
+            for record in records:
+                day = record_day(record)
+                meta = self._segments.get(day)
+                if meta is not None and meta['min_id'] <= record['id'] <= meta['max_id']:
+                    continue
+                by_day.setdefault(day, []).append(record)
+            if not by_day:
+                return 0
+            self.directory.mkdir(parents=True, exist_ok=True)
+            for day, day_records in by_day.items():
+                self._write_member(day, day_records)
+                self._segments[day] = self._describe(day_records, self._segments.get(day))
+            self._save_index()
+            return sum(len(day_records) for day_records in by_day.values())
+
+    def get(self, message_id):
+        with self._lock:
+            self._refresh()
+            days = [
+                day for day, meta in self._ordered_segments()
+                if meta['min_id'] <= message_id <= meta['max_id']
+            ]
+        for day in days:
+            for record in self._read_segment(day):
+                if record['id'] == message_id:
+                    return record
+        return None
+
+    def update(self, message_id, **fields):
+        """Дописує нову версію заархівованого запису; False, якщо його немає"""
+        with self._lock:
+            record = self.get(message_id)
+            if record is None:
+                return False
+            self._write_member(record_day(record), [{**record, **fields}])
+            return True
+
+    def update_where(self, selection, fields):
+        """Дописує нові версії всіх записів вибору; повертає [(ID, попередній статус), ...]
+
+        Відкриваються тільки сегменти, чиї діапазони ID перетинаються з вибором.
+        """
+        with self._lock:
+            self._refresh()
+            bounds = selection.id_bounds()
+            days = [
+                day for day, meta in self._segments.items()
+                if bounds is None or (meta['min_id'] <= bounds[1] and meta['max_id'] >= bounds[0])
+            ]
+            changed = []
+            for day in days:
+                records = [record for record in self._read_segment(day) if selection.matches(record)]
+                if records:
+                    self._write_member(day, [{**record, **fields} for record in records])
+                    changed.extend((record['id'], record.get('status')) for record in records)
+            return changed
+
+    def iter_messages(self, before_id=None):
+        """Повідомлення від найновішого до найстарішого; сегменти розпаковуються по черзі"""
+        with self._lock:
+            self._refresh()
+            segments = self._ordered_segments()
+        for day, meta in segments:
+            if before_id is not None and meta['min_id'] >= before_id:
+                continue
+            for record in reversed(self._read_segment(day)):
+                if before_id is None or record['id'] < before_id:
+                    yield record
+
+    def iter_messages_after(self, after_id):
+        """Повідомлення з ID більшим за after_id, від найстарішого; решта сегментів не відкривається"""
+        with self._lock:
+            self._refresh()
+            segments = sorted(
+                (item for item in self._segments.items() if item[1]['max_id'] > after_id),
+                key=lambda item: item[1]['min_id']
+            )
+        for day, meta in segments:
+            for record in self._read_segment(day):
+                if record['id'] > after_id:
+                    yield record
+
+    def messages_between(self, start, end):
+        """Повідомлення з created_at у [start, end), у хронологічному порядку"""
+        # Межі розширено на день: день сегмента рахується в часовій зоні запису
+        first_day = (start - timedelta(days=1)).strftime('%Y-%m-%d')
+        last_day = (end + timedelta(days=1)).strftime('%Y-%m-%d')
+        with self._lock:
+            self._refresh()
+            days = sorted(
+                day for day in self._segments
+                if day != UNDATED_SEGMENT and first_day <= day <= last_day
+            )
+        messages = []
+        for day in days:
+            for record in self._read_segment(day):
+                when = record_time(record)
+                if when is not None and start <= when < end:
+                    messages.append(record)
+        messages.sort(key=lambda record: (record_time(record), record['id']))
+        return messages
+
+    def group_chat_ids(self):
+        with self._lock:
+            self._refresh()
+            return {chat_id for meta in self._segments.values() for chat_id in meta['groups']}
+
+    def max_id(self):
+        with self._lock:
+            self._refresh()
+            return max((meta['max_id'] for meta in self._segments.values()), default=0)
+
+    def count(self):
+        """Кількість записів за індексом (без розпаковування)"""
+        with self._lock:
+            self._refresh()
+            return sum(meta['count'] for meta in self._segments.values())
+
+    def is_empty(self):
+        with self._lock:
+            self._refresh()
+            return not self._segments
+
+    def prune(self, today=None):
+        """Видаляє сегменти, старші за retention_days; повертає кількість видалених"""
+        if not self.retention_days:
+            return 0
+        if today is None:
+            today = datetime.now(self.tz).date()
+        oldest_day = (today - timedelta(days=self.retention_days)).strftime('%Y-%m-%d')
+        with self._lock:
+            self._refresh()
+            expired = [day for day in self._segments if day != UNDATED_SEGMENT and day < oldest_day]
+            if not expired:
+                return 0
+            for day in expired:
+                del self._segments[day]
+            # Спершу індекс: сегмент без запису в індексі вже не читається
+            self._save_index()
+            for day in expired:
+                self._segment_path(day).unlink(missing_ok=True)
+        logger.info(f"З архіву видалено {len(expired)} сегментів, старших за {oldest_day}")
+        return len(expired)
+
+    def clear_chat(self, chat_id):
+        """Переписує сегменти з повідомленнями групи без них; повертає видалені записи
+
+        Відкриваються тільки сегменти, в індексі яких є ця група.
+        """
+        with self._lock:
+            self._refresh()
+            days = [day for day, meta in self._segments.items() if chat_id in meta['groups']]
+            removed = []
+            for day in days:
+                kept = []
+                for record in self._read_segment(day):
+                    (removed if record.get('chat_id') == chat_id else kept).append(record)
+                self._write_segment(day, kept)
+            if days:
+                self._save_index()
+            return removed
+
+    def clear(self):
+        with self._lock:
+            self._segments = {}
+            if not self.directory.exists():
+                return
+            self._save_index()
+            for path in self.directory.glob(f"*{SEGMENT_SUFFIX}"):
+                path.unlink(missing_ok=True)
+
+
+class JsonlMessageStore(MessageStore):
+    """Append-only журнал повідомлень з фоновою компакцією
+
+    Компакція залишає в журналі останні max_records повідомлень, а старіші
+    переносить в архів (якщо його задано) або відкидає.
+    """
+
+    def __init__(self, path, max_records=DEFAULT_MAX_RECORDS, legacy_path=None, stats_tz=None, archive=None):
+        self.path = Path(path)
+        self.stats_path = self.path.with_name(self.path.name + '.stats.json')
+        self.max_records = max_records
+        self.archive = archive
+        self._lock = threading.RLock()
+        self._appended_since_compaction = 0
+        # Відкритий файл поточного пакета змін (див. apply_batch)
+        self._batch_file = None
+        # Рядки зміни пакета, що виконується зараз (див. _mutation)
+        self._pending_lines = None
+        # Версія схеми журналу - у рядку-заголовку на початку файлу
+        self.schema_version = self._read_schema_version()
+
+        if not self.path.exists():
+            if legacy_path and Path(legacy_path).exists():
+                self._import_legacy(Path(legacy_path), stats_tz)
+            else:
+                self._write_atomic([])
+
+        self._last_id = self._read_last_id()
+        if self.archive is not None:
+            self._last_id = max(self._last_id, self.archive.max_id())
+        changed = self.migrate(stats_tz)
+        # Мігровані записи могли змінити статуси і дні - лічильники рахуються наново
+        self._init_stats(stats_tz, rebuild=bool(changed))
+
+    def _read_schema_version(self):
+        """Версія з першого рядка журналу; журнал без заголовка - версія 0, новий - поточна"""
+        if not self.path.exists():
+            return SCHEMA_VERSION
+        with open(self.path, 'r', encoding='utf-8') as f:
+            first_line = f.readline()
+        try:
+            header = json.loads(first_line)
+        except ValueError:
+            return 0
+        if isinstance(header, dict) and header.get('op') == 'schema':
+            return header['version']
+        return 0
+
+    def _import_legacy(self, legacy_path, tz):
+        """Переносить старий messages_history.json у журнал"""
+        try:
+            messages = load_legacy_messages(legacy_path, tz)
+        except (OSError, ValueError) as e:
+            logger.error(f"Не вдалося прочитати {legacy_path}: {e}")
+            self._write_atomic([])
+            return
+
+        self._write_atomic(messages)
+        logger.info(f"Перенесено {len(messages)} повідомлень з {legacy_path} у {self.path}")
+
+    def _read_last_id(self):
+        """Знаходить останній виданий ID, читаючи тільки кінець файлу"""
+        if not self.path.exists():
+            return 0
+        for line in iter_lines_reversed(self.path):
+            record = self._parse(line)
+            if record and record.get('op') in (None, 'id_mark') and 'id' in record:
+                return record['id']
+        return 0
+
+    def _id_mark(self):
+        """Рядок з останнім виданим ID: після очищення чи компакції ID не почнуться спочатку"""
+        return {'op': 'id_mark', 'id': self._last_id}
+
+    def _schema_version(self):
+        return self.schema_version
+
+    def _set_schema_version(self, version):
+        # Заголовок - перший рядок файлу, тому журнал переписується
+        with self._lock:
+            self.schema_version = version
+            self._rewrite()
+
+    def _migrate_layout(self, version):
+        if version < 1:
+            # Старий бот видавав ID як len(messages) + 1, тож після обрізання вони повторювались
+            with self._lock:
+                records = list(self._hot_iter())
+                records.reverse()
+                if assign_ids(records):
+                    self._last_id = max(self._last_id, records[-1]['id'])
+                    self._write_atomic([self._id_mark(), *records])
+
+    def _hot_replace(self, records):
+        with self._lock:
+            self._rewrite({record['id']: record for record in records})
+
+    def _rewrite(self, replaced=None):
+        """Переписує журнал з уже застосованими патчами і заміненими записами"""
+        records = [(replaced or {}).get(record['id'], record) for record in self._hot_iter()]
+        records.reverse()
+        self._write_atomic([self._id_mark(), *records])
+
+    @staticmethod
+    def _parse(line):
+        try:
+            return json.loads(line)
+        except ValueError:
+            logger.warning(f"Пошкоджений рядок у журналі повідомлень пропущено: {line[:80]}")
+            return None
+
+    def _append_line(self, record):
+        line = json.dumps(record, ensure_ascii=False) + '\n'
+        if self._pending_lines is not None:
+            # Рядки зміни пакета потрапляють у файл, тільки коли вся зміна вдалась
+            self._pending_lines.append(line)
+            return
+        if self._batch_file is not None:
+            # fsync буде один на весь пакет
+            self._batch_file.write(line)
+            self._batch_file.flush()
+            return
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    @contextmanager
+    def _mutation(self):
+        last_id, appended = self._last_id, self._appended_since_compaction
+        self._pending_lines = []
+        try:
+            yield
+            if self._pending_lines:
+                # fsync буде один на весь пакет
+                self._batch_file.write(''.join(self._pending_lines))
+                self._batch_file.flush()
+        except BaseException:
+            self._last_id, self._appended_since_compaction = last_id, appended
+            raise
+        finally:
+            self._pending_lines = None
+
+    def apply_batch(self, mutations):
+        """Дописує всі зміни пакета і робить один fsync"""
+        with self._lock:
+            self._batch_file = open(self.path, 'a', encoding='utf-8')
+            try:
+                results = super().apply_batch(mutations)
+                self._batch_file.flush()
+                os.fsync(self._batch_file.fileno())
+            finally:
+                self._batch_file.close()
+                self._batch_file = None
+            if self.stats.has_changes():
+                self._save_stats()
+        return results
+
+    def _load_stats(self):
+        if not self.stats_path.exists():
+            return
+        try:
+            with open(self.stats_path, 'r', encoding='utf-8') as f:
+                self.stats.load(json.load(f))
+        except (OSError, ValueError) as e:
+            logger.error(f"Не вдалося прочитати статистику {self.stats_path}: {e}")
+
+    def _save_stats(self):
+        self.stats.take_changes()
+        write_json_atomic(self.stats_path, self.stats.snapshot())
+
+    def add(self, record):
+        """Дописує нове повідомлення в кінець журналу і повертає його ID"""
+        with self._lock:
+            self._last_id += 1
+            record = {'id': self._last_id, **record}
+            self._append_line(record)
+            self._appended_since_compaction += 1
+            return self._last_id
+
+    def import_messages(self, messages):
+        with self._lock:
+            for msg in messages:
+                self._append_line(msg)
+                self._last_id = max(self._last_id, msg['id'])
+                self._appended_since_compaction += 1
+        return messages
+
+    def _hot_update_where(self, selection, fields):
+        """Дописує патчі для всіх записів вибору за один прохід журналу"""
+        with self._lock:
+            changed = []
+            for record in self._hot_iter():
+                if selection.matches(record):
+                    self._append_line({'op': 'patch', 'id': record['id'], 'fields': fields})
+                    changed.append((record['id'], record.get('status')))
+        return changed
+
+    def _hot_update(self, message_id, **fields):
+        """Дописує патч для повідомлення з журналу"""
+        with self._lock:
+            if self._hot_get(message_id) is None:
+                return False
+            self._append_line({'op': 'patch', 'id': message_id, 'fields': fields})
+        return True
+
+    def _hot_iter(self):
+        """Повертає повідомлення журналу від найновішого до найстарішого з урахуванням патчів"""
+        if not self.path.exists():
+            return
+        # Патчі записані пізніше за повідомлення, тому при читанні з кінця
+        # вони зустрічаються раніше і застосовуються, коли дійдемо до запису
+        pending = {}
+        for line in iter_lines_reversed(self.path):
+            record = self._parse(line)
+            if not record:
+                continue
+            if record.get('op') == 'patch':
+                fields = pending.setdefault(record['id'], {})
+                for key, value in record['fields'].items():
+                    fields.setdefault(key, value)
+                continue
+            if record.get('op') is not None:
+                continue
+            record.update(pending.pop(record.get('id'), {}))
+            yield record
+
+    def _hot_get(self, message_id):
+        """Шукає повідомлення за ID, читаючи журнал з кінця"""
+        for record in self._hot_iter():
+            if record.get('id') == message_id:
+                return record
+        return None
+
+    def _hot_clear(self):
+        """Очищує журнал, залишаючи в ньому тільки останній виданий ID"""
+        with self._lock:
+            if self.path.exists():
+                if self._batch_file is not None:
+                    self._batch_file.truncate(0)
+                    self._batch_file.write(json.dumps(self._schema_header()) + '\n')
+                    self._batch_file.write(json.dumps(self._id_mark()) + '\n')
+                else:
+                    self._write_atomic([self._id_mark()])
+            self._appended_since_compaction = 0
+
+    def _hot_clear_chat(self, chat_id):
+        """Переписує журнал без повідомлень чату (патчі при цьому застосовуються)"""
+        with self._lock:
+            removed, kept = [], []
+            for record in self._hot_iter():
+                (removed if record.get('chat_id') == chat_id else kept).append(record)
+            if removed:
+                kept.reverse()
+                self._write_atomic([self._id_mark(), *kept])
+                if self._batch_file is not None:
+                    # Файл замінено - решта пакета пишеться вже в новий
+                    self._batch_file.close()
+                    self._batch_file = open(self.path, 'a', encoding='utf-8')
+            return removed
+
+    def needs_compaction(self):
+        return self._appended_since_compaction >= self.max_records
+
+    def maintenance(self):
+        if self.needs_compaction():
+            self.compact()
+        super().maintenance()
+
+    def compact(self):
+        """Переписує журнал: застосовує патчі та залишає останні max_records повідомлень
+
+        Старіші повідомлення спершу дописуються в архів, і тільки потім
+        журнал замінюється, тож збій між цими кроками нічого не втрачає.
+        """
+        with self._lock:
+            if not self.path.exists():
+                return
+            # Журнал між компакціями не більший за 2 * max_records записів
+            messages = list(self._hot_iter())
+            overflow = messages[self.max_records:]
+            messages = messages[:self.max_records]
+            messages.reverse()
+            archived = 0
+            if overflow and self.archive is not None:
+                overflow.reverse()
+                for start in range(0, len(overflow), ARCHIVE_CHUNK_SIZE):
+                    archived += self.archive.append(overflow[start:start + ARCHIVE_CHUNK_SIZE])
+            self._write_atomic([self._id_mark(), *messages])
+            if self._batch_file is not None:
+                # Файл замінено - решта пакета пишеться вже в новий
+                self._batch_file.close()
+                self._batch_file = open(self.path, 'a', encoding='utf-8')
+            self._appended_since_compaction = 0
+        logger.info(f"Журнал повідомлень ущільнено: {len(messages)} записів, в архів перенесено {archived}")
+
+    def _schema_header(self):
+        return {'op': 'schema', 'version': self.schema_version}
+
+    def _write_atomic(self, messages):
+        """Замінює журнал записами messages; першим рядком іде заголовок зі схемою"""
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(self._schema_header()) + '\n')
+            for msg in messages:
+                f.write(json.dumps(msg, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        fsync_directory(self.path.parent)
+
+
+class SqliteMessageStore(MessageStore):
+    """Історія повідомлень у SQLite (режим WAL, індекси для частих запитів)
+
+    Якщо задано архів, обслуговування переносить у нього все, що старіше
+    за останні max_records повідомлень; без архіву таблиця не обмежується.
+    """
+
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_name TEXT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            chat_type TEXT,
+            message_text TEXT,
+            timestamp TEXT,
+            status TEXT,
+            replied_by INTEGER,
+            reply_timestamp TEXT,
+            created_at TEXT
+        )""",
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages (chat_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_chat_type ON messages (chat_type)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_status ON messages (status)",
+        "CREATE INDEX IF NOT EXISTS idx_messages_timestamp ON messages (timestamp)",
+        """CREATE TABLE IF NOT EXISTS message_stats (
+            dimension TEXT NOT NULL,
+            key TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            PRIMARY KEY (dimension, key)
+        )""",
+    )
+
+    def __init__(self, path, legacy_path=None, stats_tz=None, max_records=None, archive=None):
+        self.path = Path(path)
+        self.max_records = max_records
+        self.archive = archive
+        is_new = not self.path.exists()
+        # З'єднання використовується і з потоків виконавця, тому доступ серіалізуємо замком
+        self._lock = threading.RLock()
+        self._in_batch = False
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # Інші процеси бота можуть тримати блокування запису (спільне сховище)
+        self._conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        # Коміти групуються StoreWriter, тому можна дозволити fsync на кожен
+        self._conn.execute("PRAGMA synchronous=FULL")
+        with self._conn:
+            for statement in self.SCHEMA:
+                self._conn.execute(statement)
+
+        if is_new and legacy_path and Path(legacy_path).exists():
+            try:
+                messages = load_legacy_messages(Path(legacy_path), stats_tz)
+            except (OSError, ValueError) as e:
+                logger.error(f"Не вдалося прочитати {legacy_path}: {e}")
+            else:
+                self.import_messages(messages)
+                logger.info(f"Перенесено {len(messages)} повідомлень з {legacy_path} у {self.path}")
+
+        changed = self.migrate(stats_tz)
+        # Мігровані записи могли змінити статуси і дні - лічильники рахуються наново
+        self._init_stats(stats_tz, rebuild=bool(changed))
+
+    @contextmanager
+    def _transaction(self):
+        """Транзакція для однієї зміни; всередині apply_batch - спільна для пакета"""
+        with self._lock:
+            if self._in_batch:
+                yield
+                return
+            with self._conn:
+                yield
+
+    @contextmanager
+    def _mutation(self):
+        # Точка збереження поза транзакцією сама стала б транзакцією і комітилась би на RELEASE
+        if not self._conn.in_transaction:
+            self._conn.execute("BEGIN")
+        self._conn.execute("SAVEPOINT mutation")
+        try:
+            yield
+        except BaseException:
+            self._conn.execute("ROLLBACK TO mutation")
+            raise
+        finally:
+            self._conn.execute("RELEASE mutation")
+
+    def apply_batch(self, mutations):
+        """Виконує весь пакет змін в одній транзакції"""
+        with self._lock:
+            self._in_batch = True
+            try:
+                with self._conn:
+                    results = super().apply_batch(mutations)
+                    # Лічильники фіксуються в тій самій транзакції, що й повідомлення
+                    if self.stats.has_changes():
+                        self._save_stats()
+                    return results
+            finally:
+                self._in_batch = False
+
+    def migrate(self, tz=None):
+        """Міграція в одній транзакції з блокуванням запису: інші процеси чекають і бачать нову версію"""
+        with self._lock:
+            self._in_batch = True
+            try:
+                with self._conn:
+                    self._conn.execute("BEGIN IMMEDIATE")
+                    return super().migrate(tz)
+            finally:
+                self._in_batch = False
+
+    def _schema_version(self):
+        return self._conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def _set_schema_version(self, version):
+        self._conn.execute(f"PRAGMA user_version = {int(version)}")
+
+    def _migrate_layout(self, version):
+        columns = {row['name'] for row in self._conn.execute("PRAGMA table_info(messages)")}
+        if 'created_at' not in columns:
+            self._conn.execute("ALTER TABLE messages ADD COLUMN created_at TEXT")
+
+    def _hot_replace(self, records):
+        columns = [field for field in MESSAGE_FIELDS if field != 'id']
+        assignments = ', '.join(f"{field} = ?" for field in columns)
+        self._conn.executemany(
+            f"UPDATE messages SET {assignments} WHERE id = ?",
+            [[*(record.get(field) for field in columns), record['id']] for record in records]
+        )
+
+    def _load_stats(self):
+        with self._lock:
+            rows = self._conn.execute("SELECT dimension, key, count FROM message_stats").fetchall()
+        self.stats.load_rows([tuple(row) for row in rows])
+
+    def _save_stats(self):
+        cleared, changes = self.stats.take_changes()
+        with self._transaction():
+            if cleared:
+                self._conn.execute("DELETE FROM message_stats")
+            # Прирости замість значень: лічильники можуть оновлювати кілька процесів
+            self._conn.executemany(
+                "INSERT INTO message_stats (dimension, key, count) VALUES (?, ?, ?) "
+                "ON CONFLICT (dimension, key) DO UPDATE SET count = count + excluded.count",
+                changes
+            )
+
+    def refresh_stats(self):
+        with self._lock:
+            self._load_stats()
+
+    @staticmethod
+    def _row_to_dict(row):
+        return dict(row) if row is not None else None
+
+    def add(self, record):
+        columns = [field for field in MESSAGE_FIELDS if field != 'id']
+        placeholders = ', '.join('?' for _ in columns)
+        with self._transaction():
+            cursor = self._conn.execute(
+                f"INSERT INTO messages ({', '.join(columns)}) VALUES ({placeholders})",
+                [record.get(field) for field in columns]
+            )
+            return cursor.lastrowid
+
+    def import_messages(self, messages):
+        placeholders = ', '.join('?' for _ in MESSAGE_FIELDS)
+        imported = []
+        with self._transaction():
+            for msg in messages:
+                cursor = self._conn.execute(
+                    f"INSERT OR IGNORE INTO messages ({', '.join(MESSAGE_FIELDS)}) VALUES ({placeholders})",
+                    [msg.get(field) for field in MESSAGE_FIELDS]
+                )
+                # Записи з уже наявними ID пропускаються
+                if cursor.rowcount:
+                    imported.append(msg)
+        return imported
+
+    def _hot_get(self, message_id):
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM messages WHERE id = ?", (message_id,)).fetchone()
+        return self._row_to_dict(row)
+
+    def _hot_update(self, message_id, **fields):
+        unknown = set(fields) - set(MESSAGE_FIELDS)
+        if unknown:
+            raise ValueError(f"Невідомі поля повідомлення: {', '.join(sorted(unknown))}")
+        assignments = ', '.join(f"{field} = ?" for field in fields)
+        with self._transaction():
+            cursor = self._conn.execute(
+                f"UPDATE messages SET {assignments} WHERE id = ?",
+                [*fields.values(), message_id]
+            )
+            return cursor.rowcount > 0
+
+    def recent(self, limit=10):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM messages ORDER BY id DESC LIMIT ?", (limit,)
+            ).fetchall()
+        messages = [dict(row) for row in rows]
+        if len(messages) < limit and self.archive is not None:
+            before_id = messages[-1]['id'] if messages else None
+            messages.extend(itertools.islice(self.archive.iter_messages(before_id), limit - len(messages)))
+        messages.reverse()
+        return messages
+
+    def _hot_iter(self):
+        # Частинами за ID, щоб не тримати в пам'яті всю таблицю
+        before_id = None
+        while True:
+            with self._lock:
+                if before_id is None:
+                    rows = self._conn.execute(
+                        "SELECT * FROM messages ORDER BY id DESC LIMIT ?", (ARCHIVE_CHUNK_SIZE,)
+                    ).fetchall()
+                else:
+                    rows = self._conn.execute(
+                        "SELECT * FROM messages WHERE id < ? ORDER BY id DESC LIMIT ?",
+                        (before_id, ARCHIVE_CHUNK_SIZE)
+                    ).fetchall()
+            for row in rows:
+                yield dict(row)
+            if len(rows) < ARCHIVE_CHUNK_SIZE:
+                return
+            before_id = rows[-1]['id']
+
+    def _hot_update_where(self, selection, fields):
+        """Один UPDATE за індексами; попередні статуси читаються в тій самій транзакції"""
+        where, params = selection.where()
+        assignments = ', '.join(f"{field} = ?" for field in fields)
+        with self._transaction():
+            rows = self._conn.execute(f"SELECT id, status FROM messages WHERE {where}", params).fetchall()
+            if rows:
+                self._conn.execute(f"UPDATE messages SET {assignments} WHERE {where}", [*fields.values(), *params])
+        return [(row['id'], row['status']) for row in rows]
+
+    def _hot_query(self, limit, before_id, after_id, filters):
+        # Поля фільтрів перевірено в query, тож їх можна підставляти в запит
+        conditions = [f"{field} = ?" for field in filters]
+        params = list(filters.values())
+        if before_id is not None:
+            conditions.append("id < ?")
+            params.append(before_id)
+        if after_id is not None:
+            conditions.append("id > ?")
+            params.append(after_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        order = 'ASC' if after_id is not None else 'DESC'
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM messages {where} ORDER BY id {order} LIMIT ?", [*params, limit]
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def _hot_is_empty(self):
+        with self._lock:
+            return self._conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone() is None
+
+    def _hot_group_chat_ids(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT DISTINCT chat_id FROM messages WHERE chat_type IN (?, ?)", GROUP_CHAT_TYPES
+            ).fetchall()
+        return {row['chat_id'] for row in rows}
+
+    def _hot_clear(self):
+        # AUTOINCREMENT не видає повторно ID видалених рядків
+        with self._transaction():
+            self._conn.execute("DELETE FROM messages")
+
+    def _hot_clear_chat(self, chat_id):
+        with self._transaction():
+            rows = self._conn.execute("SELECT * FROM messages WHERE chat_id = ?", (chat_id,)).fetchall()
+            if rows:
+                self._conn.execute("DELETE FROM messages WHERE chat_id = ?", (chat_id,))
+        return [self._row_to_dict(row) for row in rows]
+
+    def maintenance(self):
+        if self.archive is not None and self.max_records:
+            self.archive_overflow()
+        super().maintenance()
+        with self._lock:
+            self._conn.execute("PRAGMA optimize")
+
+    def archive_overflow(self):
+        """Переносить в архів найстаріші повідомлення понад max_records; повертає їх кількість"""
+        archived = 0
+        with self._lock:
+            (count,) = self._conn.execute("SELECT COUNT(*) FROM messages").fetchone()
+            excess = count - self.max_records
+            while excess > 0:
+                rows = self._conn.execute(
+                    "SELECT * FROM messages ORDER BY id LIMIT ?", (min(excess, ARCHIVE_CHUNK_SIZE),)
+                ).fetchall()
+                if not rows:
+                    break
+                records = [dict(row) for row in rows]
+                # Спершу архів, потім видалення: повтор після збою архів пропустить
+                self.archive.append(records)
+                with self._transaction():
+                    self._conn.execute("DELETE FROM messages WHERE id <= ?", (records[-1]['id'],))
+                archived += len(records)
+                excess -= len(records)
+        if archived:
+            logger.info(f"В архів перенесено {archived} повідомлень")
+        return archived
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+# Функція для створення сховища за назвою бекенду
+def open_message_store(backend, path, legacy_path=None, max_records=DEFAULT_MAX_RECORDS, stats_tz=None,
+                       archive_dir=None, archive_retention_days=0):
+    """Створює сховище історії: 'sqlite' або 'json'
+
+    max_records - розмір гарячого шару; старіші повідомлення переносяться в
+    архів archive_dir (якщо він заданий) і зберігаються archive_retention_days
+    днів (0 - без обмеження). Без архіву JSON-бекенд відкидає старі записи,
+    а SQLite не обмежується. stats_tz - часова зона, в якій статистика
+    рахує календарні дні та години.
+    """
+    archive = None
+    if archive_dir:
+        archive = MessageArchive(archive_dir, retention_days=archive_retention_days, tz=stats_tz)
+    if backend == 'sqlite':
+        return SqliteMessageStore(
+            path, legacy_path=legacy_path, stats_tz=stats_tz,
+            max_records=max_records if archive is not None else None, archive=archive
+        )
+    if backend == 'json':
+        return JsonlMessageStore(
+            path, max_records=max_records, legacy_path=legacy_path, stats_tz=stats_tz, archive=archive
+        )
+    raise ValueError(f"Невідомий бекенд сховища повідомлень: {backend}")
+
+
+# Функція для одноразового перенесення старої історії
+def import_json_history(json_path, store):
+    """Переносить повідомлення з messages_history.json у сховище, повертає їх кількість"""
+    messages = load_legacy_messages(json_path)
+    # Через apply_batch, щоб разом із записами оновилась і статистика
+    results = store.apply_batch([('import_messages', (messages,), {})])
+    if isinstance(results[0], Exception):
+        raise results[0]
+    return len(results[0])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Інструменти сховища історії повідомлень")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    import_parser = subparsers.add_parser('import', help="перенести messages_history.json у сховище")
+    import_parser.add_argument('json_path')
+    import_parser.add_argument('--backend', choices=['sqlite', 'json'], default='sqlite')
+    import_parser.add_argument('--path', default='messages.db')
+    args = parser.parse_args(argv)
+
+    store = open_message_store(args.backend, args.path)
+    try:
+        count = import_json_history(args.json_path, store)
+    finally:
+        store.close()
+    print(f"Перенесено {count} повідомлень у {args.path}")
+
+
+if __name__ == '__main__':
+    main()
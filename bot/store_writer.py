@@ -0,0 +1,104 @@
+"""
+Єдиний записувач сховища історії.
+
+Всі зміни сховища проходять через одну asyncio-задачу: обробники кладуть
+операцію в чергу і отримують future з результатом. Записувач збирає всі
+операції, що надійшли за коротке вікно, і застосовує їх одним комітом
+у потоці виконавця, тому диск не блокує цикл подій, а дві одночасні зміни
+не можуть перезаписати одна одну.
+"""
+
+import asyncio
+import logging
+
+from bot.metrics import STORE_ERRORS, STORE_SECONDS, timer
+from bot.storage import MUTATIONS
+
+logger = logging.getLogger(__name__)
+
+# Вікно накопичення пакета змін (секунди)
+DEFAULT_BATCH_WINDOW = 0.05
+
+# Максимальна кількість змін в одному коміті
+DEFAULT_MAX_BATCH = 500
+
+
+class StoreWriter:
+    """Asyncio-актор, що серіалізує та групує зміни сховища"""
+
+    def __init__(self, store, batch_window=DEFAULT_BATCH_WINDOW, max_batch=DEFAULT_MAX_BATCH):
+        self.store = store
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self._queue = None
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    def queue_size(self):
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self):
+        """Запускає задачу записувача в поточному циклі подій"""
+        if self.running:
+            return
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run(), name='store-writer')
+
+    async def stop(self):
+        """Дописує все, що залишилось у черзі, і зупиняє записувач"""
+        if not self.running:
+            return
+        await self._queue.put(None)
+        await self._task
+        self._task = None
+
+    def submit(self, operation, *args, **kwargs):
+        """Ставить зміну в чергу; повертає future, що завершиться після коміту"""
+        if operation not in MUTATIONS:
+            raise ValueError(f"Невідома операція сховища: {operation}")
+        if not self.running:
+            raise RuntimeError("Записувач сховища не запущено")
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((operation, args, kwargs, future))
+        return future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+        while not stopping:
+            item = await self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+
+            # Даємо іншим змінам накопичитись і забираємо все, що встигло прийти
+            await asyncio.sleep(self.batch_window)
+            while len(batch) < self.max_batch and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+
+            await self._commit(loop, batch)
+
+    async def _commit(self, loop, batch):
+        mutations = [(operation, args, kwargs) for operation, args, kwargs, _ in batch]
+        try:
+            with timer(STORE_SECONDS, operation='commit'):
+                results = await loop.run_in_executor(None, self.store.apply_batch, mutations)
+        except Exception as e:
+            logger.error(f"Помилка коміту пакета змін сховища ({len(batch)} змін): {e}")
+            STORE_ERRORS.inc(operation='commit')
+            results = [e] * len(batch)
+
+        for (_, _, _, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,244 @@
+"""
+Режим webhook: вбудований HTTP-сервер для оновлень від Telegram.
+
+Замість довгого опитування getUpdates Telegram сам надсилає оновлення
+POST-запитами. Сервер перевіряє секретний токен із заголовка
+X-Telegram-Bot-Api-Secret-Token, обмежує кількість одночасних з'єднань і
+кладе оновлення в ту саму чергу Application, з якої їх бере run_polling,
+тож обробляють їх ті самі обробники.
+
+Сервер можна перевірити локально без Telegram, надіславши записані
+оновлення:
+
+    python -m bot.webhook post update.json --url http://127.0.0.1:8443/telegram --secret ...
+"""
+
+import argparse
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import urllib.error
+import urllib.request
+from http import HTTPStatus
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+# Telegram за замовчуванням відкриває до 40 одночасних з'єднань
+DEFAULT_MAX_CONNECTIONS = 40
+
+# Максимальний розмір тіла запиту (байти); оновлення значно менші
+MAX_BODY_SIZE = 1024 * 1024
+
+# Скільки секунд чекати наступного запиту на відкритому з'єднанні
+IDLE_TIMEOUT = 60
+
+
+class WebhookServer:
+    """HTTP-сервер, що приймає оновлення Telegram і передає їх в Application"""
+
+    def __init__(self, application, url_path, secret_token=None,
+                 max_connections=DEFAULT_MAX_CONNECTIONS, listen='0.0.0.0', port=8443):
+        self.application = application
+        self.url_path = '/' + url_path.lstrip('/')
+        self.secret_token = secret_token or None
+        self.max_connections = max_connections
+        self.listen = listen
+        self.port = port
+        self.received = 0
+        self.rejected = 0
+        self._connections = 0
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle_connection, self.listen, self.port)
+        # Порт 0 означає довільний вільний порт
+        self.port = self._server.sockets[0].getsockname()[1]
+        logger.info(f"Webhook-сервер слухає {self.listen}:{self.port}{self.url_path}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        if self._connections >= self.max_connections:
+            # Telegram повторить доставку пізніше
+            self.rejected += 1
+            await self._respond(writer, HTTPStatus.SERVICE_UNAVAILABLE, keep_alive=False)
+            writer.close()
+            return
+
+        self._connections += 1
+        try:
+            while True:
+                request = await asyncio.wait_for(self._read_request(reader), IDLE_TIMEOUT)
+                if request is None:
+                    break
+                method, path, headers, body = request
+                status = await self._handle_request(method, path, headers, body)
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                await self._respond(writer, status, keep_alive)
+                if not keep_alive:
+                    break
+        except _BadRequest as e:
+            await self._respond(writer, e.status, keep_alive=False)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Помилка обробки запиту webhook: {e}")
+        finally:
+            self._connections -= 1
+            writer.close()
+
+    async def _read_request(self, reader):
+        """Читає один HTTP-запит; повертає None, якщо клієнт закрив з'єднання"""
+        request_line = await reader.readline()
+        if not request_line.strip():
+            return None
+        try:
+            method, target, _ = request_line.decode('latin-1').split(' ', 2)
+        except ValueError:
+            raise _BadRequest(HTTPStatus.BAD_REQUEST)
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise _BadRequest(HTTPStatus.LENGTH_REQUIRED)
+        try:
+            length = int(headers.get('content-length', '0'))
+        except ValueError:
+            raise _BadRequest(HTTPStatus.BAD_REQUEST)
+        if length > MAX_BODY_SIZE:
+            raise _BadRequest(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+        body = await reader.readexactly(length) if length else b''
+        return method, target.split('?', 1)[0], headers, body
+
+    async def _handle_request(self, method, path, headers, body):
+        if path != self.url_path:
+            return HTTPStatus.NOT_FOUND
+        if method != 'POST':
+            return HTTPStatus.METHOD_NOT_ALLOWED
+        if self.secret_token is not None:
+            token = headers.get(SECRET_HEADER, '')
+            if not hmac.compare_digest(token.encode(), self.secret_token.encode()):
+                logger.warning("Запит webhook без правильного секретного токена")
+                return HTTPStatus.FORBIDDEN
+
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except Exception as e:
+            logger.error(f"Не вдалося розібрати оновлення з webhook: {e}")
+            return HTTPStatus.BAD_REQUEST
+        if update is None:
+            return HTTPStatus.BAD_REQUEST
+
+        self.received += 1
+        await self.application.update_queue.put(update)
+        return HTTPStatus.OK
+
+    async def _respond(self, writer, status, keep_alive=True):
+        writer.write(
+            f"HTTP/1.1 {status.value} {status.phrase}\r\n"
+            f"Content-Length: 0\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode('latin-1')
+        )
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+class _BadRequest(Exception):
+    def __init__(self, status):
+        super().__init__(status.phrase)
+        self.status = status
+
+
+# Функція для запуску бота в режимі webhook
+async def run_webhook(application, server, webhook_url=None, allowed_updates=None):
+    """Запускає Application з вбудованим сервером до SIGINT/SIGTERM
+
+    Якщо webhook_url порожній, webhook у Telegram не реєструється - так сервер
+    можна перевіряти локально, надсилаючи йому записані оновлення.
+    """
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    async with application:
+        if application.post_init:
+            await application.post_init(application)
+        if webhook_url:
+            await application.bot.set_webhook(
+                webhook_url,
+                secret_token=server.secret_token,
+                max_connections=server.max_connections,
+                allowed_updates=allowed_updates,
+            )
+            logger.info(f"Webhook зареєстровано: {webhook_url}")
+        else:
+            logger.warning("WEBHOOK_URL не задано, webhook у Telegram не реєструється")
+        await application.start()
+        await server.start()
+        try:
+            await stop_event.wait()
+        finally:
+            await server.stop()
+            await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+    if application.post_shutdown:
+        await application.post_shutdown(application)
+
+
+# Функція для надсилання записаного оновлення на локальний сервер
+def post_update(url, update, secret_token=None):
+    """Надсилає одне оновлення (dict) POST-запитом; повертає HTTP-статус"""
+    request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), method='POST')
+    request.add_header('Content-Type', 'application/json')
+    if secret_token:
+        request.add_header('X-Telegram-Bot-Api-Secret-Token', secret_token)
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Інструменти режиму webhook")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    post_parser = subparsers.add_parser('post', help="надіслати записані оновлення на webhook-сервер")
+    post_parser.add_argument('json_path', help="файл з одним оновленням або списком оновлень")
+    post_parser.add_argument('--url', default='http://127.0.0.1:8443/telegram')
+    post_parser.add_argument('--secret', default=None)
+    args = parser.parse_args(argv)
+
+    with open(args.json_path, 'r', encoding='utf-8') as f:
+        updates = json.load(f)
+    if isinstance(updates, dict):
+        updates = [updates]
+    for update in updates:
+        status = post_update(args.url, update, args.secret)
+        print(f"update_id={update.get('update_id')}: HTTP {status}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,114 +1,562 @@
 from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters
+from telegram.ext import Application, CallbackQueryHandler, ChatMemberHandler, CommandHandler, MessageHandler, filters
+from telegram.error import BadRequest, Forbidden
 from datetime import datetime
 import os
 import logging
 import pytz
-import json
-from pathlib import Path
+import asyncio
+import time
+import socket
+import atexit
+from bot.storage import MessageSelection, open_message_store
+from bot.store_writer import StoreWriter
+from bot.history import (
+    CALLBACK_PREFIX, PAGE_SIZE, FilterError, HistoryFilters, decode_cursor, fetch_page, format_ranges, parse_filters, parse_selection,
+    render_page
+)
+from bot.search import (
+    CALLBACK_PREFIX as SEARCH_CALLBACK_PREFIX, RecentQueries, SearchIndex, decode_page, render_results, tokenize
+)
+from bot.groups import GroupRegistry
+from bot.chat_state import AppliedPermissions, SentStatuses
+from bot.admin_cache import MemberStatusCache
+from bot.chat_settings import ChatSchedules
+from bot.fanout import TokenBucket, call_with_retry, fan_out
+from bot.coalesce import BurstCoalescer
+from bot.outbox import LANE_BROADCAST, LANE_REPLY, LANE_REPORT, Outbox
+from bot.profiling import Profiler, ProfilingBusy
+from bot.scheduler import TransitionScheduler
+from bot.log_pipeline import setup_logging
+from bot import metrics
+from bot.shared_state import LeaderElection, SharedState
+from bot.webhook import DEFAULT_MAX_CONNECTIONS, WebhookServer, run_webhook
+from bot.clock import ALL_WEEKDAYS, LocalClock, Schedule, ScheduleRule, parse_time_of_day, parse_weekdays
+
+# Налаштування логування: черга з фоновим записом, JSON або текст
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')
+# Чи писати в лог текст повідомлень користувачів (за замовчуванням - тільки довжину)
+LOG_MESSAGE_TEXT = os.getenv('LOG_MESSAGE_TEXT', '0') == '1'
+# Проріджування записів з активних груп: перші N за хвилину, далі кожен K-й (0 - вимкнено)
+LOG_SAMPLE_BURST = int(os.getenv('LOG_SAMPLE_BURST', '20'))
+LOG_SAMPLE_EVERY = int(os.getenv('LOG_SAMPLE_EVERY', '10'))
 
-# Налаштування логування
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+log_listener = setup_logging(
+    level=logging.INFO,
+    json_format=LOG_FORMAT == 'json',
+    redact_text=not LOG_MESSAGE_TEXT,
+    sample_burst=LOG_SAMPLE_BURST,
+    sample_every=LOG_SAMPLE_EVERY,
 )
+# Дописуємо записи, що лишились у черзі, перед виходом
+atexit.register(log_listener.stop)
 logger = logging.getLogger(__name__)
 
 # Токен вашого бота з environment variables
 TOKEN = os.getenv('BOT_TOKEN')
 
+# Бекенд сховища історії: 'sqlite' або 'json' (журнал JSON Lines для невеликих установок)
+MESSAGE_STORE_BACKEND = os.getenv('MESSAGE_STORE', 'sqlite')
 # Файл для збереження повідомлень
-MESSAGES_FILE = 'messages_history.json'
+MESSAGES_FILE = os.getenv(
+    'MESSAGES_FILE',
+    'messages.db' if MESSAGE_STORE_BACKEND == 'sqlite' else 'messages_history.jsonl'
+)
+# Старий формат історії - переноситься у сховище при першому запуску
+LEGACY_MESSAGES_FILE = 'messages_history.json'
+# Скільки останніх повідомлень тримає гарячий шар сховища; старіші переносяться в архів
+MAX_STORED_MESSAGES = int(os.getenv(
+    'HOT_MESSAGES', '1000' if MESSAGE_STORE_BACKEND == 'json' else '100000'
+))
+# Каталог стиснутих денних сегментів архіву (порожній рядок вимикає архів)
+MESSAGES_ARCHIVE_DIR = os.getenv('MESSAGES_ARCHIVE_DIR', f"{MESSAGES_FILE}.archive")
+# Скільки днів зберігати архів (0 - без обмеження)
+ARCHIVE_RETENTION_DAYS = int(os.getenv('ARCHIVE_RETENTION_DAYS', '0'))
+# Як часто запускати обслуговування сховища (секунди)
+COMPACTION_INTERVAL = 600
+
+message_store = open_message_store(
+    MESSAGE_STORE_BACKEND, MESSAGES_FILE,
+    legacy_path=LEGACY_MESSAGES_FILE, max_records=MAX_STORED_MESSAGES,
+    stats_tz=pytz.timezone('Europe/Kiev'),
+    archive_dir=MESSAGES_ARCHIVE_DIR, archive_retention_days=ARCHIVE_RETENTION_DAYS
+)
+# Всі зміни історії йдуть через один записувач, що групує коміти
+message_writer = StoreWriter(message_store)
+
+# Режим роботи: single (один процес) або shared (кілька процесів зі спільним станом у SQLite)
+WORKER_MODE = os.getenv('WORKER_MODE', 'single')
+# Файл спільного стану; за замовчуванням - та сама база SQLite, що й історія повідомлень
+SHARED_STATE_FILE = os.getenv(
+    'SHARED_STATE_FILE',
+    MESSAGES_FILE if MESSAGE_STORE_BACKEND == 'sqlite' else 'shared_state.db'
+)
+# Ідентифікатор процесу в оренді лідера
+WORKER_ID = os.getenv('WORKER_ID', f"{socket.gethostname()}:{os.getpid()}")
+# Тривалість оренди лідера (секунди); продовжується втричі частіше
+LEADER_LEASE_TTL = int(os.getenv('LEADER_LEASE_TTL', '30'))
+# Як часто перечитувати стан чатів, змінений іншими процесами (секунди)
+SHARED_SYNC_INTERVAL = int(os.getenv('SHARED_SYNC_INTERVAL', '5'))
+# Простори імен стану по чатах у спільному сховищі
+SHARED_NAMESPACES = ('groups', 'permissions', 'schedules')
+
+shared_state = SharedState(SHARED_STATE_FILE) if WORKER_MODE == 'shared' else None
+leader_election = LeaderElection(shared_state, WORKER_ID, LEADER_LEASE_TTL) if shared_state else None
+
+# Журнал пошукового індексу (порожній рядок - індекс тільки в пам'яті).
+# У спільному режимі кожен процес будує власний індекс зі спільного сховища
+SEARCH_INDEX_FILE = os.getenv('SEARCH_INDEX_FILE', f"{MESSAGES_FILE}.search" if WORKER_MODE == 'single' else '')
+# Як часто дописувати нові записи індексу на диск (секунди)
+SEARCH_FLUSH_INTERVAL = int(os.getenv('SEARCH_FLUSH_INTERVAL', '30'))
+# Скільки повідомлень читати за раз, доганяючи сховище
+SEARCH_SYNC_CHUNK = 1000
+
+search_index = SearchIndex(SEARCH_INDEX_FILE or None)
+search_index_lock = asyncio.Lock()
+# Запити, сторінки яких можна гортати кнопками
+recent_searches = RecentQueries()
+
+# Файл реєстру груп, якими керує бот
+GROUPS_FILE = os.getenv('GROUPS_FILE', 'groups.json')
+
+group_registry = GroupRegistry(GROUPS_FILE)
+# Замок, що серіалізує запис реєстру груп на диск
+group_registry_lock = asyncio.Lock()
+
+# Файл з останніми застосованими дозволами кожної групи
+PERMISSIONS_STATE_FILE = os.getenv('PERMISSIONS_STATE_FILE', 'permissions_state.json')
+# Через скільки секунд повторно застосовувати незмінні дозволи (на випадок ручних змін у групі)
+PERMISSIONS_REVERIFY_INTERVAL = int(os.getenv('PERMISSIONS_REVERIFY_INTERVAL', '21600'))
+
+applied_permissions = AppliedPermissions(PERMISSIONS_STATE_FILE)
+applied_permissions_lock = asyncio.Lock()
+
+# Скільки секунд кешувати статус учасника для перевірки прав адміністратора
+ADMIN_CACHE_TTL = int(os.getenv('ADMIN_CACHE_TTL', '300'))
+
+member_status_cache = MemberStatusCache(ttl=ADMIN_CACHE_TTL)
+
+# Локальний HTTP-endpoint метрик у форматі Prometheus (0 - вимкнено); кожному процесу
+# в режимі WORKER_MODE=shared потрібен власний порт
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
 
-# Глобальна змінна для відстеження останнього статусу кожного чату
-last_status_per_chat = {}
+metrics_server = metrics.MetricsServer(listen=METRICS_LISTEN, port=METRICS_PORT)
+metrics.REGISTRY.gauge('bot_store_queue_size', "Зміни сховища, що чекають на коміт", message_writer.queue_size)
+metrics.REGISTRY.gauge('bot_log_queue_size', "Записи логу, що чекають на запис", log_listener.queue.qsize)
+metrics.REGISTRY.gauge('bot_groups', "Групи під контролем бота", lambda: len(group_registry))
+metrics.REGISTRY.gauge('bot_reply_bursts', "Серії повідомлень в особистих чатах, що чекають на збереження", lambda: len(reply_bursts))
+metrics.REGISTRY.gauge('bot_search_documents', "Повідомлення в пошуковому індексі", lambda: len(search_index))
 
-# Глобальні змінні для налаштування робочих годин
-working_hours = {
-    'start_hour': 8,
-    'end_hour': 23
-}
+# ID користувачів (через кому), яким доступні /profile і /memory; без них команди вимкнено
+BOT_OWNER_IDS = frozenset(
+    int(user_id) for user_id in os.getenv('BOT_OWNER_IDS', '').split(',') if user_id.strip()
+)
+# Найдовша сесія профілювання (секунди)
+PROFILE_MAX_SECONDS = int(os.getenv('PROFILE_MAX_SECONDS', '300'))
+# Частка часу, яку може займати потік вибірок стеку
+PROFILE_OVERHEAD_CAP = float(os.getenv('PROFILE_OVERHEAD_CAP', '0.02'))
+# Середня затримка циклу подій (мс), після якої сесія зупиняється достроково
+PROFILE_MAX_LAG_MS = int(os.getenv('PROFILE_MAX_LAG_MS', '250'))
+
+# У звітах окремо показуються обробники, через які йде основне навантаження
+profiler = Profiler(
+    max_seconds=PROFILE_MAX_SECONDS,
+    overhead_cap=PROFILE_OVERHEAD_CAP,
+    max_lag=PROFILE_MAX_LAG_MS / 1000,
+    focus=('message_handler', 'stats_command', 'check_and_update_group_permissions', 'set_chat_permissions'),
+)
+# Задача поточної сесії профілювання (не більше однієї)
+profiling_tasks = set()
+
+# Знімок стану виконання: останній надісланий статус кожного чату (у спільному режимі - в спільному стані)
+RUNTIME_STATE_FILE = os.getenv('RUNTIME_STATE_FILE', 'runtime_state.json')
+# Як часто записувати знімок, якщо він змінився (секунди)
+STATE_SNAPSHOT_INTERVAL = int(os.getenv('STATE_SNAPSHOT_INTERVAL', '60'))
+
+# Відновлюється в main() до запуску задач, щоб після перезапуску не надсилати повідомлення повторно
+sent_statuses = SentStatuses(RUNTIME_STATE_FILE)
+sent_statuses_lock = asyncio.Lock()
+
+# Інтервал страхувальної перевірки дозволів груп (секунди); основні переходи плануються точно
+RECONCILE_INTERVAL = int(os.getenv('RECONCILE_INTERVAL', '1800'))
+
+# Скільки груп оновлюється одночасно під час перевірки дозволів
+SWEEP_CONCURRENCY = int(os.getenv('SWEEP_CONCURRENCY', '20'))
+# Загальний ліміт викликів Bot API на секунду (Telegram дозволяє близько 30)
+API_RATE_LIMIT = float(os.getenv('API_RATE_LIMIT', '25'))
+
+api_rate_limiter = TokenBucket(API_RATE_LIMIT)
+
+# Ліміти надсилання в один чат (повідомлень на секунду в особистому чаті, на хвилину в групі; 0 - без ліміту)
+OUTBOX_PRIVATE_RATE = float(os.getenv('OUTBOX_PRIVATE_RATE', '1'))
+OUTBOX_GROUP_RATE_PER_MINUTE = float(os.getenv('OUTBOX_GROUP_RATE_PER_MINUTE', '20'))
+# Скільки повідомлень надсилається одночасно в різні чати
+OUTBOX_CONCURRENCY = int(os.getenv('OUTBOX_CONCURRENCY', '16'))
+
+# Всі повідомлення бота йдуть через одну чергу: відповіді, потім розсилки, потім звіти
+outbox = Outbox(
+    api_rate_limiter,
+    private_rate=OUTBOX_PRIVATE_RATE,
+    group_rate=OUTBOX_GROUP_RATE_PER_MINUTE / 60,
+    concurrency=OUTBOX_CONCURRENCY,
+)
+for lane, lane_name in ((LANE_REPLY, 'reply'), (LANE_BROADCAST, 'broadcast'), (LANE_REPORT, 'report')):
+    metrics.REGISTRY.gauge(
+        f'bot_outbox_{lane_name}_queue_size', f"Повідомлення в черзі відправлення ({lane_name})",
+        lambda lane=lane: outbox.queue_size(lane)
+    )
+# Задачі, що чекають на доставку повідомлень про статус і повертають статус у разі невдачі
+status_deliveries = set()
+
+# Серія повідомлень користувача в особистому чаті закінчується після REPLY_BURST_WINDOW секунд тиші,
+# але не пізніше REPLY_BURST_MAX_DELAY секунд від початку; серій у пам'яті - не більше REPLY_BURST_MAX_USERS
+REPLY_BURST_WINDOW = float(os.getenv('REPLY_BURST_WINDOW', '5'))
+REPLY_BURST_MAX_DELAY = float(os.getenv('REPLY_BURST_MAX_DELAY', '15'))
+REPLY_BURST_MAX_USERS = int(os.getenv('REPLY_BURST_MAX_USERS', '10000'))
+
+# Одна автовідповідь на серію повідомлень підряд; записи серії зберігаються однією зміною сховища
+reply_bursts = BurstCoalescer(
+    lambda records: save_messages(records),
+    window=REPLY_BURST_WINDOW,
+    max_delay=REPLY_BURST_MAX_DELAY,
+    max_users=REPLY_BURST_MAX_USERS,
+)
+
+# Робочі години за замовчуванням для чатів без власного розкладу
+ALLOWED_START_HOUR = int(os.getenv('ALLOWED_START_HOUR', '8'))
+ALLOWED_END_HOUR = int(os.getenv('ALLOWED_END_HOUR', '23'))
+# Часова зона робочих годин і святкові дні (через кому, YYYY-MM-DD) - вихідні для всіх груп
+WORKING_TIMEZONE = os.getenv('WORKING_TIMEZONE', 'Europe/Kiev')
+HOLIDAYS = [
+    datetime.strptime(day.strip(), '%Y-%m-%d').date()
+    for day in os.getenv('HOLIDAYS', '').split(',') if day.strip()
+]
+# Файл з власними розкладами чатів
+CHAT_SCHEDULES_FILE = os.getenv('CHAT_SCHEDULES_FILE', 'chat_schedules.json')
+
+KYIV_TIMEZONES = ('Europe/Kiev', 'Europe/Kyiv')
+
+# Режим отримання оновлень: polling (getUpdates) або webhook (вбудований HTTP-сервер)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+# Публічна адреса webhook; якщо порожня, webhook у Telegram не реєструється (локальна перевірка)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', str(DEFAULT_MAX_CONNECTIONS)))
+
+# Розклади чатів завантажуються один раз і далі читаються тільки з пам'яті
+chat_schedules = ChatSchedules(
+    CHAT_SCHEDULES_FILE,
+    Schedule.from_hours(ALLOWED_START_HOUR, ALLOWED_END_HOUR, WORKING_TIMEZONE, HOLIDAYS)
+)
+chat_schedules_lock = asyncio.Lock()
+
+# Поточний час у Києві з кешем на хвилину
+kyiv_clock = LocalClock('Europe/Kiev')
+# Годинники для інших часових зон чатів
+local_clocks = {'Europe/Kiev': kyiv_clock}
+
+# Функція для логування помилок відкладеного збереження
+def _log_save_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        metrics.STORE_ERRORS.inc(operation='add')
+        logger.error(f"Помилка збереження повідомлення: {future.exception()}")
+
+# Функція для індексації повідомлення після коміту
+def _index_saved_message(message_text, chat_id):
+    def index(future):
+        if not future.cancelled() and future.exception() is None:
+            search_index.add(future.result(), message_text, chat_id)
+    return index
+
+# Функція для індексації серії повідомлень після коміту
+def _index_saved_messages(records):
+    def index(future):
+        if not future.cancelled() and future.exception() is None:
+            for message_id, record in zip(future.result(), records):
+                search_index.add(message_id, record['message_text'], record['chat_id'])
+    return index
+
+# Функція для логування помилок відкладеного надсилання
+def _log_send_error(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error(f"Помилка надсилання відповіді: {future.exception()}")
+
+# Функція для відповіді на повідомлення через чергу відправлення
+def reply_to(update, text, **kwargs):
+    """Ставить відповідь у смугу відповідей; повертає future з надісланим повідомленням
+
+    Обробники не чекають на future: оновлення обробляються по одному, і
+    очікування ліміту чату чи RetryAfter затримало б усі інші чати.
+    Помилки надсилання логуються.
+    """
+    message = update.message
+    future = outbox.submit(LANE_REPLY, message.chat.id, lambda: message.reply_text(text, **kwargs))
+    future.add_done_callback(_log_send_error)
+    return future
+
+# Функція для надсилання звіту в особистий чат через чергу відправлення
+def send_report(user_id, make_call, update=None, confirmation=None):
+    """Ставить make_call() у смугу звітів для особистого чату user_id, не чекаючи доставки
+
+    Якщо команду виконано в групі (update), після доставки звіту в групі
+    з'являється confirmation, а якщо звіт надіслати не вдалось - повідомлення
+    про помилку.
+    """
+    in_group = update is not None and update.message.chat.type != 'private'
+    
+    def delivered(future):
+        if future.cancelled():
+            return
+        error = future.exception()
+        try:
+            if error is not None:
+                logger.error(f"Помилка надсилання звіту користувачу {user_id}: {error}")
+                if in_group:
+                    reply_to(update, "❌ Не вдалося надіслати відповідь в особисті повідомлення. Напишіть боту /start в особистому чаті.")
+            elif in_group and confirmation:
+                reply_to(update, confirmation)
+        except RuntimeError as e:
+            # Черга вже зупиняється
+            logger.warning(f"Підтвердження звіту не надіслано: {e}")
+    
+    future = outbox.submit(LANE_REPORT, user_id, make_call)
+    future.add_done_callback(delivered)
+    return future
+
+# Функція для створення запису повідомлення
+def make_message_record(user_name, user_id, chat_id, chat_type, message_text, timestamp, status, received_at=None):
+    """received_at - момент отримання (секунди epoch, зазвичай дата з оновлення); None - зараз"""
+    return {
+        'user_name': user_name,
+        'user_id': user_id,
+        'chat_id': chat_id,
+        'chat_type': chat_type,
+        'message_text': message_text,
+        'timestamp': timestamp,
+        'status': status,  # 'received', 'replied', 'rejected_time', 'manually_replied'
+        'replied_by': None,  # ID адміністратора, який відзначив як відповіджене
+        'reply_timestamp': None,
+        # Повний момент отримання: за ним повідомлення потрапляє в денний сегмент архіву
+        # (форматування кешується на хвилину, без роботи з часовою зоною на кожне повідомлення)
+        'created_at': kyiv_clock.isoformat(received_at)
+    }
 
 # Функція для збереження повідомлення
-def save_message(user_name, user_id, chat_id, chat_type, message_text, timestamp, status):
-    """Зберігає повідомлення у файл для історії"""
+def save_message(user_name, user_id, chat_id, chat_type, message_text, timestamp, status, received_at=None):
+    """Ставить повідомлення в чергу запису; повертає future з ID повідомлення"""
     try:
-        # Читаємо існуючі повідомлення
-        if Path(MESSAGES_FILE).exists():
-            with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
-        else:
-            messages = []
-        
-        # Додаємо нове повідомлення з унікальним ID
-        message_id = len(messages) + 1
-        message_data = {
-            'id': message_id,
-            'user_name': user_name,
-            'user_id': user_id,
-            'chat_id': chat_id,
-            'chat_type': chat_type,
-            'message_text': message_text,
-            'timestamp': timestamp,
-            'status': status,  # 'received', 'replied', 'rejected_time', 'manually_replied'
-            'replied_by': None,  # ID адміністратора, який відзначив як відповіджене
-            'reply_timestamp': None
-        }
-        messages.append(message_data)
-        
-        # Зберігаємо назад у файл (тримаємо останні 1000 повідомлень)
-        if len(messages) > 1000:
-            messages = messages[-1000:]
-            
-        with open(MESSAGES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
-            
+        message_data = make_message_record(
+            user_name, user_id, chat_id, chat_type, message_text, timestamp, status, received_at
+        )
+        submitted = time.perf_counter()
+        future = message_writer.submit('add', message_data)
+        future.add_done_callback(_log_save_error)
+        future.add_done_callback(_index_saved_message(message_text, chat_id))
+        # Час від постановки в чергу до коміту
+        future.add_done_callback(
+            lambda _: metrics.STORE_SECONDS.observe(time.perf_counter() - submitted, operation='add')
+        )
+        return future
     except Exception as e:
+        metrics.STORE_ERRORS.inc(operation='add')
         logger.error(f"Помилка збереження повідомлення: {e}")
 
+# Функція для збереження серії повідомлень однією зміною сховища
+def save_messages(records):
+    """Ставить записи в чергу запису; повертає future зі списком їхніх ID"""
+    try:
+        submitted = time.perf_counter()
+        future = message_writer.submit('add_many', records)
+        future.add_done_callback(_log_save_error)
+        future.add_done_callback(_index_saved_messages(records))
+        future.add_done_callback(
+            lambda _: metrics.STORE_SECONDS.observe(time.perf_counter() - submitted, operation='add_many')
+        )
+        return future
+    except Exception as e:
+        metrics.STORE_ERRORS.inc(operation='add')
+        logger.error(f"Помилка збереження повідомлень: {e}")
+
 # Функція для отримання останніх повідомлень
-def get_recent_messages(limit=10):
+async def get_recent_messages(limit=10):
     """Повертає останні повідомлення"""
     try:
-        if Path(MESSAGES_FILE).exists():
-            with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
-                
-                # Оновлюємо старі записи без ID
-                updated = False
-                for i, msg in enumerate(messages):
-                    if 'id' not in msg:
-                        msg['id'] = i + 1
-                        msg['replied_by'] = None
-                        msg['reply_timestamp'] = None
-                        updated = True
-                
-                # Зберігаємо оновлені дані
-                if updated:
-                    with open(MESSAGES_FILE, 'w', encoding='utf-8') as f_write:
-                        json.dump(messages, f_write, ensure_ascii=False, indent=2)
-                
-                return messages[-limit:] if messages else []
-        return []
+        with metrics.timer(metrics.STORE_SECONDS, operation='recent'):
+            return await asyncio.to_thread(message_store.recent, limit)
     except Exception as e:
+        metrics.STORE_ERRORS.inc(operation='recent')
         logger.error(f"Помилка читання повідомлень: {e}")
         return []
 
-# Функція для перевірки часу за київським часом
-def is_allowed_time():
-    # Отримуємо поточний час за київським часом (Europe/Kiev)
-    kyiv_tz = pytz.timezone('Europe/Kiev')
-    current_time_kyiv = datetime.now(kyiv_tz)
-    current_hour = current_time_kyiv.hour
-    return working_hours['start_hour'] <= current_hour < working_hours['end_hour']
+# Функція для фонового обслуговування сховища повідомлень
+async def maintain_message_store(context):
+    """Ущільнює/оптимізує сховище повідомлень через записувач сховища"""
+    try:
+        await message_writer.submit('maintenance')
+    except Exception as e:
+        logger.error(f"Помилка обслуговування сховища повідомлень: {e}")
+
+# Функція для синхронізації пошукового індексу зі сховищем
+async def sync_search_index():
+    """Індексує повідомлення, новіші за останній проіндексований ID (після перезапуску або з інших процесів)"""
+    while True:
+        records = await asyncio.to_thread(message_store.query, SEARCH_SYNC_CHUNK, after_id=search_index.last_id)
+        for record in records:
+            search_index.add(record['id'], record.get('message_text'), record.get('chat_id'))
+        if len(records) < SEARCH_SYNC_CHUNK:
+            return
+
+# Функція для збереження пошукового індексу
+async def persist_search_index(context=None):
+    """Дописує нові записи індексу в журнал у окремому потоці"""
+    if search_index.path is None or not search_index.dirty:
+        return
+    async with search_index_lock:
+        pending, reset = search_index.take_pending()
+        try:
+            await asyncio.to_thread(search_index.write_pending, pending, reset)
+        except Exception as e:
+            # Спробуємо ще раз під час наступного запису
+            search_index.requeue(pending, reset)
+            logger.error(f"Помилка збереження пошукового індексу: {e}")
+
+# Функція для збереження реєстру груп
+async def persist_group_registry():
+    """Записує реєстр груп на диск (або в спільний стан) у окремому потоці"""
+    try:
+        async with group_registry_lock:
+            if shared_state is not None:
+                await asyncio.to_thread(shared_state.save, 'groups', group_registry.chat_snapshot())
+            else:
+                await asyncio.to_thread(group_registry.write, group_registry.snapshot())
+    except Exception as e:
+        logger.error(f"Помилка збереження реєстру груп: {e}")
+
+# Функція для збереження застосованих дозволів
+async def persist_applied_permissions():
+    """Записує стан дозволів на диск (або в спільний стан), якщо він змінився"""
+    if not applied_permissions.dirty:
+        return
+    data = applied_permissions.snapshot()
+    try:
+        async with applied_permissions_lock:
+            if shared_state is not None:
+                await asyncio.to_thread(shared_state.save, 'permissions', data)
+            else:
+                await asyncio.to_thread(applied_permissions.write, data)
+    except Exception as e:
+        logger.error(f"Помилка збереження стану дозволів: {e}")
+
+# Функція для збереження знімка статусів чатів
+async def persist_sent_statuses(context=None):
+    """Атомарно записує знімок надісланих статусів, якщо він змінився"""
+    if shared_state is not None or not sent_statuses.dirty:
+        return
+    data = sent_statuses.snapshot()
+    try:
+        async with sent_statuses_lock:
+            await asyncio.to_thread(sent_statuses.write, data)
+    except Exception as e:
+        # Запишемо при наступній спробі
+        sent_statuses.dirty = True
+        logger.error(f"Помилка збереження знімка статусів: {e}")
+
+# Функція для збереження розкладів чатів
+async def persist_chat_schedules():
+    """Записує розклади чатів на диск (або в спільний стан) у окремому потоці"""
+    data = chat_schedules.snapshot()
+    try:
+        async with chat_schedules_lock:
+            if shared_state is not None:
+                await asyncio.to_thread(shared_state.save, 'schedules', data)
+            else:
+                await asyncio.to_thread(chat_schedules.write, data)
+    except Exception as e:
+        logger.error(f"Помилка збереження розкладів чатів: {e}")
+
+# Функція для першого завантаження спільного стану
+async def load_shared_state():
+    """Читає стан чатів зі спільного сховища; порожні простори імен заповнює з локальних файлів"""
+    for namespace, local_snapshot, restore in (
+        ('groups', group_registry.chat_snapshot, group_registry.restore_chats),
+        ('permissions', applied_permissions.snapshot, applied_permissions.restore),
+        ('schedules', chat_schedules.snapshot, chat_schedules.restore),
+    ):
+        data = await asyncio.to_thread(shared_state.load, namespace)
+        if data:
+            restore(data)
+        else:
+            await asyncio.to_thread(shared_state.save, namespace, local_snapshot())
+
+# Функція для синхронізації стану, зміненого іншими процесами
+async def sync_shared_state(context):
+    """Перечитує простори імен, які змінили інші процеси"""
+    try:
+        changed = await asyncio.to_thread(shared_state.changed_namespaces, SHARED_NAMESPACES)
+        if 'groups' in changed:
+            async with group_registry_lock:
+                group_registry.restore_chats(await asyncio.to_thread(shared_state.load, 'groups'))
+        # Незаписані локальні зміни дозволів не затираємо - їх запише поточна перевірка
+        if 'permissions' in changed and not applied_permissions.dirty:
+            async with applied_permissions_lock:
+                applied_permissions.restore(await asyncio.to_thread(shared_state.load, 'permissions'))
+        if 'schedules' in changed:
+            async with chat_schedules_lock:
+                chat_schedules.restore(await asyncio.to_thread(shared_state.load, 'schedules'))
+            if is_leader():
+                transition_scheduler.plan(context.job_queue)
+        # Повідомлення, збережені іншими процесами, потрапляють у пошуковий індекс цього процесу
+        await sync_search_index()
+    except Exception as e:
+        logger.error(f"Помилка синхронізації спільного стану: {e}")
+
+# Функція для запам'ятовування останнього надісланого статусу чату
+async def remember_status(chat_id, status):
+    """Записує статус чату (None - забуває) і повертає попередній"""
+    if shared_state is not None:
+        # Атомарна заміна: з кількох процесів повідомлення надсилає тільки перший
+        return await asyncio.to_thread(shared_state.swap, 'status', chat_id, status)
+    return sent_statuses.swap(chat_id, status)
+
+# Функція для перевірки, чи виконує цей процес задачі лідера
+def is_leader():
+    """В режимі одного процесу - завжди True"""
+    return leader_election is None or leader_election.is_leader
+
+# Функція для перевірки робочого часу
+def is_allowed_time(chat_id=None):
+    # Порівняння з закешованою межею розкладу чату, без роботи з часовими зонами
+    return chat_schedules.clock_for(chat_id).is_allowed()
 
 # Функція для отримання поточного часу у Києві
 def get_kyiv_time_string():
-    kyiv_tz = pytz.timezone('Europe/Kiev')
-    current_time_kyiv = datetime.now(kyiv_tz)
-    return current_time_kyiv.strftime("%H:%M")
+    return kyiv_clock.time_string()
+
+# Функція для рядка з поточним часом у часовій зоні чату
+def get_chat_time_text(chat_id):
+    """Повертає "Поточний час у Києві: HH:MM" (або в часовій зоні розкладу чату)"""
+    timezone = chat_schedules.schedule_for(chat_id).timezone
+    clock = local_clocks.get(timezone)
+    if clock is None:
+        clock = local_clocks[timezone] = LocalClock(timezone)
+    place = "у Києві" if timezone in KYIV_TIMEZONES else f"({timezone})"
+    return f"Поточний час {place}: {clock.time_string()}"
+
+# Функція для форматування моменту наступного переходу
+def format_next_transition(clock):
+    """Повертає дату й час наступного переходу розкладу або None"""
+    moment, _ = clock.next_transition()
+    if moment is None:
+        return None
+    local = datetime.fromtimestamp(moment, clock.schedule.tz)
+    return local.strftime("%d.%m %H:%M")
 
 # Функція для блокування/розблокування чату
+@metrics.timed(metrics.OPERATION_SECONDS, metrics.OPERATION_ERRORS, operation='set_chat_permissions')
 async def set_chat_permissions(context, chat_id, can_send_messages=True):
     """Встановлює дозволи для чату"""
     try:
@@ -125,99 +573,189 @@ async def set_chat_permissions(context, chat_id, can_send_messages=True):
             can_send_other_messages=can_send_messages,
             can_add_web_page_previews=can_send_messages
         )
-        await context.bot.set_chat_permissions(chat_id=chat_id, permissions=permissions)
+        await call_with_retry(
+            lambda: context.bot.set_chat_permissions(chat_id=chat_id, permissions=permissions),
+            api_rate_limiter
+        )
+        applied_permissions.record(chat_id, can_send_messages, time.time())
         return True
+    except (Forbidden, BadRequest) as e:
+        # Бота видалили з групи або він більше не адміністратор - прибираємо групу з реєстру
+        logger.error(f"Помилка зміни дозволів чату {chat_id}: {e}")
+        if isinstance(e, Forbidden) or 'rights' in e.message.lower() or 'not found' in e.message.lower():
+            applied_permissions.forget(chat_id)
+            if group_registry.prune(chat_id):
+                logger.info(f"Групу {chat_id} прибрано з реєстру: бот не має прав адміністратора")
+                await persist_group_registry()
+        return False
     except Exception as e:
         logger.error(f"Помилка зміни дозволів чату {chat_id}: {e}")
         return False
 
 # Функція для надсилання повідомлення про статус часу
+@metrics.timed(metrics.OPERATION_SECONDS, metrics.OPERATION_ERRORS, operation='send_time_status_message')
 async def send_time_status_message(context, chat_id, is_allowed):
-    """Надсилає повідомлення про статус робочого часу тільки при зміні статусу"""
-    global last_status_per_chat
-    
-    # Перевіряємо чи змінився статус для цього чату
+    """Ставить у чергу повідомлення про статус робочого часу тільки при зміні статусу
+
+    На доставку не чекає: повертає задачу, що завершується після неї (None,
+    якщо надсилати нічого). Розсилка чекає на всі такі задачі разом.
+    """
+    # Перевіряємо чи змінився статус для цього чату (і одразу запам'ятовуємо новий)
     current_status = 'allowed' if is_allowed else 'blocked'
-    last_status = last_status_per_chat.get(chat_id, None)
+    last_status = await remember_status(chat_id, current_status)
     
     # Якщо статус не змінився, не надсилаємо повідомлення
     if last_status == current_status:
-        return
+        return None
     
     try:
-        current_time = get_kyiv_time_string()
+        current_time_text = get_chat_time_text(chat_id)
+        schedule = chat_schedules.schedule_for(chat_id)
         if is_allowed:
-            message = f"🌅 Доброго ранку! \n\nТепер можна писати повідомлення в групі.\n\nРобочі години: {working_hours['start_hour']:02d}:00 - {working_hours['end_hour']:02d}:00\nПоточний час у Києві: {current_time}"
+            message = f"🌅 Доброго ранку! \n\nТепер можна писати повідомлення в групі.\n\nРобочі години: {schedule.describe()}\n{current_time_text}"
         else:
-            message = f"🌙 Робочий день закінчено!\n\nПовідомлення після {working_hours['end_hour']:02d}:00 неможна написати.\nПовертайтесь до нас після {working_hours['start_hour']:02d}:00 ранку.\n\nПоточний час у Києві: {current_time}"
-        
-        await context.bot.send_message(chat_id=chat_id, text=message)
+            next_open = format_next_transition(chat_schedules.clock_for(chat_id))
+            return_hint = f"Повертайтесь до нас {next_open}.\n\n" if next_open else ""
+            message = f"🌙 Робочий день закінчено!\n\nЗараз неможна написати повідомлення.\n{return_hint}Робочі години: {schedule.describe()}\n{current_time_text}"
         
-        # Зберігаємо поточний статус для цього чату
-        last_status_per_chat[chat_id] = current_status
-        
-        logger.info(f"Надіслано повідомлення про зміну статусу до чату {chat_id}: {current_status}")
+        future = outbox.submit(LANE_BROADCAST, chat_id, lambda: context.bot.send_message(chat_id=chat_id, text=message))
     except Exception as e:
         logger.error(f"Помилка надсилання повідомлення про час до чату {chat_id}: {e}")
+        # Повертаємо попередній статус, щоб повідомлення надіслалось при наступній перевірці
+        await remember_status(chat_id, last_status)
+        return None
+    
+    task = asyncio.create_task(confirm_status_message(future, chat_id, current_status, last_status))
+    status_deliveries.add(task)
+    task.add_done_callback(status_deliveries.discard)
+    return task
+
+# Функція для очікування доставки повідомлення про статус
+async def confirm_status_message(future, chat_id, current_status, last_status):
+    """Чекає на доставку; якщо вона не вдалась, повертає попередній статус чату"""
+    try:
+        await future
+        logger.info("Надіслано повідомлення про зміну статусу", extra={'chat_id': chat_id, 'status': current_status})
+    except Exception as e:
+        logger.error(f"Помилка надсилання повідомлення про час до чату {chat_id}: {e}")
+        # Повідомлення надішлеться при наступній перевірці
+        await remember_status(chat_id, last_status)
+        await persist_sent_statuses()
 
 # Функція для обробки повідомлень (тепер тільки для особистих чатів та команд)
 async def message_handler(update: Update, context):
+    started = time.perf_counter()
     current_time_str = get_kyiv_time_string()
     user_name = update.message.from_user.first_name or "друже"
     user_id = update.message.from_user.id
     chat_id = update.message.chat.id
     chat_type = update.message.chat.type
     message_text = update.message.text
-    
-    # Логування отриманого повідомлення
-    logger.info(f"Повідомлення від {user_name} (ID: {user_id}) в чаті {chat_id} ({chat_type}): {message_text}")
+    # Момент відправлення вже є в оновленні
+    received_at = update.message.date.timestamp()
     
     # В особистих чатах завжди відповідаємо
     if chat_type == 'private':
-        if not is_allowed_time():
-            response = f"Зараз не робочий час. Можна писати з {working_hours['start_hour']:02d}:00 до {working_hours['end_hour']:02d}:00.\n\nПоточний час у Києві: {current_time_str}"
-            await update.message.reply_text(response)
-            save_message(user_name, user_id, chat_id, chat_type, message_text, current_time_str, 'rejected_time')
+        if not is_allowed_time(chat_id):
+            status = 'rejected_time'
+            response = f"Зараз не робочий час. Робочі години: {chat_schedules.schedule_for(chat_id).describe()}.\n\n{get_chat_time_text(chat_id)}"
         else:
-            response_message = f"Дякую за повідомлення, {user_name}! 🙏\n\nПоточний час у Києві: {current_time_str}"
-            await update.message.reply_text(response_message)
-            save_message(user_name, user_id, chat_id, chat_type, message_text, current_time_str, 'replied')
+            status = 'replied'
+            response = f"Дякую за повідомлення, {user_name}! 🙏\n\n{get_chat_time_text(chat_id)}"
+        # Серія повідомлень підряд отримує одну відповідь і зберігається однією зміною
+        record = make_message_record(
+            user_name, user_id, chat_id, chat_type, message_text, current_time_str, status, received_at
+        )
+        if reply_bursts.add(user_id, record, status):
+            # Відповідь іде через чергу відправлення; обробник не чекає на Bot API
+            reply_to(update, response)
     else:
+        # Запам'ятовуємо групу для автоматичного контролю
+        if group_registry.seen(chat_id, update.message.chat.title):
+            await persist_group_registry()
+        
         # В групах зберігаємо повідомлення для статистики
-        if is_allowed_time():
-            save_message(user_name, user_id, chat_id, chat_type, message_text, current_time_str, 'received')
-        else:
-            # Це повідомлення не повинно дійти, але якщо дійшло - зберігаємо
-            save_message(user_name, user_id, chat_id, chat_type, message_text, current_time_str, 'blocked_time')
+        # (blocked_time - повідомлення не повинно дійти, але якщо дійшло - зберігаємо)
+        status = 'received' if is_allowed_time(chat_id) else 'blocked_time'
+        save_message(user_name, user_id, chat_id, chat_type, message_text, current_time_str, status, received_at)
+    
+    # Один структурований запис на повідомлення; текст форматується у фоновому потоці
+    logger.info(
+        "Повідомлення від %s", user_name,
+        extra={
+            'chat_id': chat_id,
+            'user_id': user_id,
+            'chat_type': chat_type,
+            'status': status,
+            'text': message_text,
+            'latency_ms': round((time.perf_counter() - started) * 1000, 2),
+        }
+    )
+
+# Функція для відстеження змін статусу бота в групах
+async def bot_membership_handler(update: Update, context):
+    """Оновлює реєстр груп, коли бота додають, видаляють або змінюють його права"""
+    member_update = update.my_chat_member
+    chat = member_update.chat
+    if chat.type not in ['group', 'supergroup']:
+        return
+    
+    new_status = member_update.new_chat_member.status
+    if new_status in ['creator', 'administrator']:
+        changed = group_registry.add(chat.id, chat.title)
+    elif new_status in ['left', 'kicked']:
+        changed = group_registry.remove(chat.id)
+    else:
+        # Бот у групі, але без прав адміністратора - керувати дозволами він не може
+        changed = group_registry.prune(chat.id)
+    
+    if changed:
+        # Стан дозволів у групі міг змінитися - наступна перевірка застосує їх заново
+        applied_permissions.forget(chat.id)
+        await persist_applied_permissions()
+        await persist_group_registry()
+        logger.info(f"Реєстр груп оновлено: чат {chat.id} ({chat.title}), статус бота: {new_status}")
+
+# Функція для відстеження змін учасників груп
+async def chat_member_handler(update: Update, context):
+    """Оновлює кеш статусів, коли учасника призначають, знімають або видаляють"""
+    member_update = update.chat_member
+    new_member = member_update.new_chat_member
+    member_status_cache.update(member_update.chat.id, new_member.user.id, new_member.status)
 
 # Функція для старту бота
 async def start(update: Update, context):
-    current_time_str = get_kyiv_time_string()
+    schedule = chat_schedules.schedule_for(update.message.chat.id)
     user_name = update.message.from_user.first_name or "друже"
     chat_type = "групі" if update.message.chat.type in ['group', 'supergroup'] else "особистому чаті"
     
     start_message = f"""Привіт, {user_name}! 👋
 
-Я бот, який працює з {working_hours['start_hour']:02d}:00 до {working_hours['end_hour']:02d}:00 за київським часом.
+Я бот, який працює за розкладом {schedule.describe()} ({schedule.timezone}).
 
 Я дякую за повідомлення та обов'язково відповідаю!
 
 **Доступні команди:**
 /start - показати це повідомлення
-/history або /messages - історія останніх 10 повідомлень (приватно адмінам)
+/history або /messages - історія повідомлень цього чату сторінками; фільтри: status=..., user=... (приватно адмінам; інші чати - власник бота)
+/search [слова] - пошук в історії повідомлень групи (приватно адмінам; по всіх чатах - власнику бота)
 /stats - статистика всіх повідомлень (приватно адмінам)
-/replied [ID] - відзначити повідомлення як відповіджене (тільки адміни)
+/replied [ID, 12-40, status=...] - відзначити повідомлення цього чату як відповіджені (тільки адміни; інші чати - власник бота)
 /update_permissions - оновити дозволи групи (тільки адміни)
-/clear_history - очистити всю історію (тільки власник)
+/clear_history - очистити історію групи (тільки власник групи; всю історію - власник бота)
 
 **Адмінські команди:**
-/set_hours [початок] [кінець] - встановити робочі години (наприклад: /set_hours 9 22)
+/set_hours [початок] [кінець] [дні] - встановити робочі години (наприклад: /set_hours 9 22 або /set_hours 9:30 18:00 1-5)
+/set_timezone [зона] - встановити часову зону чату (наприклад: /set_timezone Europe/Kyiv)
 /show_hours - показати поточні робочі години
+/metrics - затримки обробників і Bot API, помилки, черги
+/profile [секунди] [sample|cprofile] - профілювання бота, звіт файлом (тільки власник бота)
+/memory [секунди] - приріст пам'яті за час сесії (тільки власник бота)
 
-Поточний час у Києві: {current_time_str}
+{get_chat_time_text(update.message.chat.id)}
 Робота в {chat_type}"""
     
-    await update.message.reply_text(start_message)
+    reply_to(update, start_message)
 
 # Функція для перевірки прав адміністратора
 async def is_admin(update: Update, context):
@@ -230,70 +768,228 @@ async def is_admin(update: Update, context):
         return True
     
     try:
-        member = await context.bot.get_chat_member(chat_id, user_id)
-        return member.status in ['creator', 'administrator']
+        status = await member_status_cache.get_status(context.bot, chat_id, user_id)
+        return status in ['creator', 'administrator']
     except Exception as e:
         logger.error(f"Помилка перевірки прав адміністратора: {e}")
         return False
 
-# Команда для перегляду останніх повідомлень (тільки для адмінів)
+# Функція для перевірки, чи є користувач власником бота
+def is_bot_owner(update: Update):
+    """Власники бота (BOT_OWNER_IDS) можуть працювати з даними всіх чатів"""
+    return update.effective_user.id in BOT_OWNER_IDS
+
+# Функція для обмеження фільтрів історії чатом команди
+def scope_history_filters(update: Update, history_filters):
+    """Повертає фільтри, обмежені поточним чатом, або None, якщо вибраний чат недоступний
+
+    Без chat=... вибір обмежується поточним чатом; тільки власник бота в
+    особистому чаті бачить усі чати. Інші чати (chat=<id>) - тільки власнику.
+    """
+    chat_id = update.message.chat.id
+    if history_filters.chat_id is None:
+        if is_bot_owner(update) and update.message.chat.type == 'private':
+            return history_filters
+        return history_filters._replace(chat_id=chat_id)
+    if history_filters.chat_id != chat_id and not is_bot_owner(update):
+        return None
+    return history_filters
+
+# Функція для повторної перевірки доступу до історії при гортанні
+async def can_view_history(update: Update, context, history_filters):
+    """Чи може користувач, що натиснув кнопку, бачити історію за цими фільтрами"""
+    if is_bot_owner(update):
+        return True
+    user_id = update.effective_user.id
+    if history_filters.chat_id is None:
+        return False
+    if history_filters.chat_id == user_id:
+        # Власний особистий чат з ботом
+        return True
+    try:
+        status = await member_status_cache.get_status(context.bot, history_filters.chat_id, user_id)
+    except Exception as e:
+        logger.error(f"Помилка перевірки прав адміністратора: {e}")
+        return False
+    return status in ['creator', 'administrator']
+
+# Функція для вибірки сторінки історії
+async def load_history_page(history_filters, cursor=None):
+    """Повертає (текст MarkdownV2, клавіатура) сторінки історії"""
+    try:
+        with metrics.timer(metrics.STORE_SECONDS, operation='query'):
+            records, has_more = await asyncio.to_thread(fetch_page, message_store, history_filters, cursor)
+    except Exception:
+        metrics.STORE_ERRORS.inc(operation='query')
+        raise
+    return render_page(records, has_more, history_filters, cursor)
+
+# Команда для перегляду історії повідомлень (тільки для адмінів)
 async def history_command(update: Update, context):
-    """Показує останні повідомлення (тільки для адміністраторів)"""
+    """Показує сторінку історії з кнопками навігації (тільки для адміністраторів)
+
+    Фільтри: chat=<id>, status=<статус>, user=<id>. Історія обмежена поточним
+    чатом; інші чати і всі чати одразу (в особистому чаті) - тільки власнику бота.
+    """
     try:
         # Перевіряємо права адміністратора
         if not await is_admin(update, context):
-            await update.message.reply_text("❌ Ця команда доступна тільки адміністраторам групи.")
+            reply_to(update, "❌ Ця команда доступна тільки адміністраторам групи.")
             return
-        recent_messages = get_recent_messages(10)
-        
-        if not recent_messages:
-            await update.message.reply_text("📝 Історія повідомлень порожня.")
+        try:
+            history_filters = parse_filters(context.args or [], update.message.chat.id)
+        except FilterError as e:
+            reply_to(
+                update,
+                f"❌ {e}\n\nПриклад: /history here status=rejected_time user=123456"
+            )
+            return
+        history_filters = scope_history_filters(update, history_filters)
+        if history_filters is None:
+            reply_to(update, "❌ Історію інших чатів може переглядати тільки власник бота.")
             return
         
-        history_text = "📋 **Останні 10 повідомлень:**\n\n"
+        text, keyboard = await load_history_page(history_filters)
         
-        for i, msg in enumerate(recent_messages, 1):
-            status_emoji = {
-                'replied': '✅',
-                'manually_replied': '💬',
-                'rejected_time': '⏰',
-                'blocked_time': '🚫',
-                'received': '📨'
-            }.get(msg['status'], '❓')
-            
-            # Додаткова інформація для відповіджених повідомлень
-            reply_info = ""
-            if msg['status'] == 'manually_replied' and msg.get('replied_by'):
-                reply_info = f" (відповів адмін, {msg.get('reply_timestamp', 'невідомий час')})"
-            
-            # Безпечне екранування тексту для Markdown
-            safe_user_name = msg['user_name'].replace('*', '\\*').replace('_', '\\_').replace('[', '\\[').replace(']', '\\]')
-            safe_message_text = msg['message_text'][:50].replace('*', '\\*').replace('_', '\\_').replace('[', '\\[').replace(']', '\\]')
-            if len(msg['message_text']) > 50:
-                safe_message_text += "..."
+        # Відправляємо приватно адміністратору; кнопки гортають сторінки в цьому ж повідомленні
+        # (підтвердження в групі - після доставки)
+        user_id = update.message.from_user.id
+        send_report(
+            user_id,
+            lambda: context.bot.send_message(chat_id=user_id, text=text, parse_mode='MarkdownV2', reply_markup=keyboard),
+            update, "✅ Історію надіслано вам в особисті повідомлення."
+        )
             
-            history_text += f"{i}. {status_emoji} *{safe_user_name}* ({msg['timestamp']}) [ID: {msg.get('id', 'N/A')}]\n"
-            history_text += f"   💬 {safe_message_text}\n"
-            history_text += f"   📍 {msg['chat_type']} | Статус: {msg['status']}{reply_info}\n\n"
+    except Exception as e:
+        logger.error(f"Помилка при показі історії: {e}")
+        reply_to(update, "❌ Помилка при отриманні історії повідомлень.")
+
+# Функція для кнопок "старіші"/"новіші" в історії
+async def history_callback(update: Update, context):
+    query = update.callback_query
+    try:
+        cursor = decode_cursor(query.data)
+    except ValueError:
+        await query.answer("Ця кнопка застаріла, надішліть /history ще раз.")
+        return
+    # Сторінки надсилаються тільки в особистий чат адміністратора, що їх запросив
+    if query.message is None or query.message.chat.id != query.from_user.id:
+        await query.answer("❌ Недоступно.")
+        return
+    # Фільтри приходять з кнопки: права того, хто натиснув, перевіряються заново
+    if not await can_view_history(update, context, cursor.filters):
+        await query.answer("❌ Недоступно.")
+        return
+    try:
+        text, keyboard = await load_history_page(cursor.filters, cursor)
+        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
+        await query.answer()
+    except BadRequest as e:
+        # Сторінка не змінилась (повторне натискання)
+        logger.debug(f"Сторінку історії не оновлено: {e}")
+        await query.answer()
+    except Exception as e:
+        logger.error(f"Помилка гортання історії: {e}")
+        await query.answer("❌ Помилка при отриманні історії повідомлень.")
+
+# Функція для сторінки результатів пошуку
+async def load_search_page(query_text, chat_id, key, offset):
+    """Повертає (текст MarkdownV2, клавіатура) сторінки результатів від позиції offset; chat_id - тільки в цьому чаті
+
+    Індекс не синхронізується тут: свої повідомлення він отримує після коміту,
+    а повідомлення інших процесів - у задачі синхронізації спільного стану.
+    """
+    while True:
+        with metrics.timer(metrics.OPERATION_SECONDS, operation='search'):
+            found, total = search_index.search(query_text, chat_id)
+        page_ids = found[offset:offset + PAGE_SIZE]
+        try:
+            with metrics.timer(metrics.STORE_SECONDS, operation='get'):
+                records = await asyncio.to_thread(lambda: [message_store.get(message_id) for message_id in page_ids])
+        except Exception:
+            metrics.STORE_ERRORS.inc(operation='get')
+            raise
+        missing = [message_id for message_id, record in zip(page_ids, records) if record is None]
+        if not missing:
+            return render_results(query_text, records, total, len(found), key, offset)
+        # Повідомлень уже немає у сховищі (очищений архів): прибираємо їх з індексу
+        # і шукаємо знову, щоб позиції результатів не зсувались між сторінками
+        for message_id in missing:
+            search_index.discard(message_id)
+
+# Команда для пошуку в історії повідомлень (тільки для адмінів)
+async def search_command(update: Update, context):
+    """Шукає повідомлення за словами і надсилає результати приватно (тільки для адміністраторів)
+
+    У групі пошук іде тільки по повідомленнях цієї групи; в особистому чаті - по всіх чатах,
+    і тому доступний тільки власникам бота.
+    """
+    try:
+        if update.message.chat.type == 'private':
+            if not is_bot_owner(update):
+                reply_to(update, "❌ В особистому чаті пошук доступний тільки власнику бота. Виконайте /search у своїй групі.")
+                return
+            chat_scope = None
+        else:
+            # Перевіряємо права адміністратора
+            if not await is_admin(update, context):
+                reply_to(update, "❌ Ця команда доступна тільки адміністраторам групи.")
+                return
+            chat_scope = update.message.chat.id
         
-        # Відправляємо приватно адміністратору
-        user_id = update.message.from_user.id
+        query_text = ' '.join(context.args or []).strip()
+        if not query_text:
+            reply_to(update, "❌ Використання: /search [слова]\nПриклад: /search оплата рахунку")
+            return
+        if not tokenize(query_text):
+            reply_to(update, "❌ Запит складається тільки зі службових слів або коротких слів.")
+            return
         
-        # Розбиваємо на частини якщо занадто довго
-        if len(history_text) > 4000:
-            parts = [history_text[i:i+4000] for i in range(0, len(history_text), 4000)]
-            for part in parts:
-                await context.bot.send_message(chat_id=user_id, text=part, parse_mode='Markdown')
-        else:
-            await context.bot.send_message(chat_id=user_id, text=history_text, parse_mode='Markdown')
+        key = recent_searches.remember(query_text, chat_scope, update.message.from_user.id)
+        text, keyboard = await load_search_page(query_text, chat_scope, key, 0)
         
-        # Підтвердждення в групі
-        if update.message.chat.type != 'private':
-            await update.message.reply_text("✅ Історію надіслано вам в особисті повідомлення.")
+        # Відправляємо приватно адміністратору; кнопки гортають сторінки в цьому ж повідомленні
+        # (підтвердження в групі - після доставки)
+        user_id = update.message.from_user.id
+        send_report(
+            user_id,
+            lambda: context.bot.send_message(chat_id=user_id, text=text, parse_mode='MarkdownV2', reply_markup=keyboard),
+            update, "✅ Результати пошуку надіслано вам в особисті повідомлення."
+        )
             
     except Exception as e:
-        logger.error(f"Помилка при показі історії: {e}")
-        await update.message.reply_text("❌ Помилка при отриманні історії повідомлень.")
+        logger.error(f"Помилка пошуку: {e}")
+        reply_to(update, "❌ Помилка при пошуку повідомлень.")
+
+# Функція для кнопок гортання результатів пошуку
+async def search_callback(update: Update, context):
+    query = update.callback_query
+    try:
+        key, offset = decode_page(query.data)
+    except ValueError:
+        await query.answer("Ця кнопка застаріла, повторіть /search.")
+        return
+    remembered = recent_searches.get(key)
+    if remembered is None:
+        await query.answer("Цей пошук застарів, повторіть /search.")
+        return
+    # Результати гортає тільки той, хто шукав, в особистому чаті; чат пошуку запам'ятовано,
+    # коли права вже перевірено
+    if query.message is None or query.message.chat.id != query.from_user.id or query.from_user.id != remembered.user_id:
+        await query.answer("❌ Недоступно.")
+        return
+    query_text, chat_scope = remembered.query, remembered.chat_id
+    try:
+        text, keyboard = await load_search_page(query_text, chat_scope, key, offset)
+        await query.edit_message_text(text, parse_mode='MarkdownV2', reply_markup=keyboard)
+        await query.answer()
+    except BadRequest as e:
+        # Сторінка не змінилась (повторне натискання)
+        logger.debug(f"Сторінку пошуку не оновлено: {e}")
+        await query.answer()
+    except Exception as e:
+        logger.error(f"Помилка гортання результатів пошуку: {e}")
+        await query.answer("❌ Помилка при пошуку повідомлень.")
 
 # Команда для статистики повідомлень (тільки для адмінів)
 async def stats_command(update: Update, context):
@@ -301,31 +997,27 @@ async def stats_command(update: Update, context):
     try:
         # Перевіряємо права адміністратора
         if not await is_admin(update, context):
-            await update.message.reply_text("❌ Ця команда доступна тільки адміністраторам групи.")
-            return
-        if not Path(MESSAGES_FILE).exists():
-            await update.message.reply_text("📊 Статистика: поки що немає повідомлень.")
+            reply_to(update, "❌ Ця команда доступна тільки адміністраторам групи.")
             return
-            
-        with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-            all_messages = json.load(f)
+        if shared_state is not None:
+            # Лічильники могли змінити інші процеси
+            await asyncio.to_thread(message_store.refresh_stats)
+        stats = message_store.stats
+        total = stats.total()
         
-        if not all_messages:
-            await update.message.reply_text("📊 Статистика: поки що немає повідомлень.")
+        if not total:
+            reply_to(update, "📊 Статистика: поки що немає повідомлень.")
             return
         
-        # Підрахунок статистики
-        total = len(all_messages)
-        replied = len([m for m in all_messages if m['status'] == 'replied'])
-        rejected = len([m for m in all_messages if m['status'] == 'rejected_time'])
-        
-        # Унікальні користувачі
-        unique_users = len(set(m['user_name'] for m in all_messages))
+        # Лічильники ведуться під час запису, тому тут тільки читання
+        now_kyiv = kyiv_clock.now()
+        replied = stats.by_status('replied')
+        rejected = stats.by_status('rejected_time')
+        unique_users = stats.unique_users()
+        today_count = stats.on_day(now_kyiv)
+        hour_count = stats.in_hour(now_kyiv)
         
-        # Сьогоднішні повідомлення
-        today_kyiv = get_kyiv_time_string()[:5]  # HH:MM format
-        today_messages = [m for m in all_messages if m['timestamp'][:5] == today_kyiv[:5]]
-        today_count = len(today_messages)
+        cache_counters = member_status_cache.counters()
         
         stats_text = f"""📊 **Статистика повідомлень**
 
@@ -334,292 +1026,646 @@ async def stats_command(update: Update, context):
 ⏰ **Відхилено (час):** {rejected}
 👥 **Унікальних користувачів:** {unique_users}
 📅 **Сьогодні:** {today_count}
+🕐 **За поточну годину:** {hour_count}
 
 ⏰ **Поточний час у Києві:** {get_kyiv_time_string()}
-🕒 **Робочі години:** 8:00 - 23:00"""
+🕒 **Робочі години:** {chat_schedules.schedule_for(update.message.chat.id).describe()}
+🗂 **Кеш прав адміністраторів:** {cache_counters['hits']} влучань / {cache_counters['misses']} промахів"""
 
-        # Відправляємо приватно адміністратору
+        # Відправляємо приватно адміністратору (підтвердження в групі - після доставки)
         user_id = update.message.from_user.id
-        await context.bot.send_message(chat_id=user_id, text=stats_text, parse_mode='Markdown')
-        
-        # Підтвердждення в групі
-        if update.message.chat.type != 'private':
-            await update.message.reply_text("📊 Статистику надіслано вам в особисті повідомлення.")
+        send_report(
+            user_id,
+            lambda: context.bot.send_message(chat_id=user_id, text=stats_text, parse_mode='Markdown'),
+            update, "📊 Статистику надіслано вам в особисті повідомлення."
+        )
         
     except Exception as e:
         logger.error(f"Помилка при показі статистики: {e}")
-        await update.message.reply_text("❌ Помилка при отриманні статистики.")
+        reply_to(update, "❌ Помилка при отриманні статистики.")
 
 # Команда для очищення історії (тільки для власника)
 async def clear_history_command(update: Update, context):
-    """Очищує історію повідомлень (тільки для власника групи)"""
+    """Очищує історію повідомлень групи (тільки для власника групи)
+
+    У групі видаляються тільки її повідомлення, разом з архівом. Всю історію
+    (в особистому чаті) може очистити тільки власник бота.
+    """
     try:
         user_id = update.message.from_user.id
         chat_id = update.message.chat.id
         
-        # В особистому чаті завжди дозволяємо
         if update.message.chat.type == 'private':
-            is_owner = True
-        else:
-            try:
-                member = await context.bot.get_chat_member(chat_id, user_id)
-                is_owner = member.status == 'creator'
-            except Exception as e:
-                logger.error(f"Помилка перевірки прав власника: {e}")
-                is_owner = False
+            if not is_bot_owner(update):
+                reply_to(update, "❌ Всю історію може очистити тільки власник бота. Виконайте /clear_history у своїй групі.")
+                return
+            await clear_all_history(update)
+            return
+        
+        try:
+            status = await member_status_cache.get_status(context.bot, chat_id, user_id)
+            is_owner = status == 'creator'
+        except Exception as e:
+            logger.error(f"Помилка перевірки прав власника: {e}")
+            is_owner = False
         
         if not is_owner:
-            await update.message.reply_text("❌ Ця команда доступна тільки власнику групи.")
+            reply_to(update, "❌ Ця команда доступна тільки власнику групи.")
             return
         
-        # Очищаємо історію
-        if Path(MESSAGES_FILE).exists():
-            with open(MESSAGES_FILE, 'w', encoding='utf-8') as f:
-                json.dump([], f)
-            await update.message.reply_text("✅ Історію повідомлень очищено.")
-            logger.info(f"Історію очищено власником {update.message.from_user.first_name} (ID: {user_id})")
+        # Очищаємо історію тільки цієї групи
+        removed = await message_writer.submit('clear_chat', chat_id)
+        if removed:
+            for record in removed:
+                search_index.discard(record['id'])
+            await persist_search_index()
+            reply_to(update, f"✅ Історію повідомлень групи очищено ({len(removed)} повідомлень).")
+            logger.info(f"Історію чату {chat_id} очищено власником {update.message.from_user.first_name} (ID: {user_id})")
         else:
-            await update.message.reply_text("📝 Історія і так порожня.")
+            reply_to(update, "📝 Історія і так порожня.")
             
     except Exception as e:
         logger.error(f"Помилка при очищенні історії: {e}")
-        await update.message.reply_text("❌ Помилка при очищенні історії.")
+        reply_to(update, "❌ Помилка при очищенні історії.")
 
-# Команда для відзначення повідомлення як відповіджене
+# Функція для очищення всієї історії (тільки для власника бота)
+async def clear_all_history(update: Update):
+    user_id = update.message.from_user.id
+    # Незбережені серії потрапляють в історію до очищення, а не після
+    reply_bursts.flush_all()
+    if not await asyncio.to_thread(message_store.is_empty):
+        await message_writer.submit('clear')
+        search_index.clear()
+        await persist_search_index()
+        reply_to(update, "✅ Історію повідомлень очищено.")
+        logger.info(f"Всю історію очищено власником бота {update.message.from_user.first_name} (ID: {user_id})")
+    else:
+        reply_to(update, "📝 Історія і так порожня.")
+
+# Команда для відзначення повідомлень як відповіджених
 async def mark_replied_command(update: Update, context):
-    """Відзначає повідомлення як відповіджене (тільки для адміністраторів)"""
+    """Відзначає повідомлення як відповіджені (тільки для адміністраторів)
+
+    Приймає ID, списки і діапазони (/replied 5, /replied 12-40 45,47) і
+    фільтри (/replied status=rejected_time user=123). Всі повідомлення
+    змінюються одним записом у сховище, а відповідь - одне зведення.
+
+    Вибір обмежений поточним чатом. Повідомлення інших чатів (chat=<id>)
+    може відзначати тільки власник бота; в особистому чаті з ботом вибір
+    власника без chat=... охоплює всі чати.
+    """
     try:
         # Перевіряємо права адміністратора
         if not await is_admin(update, context):
-            await update.message.reply_text("❌ Ця команда доступна тільки адміністраторам групи.")
-            return
-        
-        # Отримуємо ID повідомлення з аргументів
-        if not context.args:
-            await update.message.reply_text("❌ Вкажіть ID повідомлення. Приклад: /replied 5")
+            reply_to(update, "❌ Ця команда доступна тільки адміністраторам групи.")
             return
         
+        usage = "Приклади: /replied 5, /replied 12-40 45,47, /replied status=rejected_time user=123456"
         try:
-            message_id = int(context.args[0])
-        except ValueError:
-            await update.message.reply_text("❌ ID повідомлення має бути числом. Приклад: /replied 5")
+            ranges, history_filters = parse_selection(context.args or [], update.message.chat.id)
+        except FilterError as e:
+            reply_to(update, f"❌ {e}\n\n{usage}")
             return
-        
-        # Читаємо історію повідомлень
-        if not Path(MESSAGES_FILE).exists():
-            await update.message.reply_text("❌ Історія повідомлень порожня.")
-            return
-            
-        with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-            messages = json.load(f)
-        
-        # Знаходимо повідомлення за ID
-        message_found = None
-        for msg in messages:
-            if msg.get('id') == message_id:
-                message_found = msg
-                break
-        
-        if not message_found:
-            await update.message.reply_text(f"❌ Повідомлення з ID {message_id} не знайдено.")
+        if not ranges and history_filters == HistoryFilters():
+            reply_to(update, f"❌ Вкажіть ID повідомлень або фільтр.\n\n{usage}")
             return
         
-        # Відзначаємо як відповіджене
-        message_found['status'] = 'manually_replied'
-        message_found['replied_by'] = update.message.from_user.id
-        message_found['reply_timestamp'] = get_kyiv_time_string()
-        
-        # Зберігаємо оновлену історію
-        with open(MESSAGES_FILE, 'w', encoding='utf-8') as f:
-            json.dump(messages, f, ensure_ascii=False, indent=2)
+        # Адміністратор групи змінює тільки повідомлення свого чату
+        history_filters = scope_history_filters(update, history_filters)
+        if history_filters is None:
+            reply_to(update, "❌ Відзначати повідомлення інших чатів може тільки власник бота.")
+            return
+        selection_filters = {field: value for field, value in history_filters.as_query().items() if value is not None}
         
-        # Відправляємо підтвердження приватно
+        # Одна зміна сховища для всього вибору
         user_id = update.message.from_user.id
-        # Безпечне екранування для Markdown
-        safe_user_name = message_found['user_name'].replace('*', '\\*').replace('_', '\\_').replace('[', '\\[').replace(']', '\\]')
-        safe_message_text = message_found['message_text'][:100].replace('*', '\\*').replace('_', '\\_').replace('[', '\\[').replace(']', '\\]')
-        if len(message_found['message_text']) > 100:
-            safe_message_text += "..."
-        
-        confirmation_text = f"✅ Повідомлення ID {message_id} від *{safe_user_name}* відзначено як відповіджене.\n\n💬 Текст: {safe_message_text}"
+        changed = await message_writer.submit(
+            'mark_replied_many',
+            MessageSelection(ranges, selection_filters),
+            replied_by=user_id,
+            reply_timestamp=get_kyiv_time_string()
+        )
         
-        await context.bot.send_message(chat_id=user_id, text=confirmation_text, parse_mode='Markdown')
+        if not changed:
+            reply_to(update, "❌ Не знайдено повідомлень, які ще не відзначені як відповіджені.")
+            return
         
-        # Підтвердження в групі
-        if update.message.chat.type != 'private':
-            await update.message.reply_text(f"✅ Повідомлення ID {message_id} відзначено як відповіджене.")
+        changed_ids = [message_id for message_id, _ in changed]
+        summary = f"✅ Відзначено як відповіджені: {len(changed_ids)} (ID {format_ranges(changed_ids)})."
+        if ranges:
+            requested = sum(high - low + 1 for low, high in ranges)
+            skipped = requested - len(changed_ids)
+            if skipped > 0:
+                summary += f"\nПропущено {skipped}: не знайдено, не підходять під фільтр або вже відповіджені."
+        reply_to(update, summary)
         
-        logger.info(f"Повідомлення ID {message_id} відзначено як відповіджене адміністратором {update.message.from_user.first_name} (ID: {user_id})")
+        logger.info(f"Відзначено як відповіджені {len(changed_ids)} повідомлень адміністратором {update.message.from_user.first_name} (ID: {user_id})")
         
     except Exception as e:
         logger.error(f"Помилка при відзначенні повідомлення: {e}")
-        await update.message.reply_text("❌ Помилка при відзначенні повідомлення.")
+        reply_to(update, "❌ Помилка при відзначенні повідомлення.")
 
 # Функція для перевірки та оновлення статусу всіх груп
 async def check_and_update_group_permissions(context):
     """Перевіряє час та оновлює дозволи для всіх груп"""
+    # Кілька процесів не повинні оновлювати ті самі групи одночасно
+    if not is_leader():
+        return
     try:
-        is_allowed = is_allowed_time()
+        now = time.time()
+        allowed_count = 0
+        deliveries = []
         
-        # Читаємо список груп з повідомлень
-        if Path(MESSAGES_FILE).exists():
-            with open(MESSAGES_FILE, 'r', encoding='utf-8') as f:
-                messages = json.load(f)
+        async def update_group(chat_id):
+            nonlocal allowed_count
+            # Кожна група перевіряється за власним розкладом
+            is_allowed = is_allowed_time(chat_id)
+            allowed_count += is_allowed
             
-            # Отримуємо унікальні ID груп
-            group_chats = set()
-            for msg in messages:
-                if msg.get('chat_type') in ['group', 'supergroup']:
-                    group_chats.add(msg['chat_id'])
-            
-            # Оновлюємо дозволи для кожної групи
-            for chat_id in group_chats:
+            # Викликаємо Bot API тільки якщо стан змінився або настав час повторної перевірки
+            if applied_permissions.needs_update(chat_id, is_allowed, now, PERMISSIONS_REVERIFY_INTERVAL):
                 success = await set_chat_permissions(context, chat_id, is_allowed)
-                if success:
-                    # Надсилаємо повідомлення про зміну статусу
-                    await send_time_status_message(context, chat_id, is_allowed)
-                    
-        logger.info(f"Оновлено дозволи для груп: {'дозволено' if is_allowed else 'заборонено'}")
+            else:
+                success = True
+            if success:
+                # Ставимо в чергу повідомлення про зміну статусу; доставку чекаємо після проходу
+                delivery = await send_time_status_message(context, chat_id, is_allowed)
+                if delivery is not None:
+                    deliveries.append(delivery)
+            return success
+        
+        # Оновлюємо дозволи для всіх груп з реєстру паралельно
+        report = await fan_out(list(group_registry), update_group, SWEEP_CONCURRENCY)
+        # Усі повідомлення розсилки чекаємо разом: статуси невдалих повертаються до запису
+        await asyncio.gather(*deliveries)
+        await persist_applied_permissions()
+        await persist_sent_statuses()
+        metrics.SWEEP_SECONDS.observe(report.duration)
+        metrics.SWEEP_FAILURES.inc(len(report.failures))
+        
+        logger.info(f"Оновлено дозволи для груп: дозволено в {allowed_count}, заборонено в {report.total - allowed_count} ({report.summary()})")
+        if report.failures:
+            logger.warning(f"Не вдалося оновити дозволи для груп: {report.failures}")
         
     except Exception as e:
         logger.error(f"Помилка оновлення дозволів груп: {e}")
 
+# Функція для обчислення моменту наступного переходу робочих годин
+def next_transition_time(after=None):
+    """Повертає найближчий початок або кінець робочих годин (або None, якщо переходів немає)"""
+    after_ts = time.time()
+    if after is not None:
+        after_ts = max(after_ts, after.timestamp())
+    # Найближчий перехід серед усіх розкладів (за замовчуванням і власних)
+    moments = [clock.next_transition(after_ts)[0] for clock in chat_schedules.clocks()]
+    moments = [moment for moment in moments if moment is not None]
+    if not moments:
+        return None
+    return datetime.fromtimestamp(min(moments), pytz.utc)
+
+# Планувальник, що запускає оновлення дозволів точно на межах робочих годин
+transition_scheduler = TransitionScheduler(check_and_update_group_permissions, next_transition_time)
+
 # Команда для ручного оновлення дозволів (тільки для адмінів)
 async def update_permissions_command(update: Update, context):
     """Ручне оновлення дозволів групи (тільки для адміністраторів)"""
     try:
         # Перевіряємо права адміністратора
         if not await is_admin(update, context):
-            await update.message.reply_text("❌ Ця команда доступна тільки адміністраторам групи.")
+            reply_to(update, "❌ Ця команда доступна тільки адміністраторам групи.")
             return
         
         chat_id = update.message.chat.id
-        is_allowed = is_allowed_time()
+        is_allowed = is_allowed_time(chat_id)
         
         success = await set_chat_permissions(context, chat_id, is_allowed)
         if success:
+            await persist_applied_permissions()
             await send_time_status_message(context, chat_id, is_allowed)
-            await update.message.reply_text("✅ Дозволи групи оновлено.")
+            await persist_sent_statuses()
+            reply_to(update, "✅ Дозволи групи оновлено.")
         else:
-            await update.message.reply_text("❌ Помилка оновлення дозволів групи.")
+            reply_to(update, "❌ Помилка оновлення дозволів групи.")
         
     except Exception as e:
         logger.error(f"Помилка команди оновлення дозволів: {e}")
-        await update.message.reply_text("❌ Помилка при оновленні дозволів.")
+        reply_to(update, "❌ Помилка при оновленні дозволів.")
+
+# Функція для застосування зміненого розкладу одного чату
+async def apply_chat_schedule(context, chat):
+    """Одразу застосовує новий розклад до групи і перебудовує план переходів"""
+    # Скидаємо статус тільки цього чату для повторного надсилання повідомлення
+    await remember_status(chat.id, None)
+    
+    if chat.type in ['group', 'supergroup'] and chat.id in group_registry:
+        is_allowed = is_allowed_time(chat.id)
+        if applied_permissions.needs_update(chat.id, is_allowed, time.time(), PERMISSIONS_REVERIFY_INTERVAL):
+            success = await set_chat_permissions(context, chat.id, is_allowed)
+            await persist_applied_permissions()
+        else:
+            success = True
+        if success:
+            await send_time_status_message(context, chat.id, is_allowed)
+    await persist_sent_statuses()
+    
+    # Переходи планує лідер; інші процеси передають йому розклад через спільний стан
+    if is_leader():
+        transition_scheduler.plan(context.job_queue)
 
 # Команда для встановлення робочих годин (тільки для адмінів)
 async def set_hours_command(update: Update, context):
     """Встановлення робочих годин (тільки для адміністраторів)"""
-    global working_hours, last_status_per_chat
+    usage = (
+        "❌ Використання: /set_hours [початок] [кінець] [дні]\n"
+        "Приклади: /set_hours 9 22, /set_hours 9:30 18:00 1-5, /set_hours 22:00 6:00\n"
+        "Дні тижня: 1 - понеділок ... 7 - неділя (за замовчуванням щодня)"
+    )
     
     try:
         # Перевіряємо права адміністратора
         if not await is_admin(update, context):
-            await update.message.reply_text("❌ Ця команда доступна тільки адміністраторам групи.")
+            reply_to(update, "❌ Ця команда доступна тільки адміністраторам групи.")
             return
         
         # Перевіряємо аргументи
-        if len(context.args) != 2:
-            await update.message.reply_text("❌ Використання: /set_hours [початок] [кінець]\nПриклад: /set_hours 9 22")
+        if len(context.args) not in (2, 3):
+            reply_to(update, usage)
             return
         
         try:
-            start_hour = int(context.args[0])
-            end_hour = int(context.args[1])
+            start = parse_time_of_day(context.args[0])
+            end = parse_time_of_day(context.args[1])
+            weekdays = parse_weekdays(context.args[2]) if len(context.args) == 3 else ALL_WEEKDAYS
         except ValueError:
-            await update.message.reply_text("❌ Години повинні бути числами. Приклад: /set_hours 9 22")
+            reply_to(update, usage)
             return
         
-        # Перевіряємо валідність годин
-        if not (0 <= start_hour <= 23) or not (0 <= end_hour <= 23):
-            await update.message.reply_text("❌ Години повинні бути від 0 до 23.")
+        # Кінець раніше за початок означає вікно через північ (наприклад, 22:00 - 6:00)
+        if start == end:
+            reply_to(update, "❌ Час початку і закінчення не можуть збігатися.")
             return
         
-        if start_hour >= end_hour:
-            await update.message.reply_text("❌ Час початку повинен бути менше часу закінчення.")
-            return
-        
-        # Зберігаємо нові години
-        old_start = working_hours['start_hour']
-        old_end = working_hours['end_hour']
-        working_hours['start_hour'] = start_hour
-        working_hours['end_hour'] = end_hour
+        # Зберігаємо новий розклад цього чату (часова зона зберігається)
+        chat_id = update.message.chat.id
+        old_schedule = chat_schedules.schedule_for(chat_id)
+        new_schedule = Schedule([ScheduleRule(weekdays, start, end)], old_schedule.timezone, old_schedule.holidays)
+        chat_schedules.set(chat_id, new_schedule)
+        await persist_chat_schedules()
         
-        # Скидаємо статуси чатів для повторного надсилання повідомлень
-        last_status_per_chat.clear()
+        await apply_chat_schedule(context, update.message.chat)
         
         success_message = f"""✅ Робочі години оновлено!
 
-📅 Було: {old_start:02d}:00 - {old_end:02d}:00
-🕐 Тепер: {start_hour:02d}:00 - {end_hour:02d}:00
+📅 Було: {old_schedule.describe()}
+🕐 Тепер: {new_schedule.describe()}
 
-Автоматичний контроль груп оновлено."""
+Автоматичний контроль групи оновлено."""
         
-        await update.message.reply_text(success_message)
-        logger.info(f"Робочі години змінено: {start_hour}:00-{end_hour}:00 (адмін: {update.message.from_user.first_name})")
+        reply_to(update, success_message)
+        logger.info(f"Робочі години чату {chat_id} змінено: {new_schedule.describe()} (адмін: {update.message.from_user.first_name})")
         
     except Exception as e:
         logger.error(f"Помилка команди set_hours: {e}")
-        await update.message.reply_text("❌ Помилка при встановленні робочих годин.")
+        reply_to(update, "❌ Помилка при встановленні робочих годин.")
+
+# Команда для встановлення часової зони чату (тільки для адмінів)
+async def set_timezone_command(update: Update, context):
+    """Встановлення часової зони розкладу чату (тільки для адміністраторів)"""
+    usage = (
+        "❌ Використання: /set_timezone [зона]\n"
+        "Приклади: /set_timezone Europe/Kyiv, /set_timezone Europe/Warsaw"
+    )
+    
+    try:
+        # Перевіряємо права адміністратора
+        if not await is_admin(update, context):
+            reply_to(update, "❌ Ця команда доступна тільки адміністраторам групи.")
+            return
+        
+        if len(context.args) != 1:
+            reply_to(update, usage)
+            return
+        
+        timezone = context.args[0]
+        try:
+            pytz.timezone(timezone)
+        except pytz.UnknownTimeZoneError:
+            reply_to(update, f"❌ Невідома часова зона: {timezone}\n\n{usage}")
+            return
+        
+        # Правила і святкові дні чату лишаються, змінюється тільки часова зона
+        chat_id = update.message.chat.id
+        old_schedule = chat_schedules.schedule_for(chat_id)
+        new_schedule = Schedule(old_schedule.rules, timezone, old_schedule.holidays)
+        chat_schedules.set(chat_id, new_schedule)
+        await persist_chat_schedules()
+        
+        await apply_chat_schedule(context, update.message.chat)
+        
+        reply_to(
+            update,
+            f"✅ Часову зону оновлено: {old_schedule.timezone} → {new_schedule.timezone}\n\n"
+            f"🕐 Розклад: {new_schedule.describe()}\n"
+            f"{get_chat_time_text(chat_id)}"
+        )
+        logger.info(f"Часову зону чату {chat_id} змінено: {timezone} (адмін: {update.message.from_user.first_name})")
+        
+    except Exception as e:
+        logger.error(f"Помилка команди set_timezone: {e}")
+        reply_to(update, "❌ Помилка при встановленні часової зони.")
 
 # Команда для показу поточних робочих годин
 async def show_hours_command(update: Update, context):
     """Показати поточні робочі години"""
     try:
-        current_time = get_kyiv_time_string()
-        is_working = is_allowed_time()
+        chat_id = update.message.chat.id
+        schedule = chat_schedules.schedule_for(chat_id)
+        current_time = get_chat_time_text(chat_id)
+        is_working = is_allowed_time(chat_id)
         status = "🟢 АКТИВНО" if is_working else "🔴 НЕАКТИВНО"
+        next_transition = format_next_transition(chat_schedules.clock_for(chat_id)) or "немає"
+        holidays = ", ".join(day.strftime("%d.%m.%Y") for day in sorted(schedule.holidays)) or "немає"
+        source = "власний розклад чату" if chat_schedules.has_own(chat_id) else "розклад за замовчуванням"
         
         message = f"""🕐 **Робочі години бота**
 
-⏰ Початок: {working_hours['start_hour']:02d}:00
-⏰ Кінець: {working_hours['end_hour']:02d}:00
+⏰ Розклад: {schedule.describe()} ({source})
+🌐 Часова зона: {schedule.timezone}
+🎉 Святкові дні: {holidays}
+⏭ Наступна зміна: {next_transition}
 
-🌍 Поточний час у Києві: {current_time}
+🌍 {current_time}
 📊 Статус: {status}
 
 {'✅ Зараз можна писати повідомлення' if is_working else '❌ Зараз повідомлення заблоковані'}"""
         
-        await update.message.reply_text(message)
+        reply_to(update, message)
         
     except Exception as e:
         logger.error(f"Помилка команди show_hours: {e}")
-        await update.message.reply_text("❌ Помилка при отриманні інформації про години.")
+        reply_to(update, "❌ Помилка при отриманні інформації про години.")
+
+# Команда для перегляду метрик (тільки для адмінів)
+async def metrics_command(update: Update, context):
+    """Коротке зведення метрик: затримки, помилки, черги"""
+    try:
+        if not await is_admin(update, context):
+            reply_to(update, "❌ Ця команда доступна тільки адміністраторам групи.")
+            return
+        
+        lines = metrics.summary()
+        if not lines:
+            reply_to(update, "📈 Метрик поки що немає.")
+            return
+        reply_to(update, "📈 Метрики бота\n\n" + "\n".join(lines))
+        
+    except Exception as e:
+        logger.error(f"Помилка команди metrics: {e}")
+        reply_to(update, "❌ Помилка при отриманні метрик.")
+
+# Функція для проведення сесії профілювання і надсилання звіту власнику
+async def run_profiling_session(context, user_id, kind, seconds):
+    try:
+        report = await profiler.run(kind, seconds)
+    except ProfilingBusy as e:
+        send_report(user_id, lambda: context.bot.send_message(chat_id=user_id, text=f"❌ {e}"))
+        return
+    except Exception as e:
+        logger.error(f"Помилка профілювання: {e}")
+        send_report(user_id, lambda: context.bot.send_message(chat_id=user_id, text="❌ Помилка профілювання."))
+        return
+    logger.info(f"Профілювання завершено: {report.summary}")
+    document = report.text.encode('utf-8')
+    # Звіт лишається в черзі: при зупинці вона дописується до кінця
+    send_report(user_id, lambda: context.bot.send_document(
+        chat_id=user_id, document=document, filename=report.filename(), caption=f"📄 {report.summary}"
+    ))
+
+# Функція для запуску сесії профілювання у фоні
+async def start_profiling(update: Update, context, kind, seconds):
+    if not is_bot_owner(update):
+        reply_to(update, "❌ Ця команда доступна тільки власнику бота.")
+        return
+    if profiling_tasks:
+        reply_to(update, f"⏳ Вже триває сесія {profiler.active or kind}. Зупинити: /profile stop")
+        return
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    user_id = update.message.from_user.id
+    # Обробник не чекає на кінець сесії, щоб не тримати оновлення
+    task = asyncio.create_task(run_profiling_session(context, user_id, kind, seconds))
+    profiling_tasks.add(task)
+    task.add_done_callback(profiling_tasks.discard)
+    logger.info(f"Профілювання {kind} на {seconds} с запущено користувачем {user_id}")
+    reply_to(update, f"⏱ Профілювання {kind} на {seconds} с запущено. Звіт надішлю в особисті повідомлення.")
+
+# Команда для профілювання бота (тільки для власника)
+async def profile_command(update: Update, context):
+    """/profile [секунди] [sample|cprofile] або /profile stop"""
+    try:
+        args = [arg.lower() for arg in context.args]
+        if args == ['stop']:
+            if not is_bot_owner(update):
+                reply_to(update, "❌ Ця команда доступна тільки власнику бота.")
+            elif profiler.stop():
+                reply_to(update, "⏹ Сесію зупинено, звіт надішлю в особисті повідомлення.")
+            else:
+                reply_to(update, "📝 Профілювання не запущено.")
+            return
+        kind, seconds = 'sample', 30
+        for arg in args:
+            if arg.isdigit():
+                seconds = int(arg)
+            elif arg in ('sample', 'cprofile'):
+                kind = arg
+            else:
+                reply_to(update, "❌ Формат: /profile [секунди] [sample|cprofile] або /profile stop")
+                return
+        await start_profiling(update, context, kind, seconds)
+        
+    except Exception as e:
+        logger.error(f"Помилка команди profile: {e}")
+        reply_to(update, "❌ Помилка при запуску профілювання.")
+
+# Команда для знімків пам'яті (тільки для власника)
+async def memory_command(update: Update, context):
+    """/memory [секунди] - різниця знімків tracemalloc на початку і в кінці"""
+    try:
+        seconds = 30
+        if context.args:
+            if len(context.args) > 1 or not context.args[0].isdigit():
+                reply_to(update, "❌ Формат: /memory [секунди]")
+                return
+            seconds = int(context.args[0])
+        await start_profiling(update, context, 'memory', seconds)
+        
+    except Exception as e:
+        logger.error(f"Помилка команди memory: {e}")
+        reply_to(update, "❌ Помилка при запуску діагностики пам'яті.")
+
+# Функція, що виконується після ініціалізації Application
+async def post_init(application):
+    await message_writer.start()
+    await outbox.start()
+    if METRICS_PORT:
+        try:
+            await metrics_server.start()
+        except OSError as e:
+            # Порт зайнятий (наприклад, іншим процесом бота) - працюємо без endpoint метрик
+            logger.warning(f"Endpoint метрик на {METRICS_LISTEN}:{METRICS_PORT} не запущено: {e}")
+    
+    if shared_state is not None:
+        await load_shared_state()
+        first_run = len(group_registry) == 0
+    else:
+        first_run = not group_registry.exists()
+    
+    # При першому запуску заповнюємо реєстр групами з історії повідомлень
+    if first_run:
+        for chat_id in await asyncio.to_thread(message_store.group_chat_ids):
+            group_registry.seen(chat_id)
+        await persist_group_registry()
+        logger.info(f"Реєстр груп створено з історії: {len(group_registry)} груп")
+    
+    # Пошуковий індекс: журнал з диска, потім повідомлення, збережені після останнього запису журналу
+    if not await asyncio.to_thread(search_index.load):
+        search_index.clear()
+    await sync_search_index()
+    await persist_search_index()
+
+# Функція, що виконується при зупинці Application
+async def post_shutdown(application):
+    if leader_election is not None:
+        # Інший процес перехопить роль лідера без очікування кінця оренди
+        await leader_election.release()
+        shared_state.close()
+    await metrics_server.stop()
+    # Незавершена сесія профілювання встигає надіслати звіт до зупинки черги
+    if profiling_tasks:
+        profiler.stop()
+        await asyncio.gather(*profiling_tasks, return_exceptions=True)
+    await outbox.stop()
+    # Статуси недоставлених повідомлень повертаються до запису
+    if status_deliveries:
+        await asyncio.gather(*status_deliveries)
+    await persist_sent_statuses()
+    reply_bursts.flush_all()
+    await message_writer.stop()
+    await persist_search_index()
+    message_store.close()
+
+# Задачі, які виконує тільки лідер
+LEADER_JOB_NAMES = ('permissions-reconcile', 'store-maintenance', TransitionScheduler.JOB_NAME)
+
+# Функція для запуску задач лідера
+def start_leader_jobs(job_queue, first_sweep=10):
+    """Точні переходи, страхувальна перевірка дозволів і обслуговування сховища"""
+    job_queue.run_repeating(
+        check_and_update_group_permissions, interval=RECONCILE_INTERVAL, first=first_sweep,
+        name='permissions-reconcile'
+    )
+    transition_scheduler.plan(job_queue)
+    job_queue.run_repeating(
+        maintain_message_store, interval=COMPACTION_INTERVAL, first=COMPACTION_INTERVAL,
+        name='store-maintenance'
+    )
+
+# Функція для зупинки задач лідера
+def stop_leader_jobs(job_queue):
+    for name in LEADER_JOB_NAMES:
+        for job in job_queue.get_jobs_by_name(name):
+            job.schedule_removal()
+
+# Функція для продовження оренди лідера
+async def renew_leadership(context):
+    """Продовжує оренду і запускає або зупиняє задачі лідера при зміні ролі"""
+    if not await leader_election.renew():
+        return
+    if leader_election.is_leader:
+        # Новий лідер одразу перевіряє групи: попередній міг зупинитися посеред переходу
+        start_leader_jobs(context.job_queue, first_sweep=0)
+    else:
+        stop_leader_jobs(context.job_queue)
 
 # Головна функція для запуску бота
 def main():
     if not TOKEN:
         logger.error("BOT_TOKEN не знайдено в environment variables!")
         return
+    if shared_state is not None and MESSAGE_STORE_BACKEND != 'sqlite':
+        logger.error("WORKER_MODE=shared потребує MESSAGE_STORE=sqlite: журнал JSON не підтримує кілька процесів")
+        return
+    if shared_state is not None and BOT_MODE != 'webhook':
+        logger.warning("Telegram віддає getUpdates тільки одному процесу; для кількох процесів використовуйте BOT_MODE=webhook")
     
     current_kyiv_time = get_kyiv_time_string()
     logger.info("Запускаю Telegram бота для контролю часу...")
-    logger.info(f"Дозволені години: {working_hours['start_hour']:02d}:00 - {working_hours['end_hour']:02d}:00 (за київським часом)")
+    logger.info(f"Дозволені години за замовчуванням: {chat_schedules.default_schedule.describe()} ({chat_schedules.default_schedule.timezone})")
     logger.info(f"Поточний час у Києві: {current_kyiv_time}")
     
     # Створення Application
-    application = Application.builder().token(TOKEN).build()
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        # Клієнти Bot API, що вимірюють тривалість кожного методу
+        .request(metrics.InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(metrics.InstrumentedRequest())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_MODE == 'webhook':
+        # Оновлення приходять на власний сервер, getUpdates не потрібен
+        builder = builder.updater(None)
+    application = builder.build()
+    metrics.REGISTRY.gauge('bot_update_queue_size', "Оновлення, що чекають на обробку", application.update_queue.qsize)
     
     # Додавання команд
-    application.add_handler(CommandHandler('start', start))
-    application.add_handler(CommandHandler('history', history_command))
-    application.add_handler(CommandHandler('messages', history_command))  # альтернативна команда
-    application.add_handler(CommandHandler('stats', stats_command))
-    application.add_handler(CommandHandler('clear_history', clear_history_command))
-    application.add_handler(CommandHandler('replied', mark_replied_command))
-    application.add_handler(CommandHandler('update_permissions', update_permissions_command))
-    application.add_handler(CommandHandler('set_hours', set_hours_command))
-    application.add_handler(CommandHandler('show_hours', show_hours_command))
+    application.add_handler(CommandHandler('start', metrics.timed_handler('start', start)))
+    application.add_handler(CommandHandler('history', metrics.timed_handler('history', history_command)))
+    application.add_handler(CommandHandler('messages', metrics.timed_handler('messages', history_command)))  # альтернативна команда
+    application.add_handler(CallbackQueryHandler(metrics.timed_handler('history_page', history_callback), pattern=f'^{CALLBACK_PREFIX}'))
+    application.add_handler(CommandHandler('search', metrics.timed_handler('search', search_command)))
+    application.add_handler(CallbackQueryHandler(metrics.timed_handler('search_page', search_callback), pattern=f'^{SEARCH_CALLBACK_PREFIX}'))
+    application.add_handler(CommandHandler('stats', metrics.timed_handler('stats', stats_command)))
+    application.add_handler(CommandHandler('clear_history', metrics.timed_handler('clear_history', clear_history_command)))
+    application.add_handler(CommandHandler('replied', metrics.timed_handler('replied', mark_replied_command)))
+    application.add_handler(CommandHandler('update_permissions', metrics.timed_handler('update_permissions', update_permissions_command)))
+    application.add_handler(CommandHandler('set_hours', metrics.timed_handler('set_hours', set_hours_command)))
+    application.add_handler(CommandHandler('set_timezone', metrics.timed_handler('set_timezone', set_timezone_command)))
+    application.add_handler(CommandHandler('metrics', metrics.timed_handler('metrics', metrics_command)))
+    application.add_handler(CommandHandler('show_hours', metrics.timed_handler('show_hours', show_hours_command)))
+    application.add_handler(CommandHandler('profile', metrics.timed_handler('profile', profile_command)))
+    application.add_handler(CommandHandler('memory', metrics.timed_handler('memory', memory_command)))
     
     # Додавання обробника для повідомлень
-    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
+    application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, metrics.timed_handler('message', message_handler)))
     
-    # Додавання автоматичної перевірки часу кожну хвилину
+    # Відстеження додавання/видалення бота та зміни його прав у групах
+    application.add_handler(ChatMemberHandler(metrics.timed_handler('my_chat_member', bot_membership_handler), ChatMemberHandler.MY_CHAT_MEMBER))
+    application.add_handler(ChatMemberHandler(metrics.timed_handler('chat_member', chat_member_handler), ChatMemberHandler.CHAT_MEMBER))
+    
+    # Стан виконання відновлюється до запуску задач: перша перевірка після перезапуску
+    # не надсилає повідомлень групам, які вже отримали поточний статус
+    if shared_state is None:
+        restored = sent_statuses.load()
+        staggered = applied_permissions.stagger_overdue(time.time(), PERMISSIONS_REVERIFY_INTERVAL)
+        logger.info(f"Відновлено статуси {restored} груп; прострочених повторних перевірок дозволів розподілено: {staggered}")
+    
+    # Додавання автоматичного контролю часу: точні переходи + рідка страхувальна перевірка
     try:
         job_queue = application.job_queue
         if job_queue:
-            job_queue.run_repeating(check_and_update_group_permissions, interval=60, first=10)
-            logger.info("Автоматична перевірка часу налаштована: кожну хвилину")
+            if leader_election is not None:
+                # Задачі лідера запускаються після отримання оренди
+                job_queue.run_repeating(renew_leadership, interval=max(1, LEADER_LEASE_TTL / 3), first=0, name='leader-lease')
+                job_queue.run_repeating(sync_shared_state, interval=SHARED_SYNC_INTERVAL, first=SHARED_SYNC_INTERVAL, name='shared-state-sync')
+                logger.info(f"Спільний режим: процес {WORKER_ID}, стан у {SHARED_STATE_FILE}")
+            else:
+                start_leader_jobs(job_queue)
+            if shared_state is None:
+                job_queue.run_repeating(persist_sent_statuses, interval=STATE_SNAPSHOT_INTERVAL, first=STATE_SNAPSHOT_INTERVAL, name='runtime-state-snapshot')
+            if search_index.path is not None:
+                job_queue.run_repeating(persist_search_index, interval=SEARCH_FLUSH_INTERVAL, first=SEARCH_FLUSH_INTERVAL, name='search-index-flush')
+            logger.info(f"Автоматичний контроль часу налаштовано: переходи за розкладом, перевірка кожні {RECONCILE_INTERVAL} с")
         else:
             logger.warning("JobQueue недоступний, автоматична перевірка вимкнена")
     except Exception as e:
@@ -627,8 +1673,19 @@ def main():
     
     # Запуск бота
     logger.info("Бот запускається...")
-    logger.info("Автоматична перевірка часу: кожну хвилину")
-    application.run_polling()
+    # chat_member не надсилається Telegram без явного запиту
+    if BOT_MODE == 'webhook':
+        server = WebhookServer(
+            application,
+            WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+        )
+        asyncio.run(run_webhook(application, server, WEBHOOK_URL, allowed_updates=Update.ALL_TYPES))
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()